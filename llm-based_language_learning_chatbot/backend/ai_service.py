@@ -1,52 +1,82 @@
 import os
+import time
 import asyncio
-import base64
 import logging
+from contextlib import aclosing
 from openai import AsyncOpenAI
 from fastapi.concurrency import run_in_threadpool
-from rag_service import search_knowledge
+from rag_service import search_knowledge_scored, embed_query
 from rule_service import check_rules
+from answer_cache import answer_cache, ANSWER_CACHE_ENABLED
+from history_service import HISTORY_MAX_MESSAGES
+from prompt_builder import build_agent_messages, build_synthesis_messages
+from image_pipeline import image_data_url
+from upload_service import resolve_upload_path
+from query_router import TIER_DEBATE, route_query, router_stats
+from single_flight import SINGLE_FLIGHT_ENABLED, coalescing_key, single_flight
+from llm_scheduler import PRIORITY_HIGH, PRIORITY_LOW, LLMQueueTimeout, estimate_request_tokens, llm_scheduler
+from metrics import LLM_CALL_ERRORS, LLM_CALL_LATENCY, RETRIEVAL_LATENCY, record_usage
 
 # Configure logger
 logger = logging.getLogger(__name__)
 
-client = AsyncOpenAI(
-    api_key=os.getenv("OPENAI_API_KEY", "sk-placeholder"),
-    base_url=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-)
+_client = None
+
+def get_client() -> AsyncOpenAI:
+    """首次调用时才创建共享的 AsyncOpenAI 客户端（含连接池），导入本模块不产生副作用"""
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY", "sk-placeholder"),
+            base_url=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+        )
+    return _client
 
 LAWYER_AGENT_PROMPT = """...（同原代码）..."""
 JUDGE_AGENT_PROMPT = """...（同原代码）..."""
 SYNTHESIS_AGENT_PROMPT = """...（同原代码）..."""
 
-def encode_image_to_base64(image_path: str) -> str:
-    """将本地图片文件转换为 Base64 字符串"""
-    try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    except Exception as e:
-        logger.error(f"读取图片失败: {e}")
-        return None
+SYNTHESIS_FAILED_TEXT = "系统思考超时，请检查服务配置。"
+# 流式输出中途失败时追加在已输出内容之后，落库的消息据此可辨认为不完整的回答
+STREAM_INTERRUPTED_TEXT = "\n\n（回答生成中断，以上内容不完整，请稍后重试。）"
 
-async def agent_inference(prompt: str, context: str, user_query: str) -> str:
+async def chat_completion(priority: int = PRIORITY_HIGH, agent: str = "single", **kwargs):
+    """
+    所有非流式上游调用的统一入口：先经 llm_scheduler 排队获得名额，再按实际 usage 校正令牌桶。
+    agent 为指标标签（single / lawyer / judge / synthesis / vision），耗时与 token 用量按它分别统计。
+    """
+    model = kwargs["model"]
+    async with llm_scheduler.slot(priority, estimate_request_tokens(kwargs["messages"])) as usage:
+        started = time.perf_counter()
+        try:
+            response = await get_client().chat.completions.create(**kwargs)
+        except Exception:
+            LLM_CALL_ERRORS.inc(agent=agent, model=model)
+            raise
+        finally:
+            LLM_CALL_LATENCY.observe(time.perf_counter() - started, agent=agent, model=model)
+        usage.actual_tokens = record_usage(agent, model, getattr(response, "usage", None))
+        return response
+
+async def agent_inference(prompt: str, docs: list, user_query: str, priority: int = PRIORITY_HIGH, agent: str = "single") -> str:
     try:
-        response = await client.chat.completions.create(
+        response = await chat_completion(
+            priority,
+            agent,
             model=os.getenv("LLM_MODEL", "gpt-4o"), 
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": f"【案件背景与法律依据】\n{context}\n\n【用户问题】\n{user_query}"}
-            ],
+            messages=build_agent_messages(prompt, docs, user_query, agent),
             temperature=0.5
         )
         return response.choices[0].message.content
+    except LLMQueueTimeout:
+        raise
     except Exception as e:
         logger.error(f"Agent Error: {e}")
         return ""
 
-async def get_legal_response(history: list, latest_input: dict):
+def _match_rules(latest_input: dict):
+    """=== Level 1: 规则引擎极速拦截 ==="""
     text_content = latest_input.get("content", "")
-    
-    # === Level 1: 规则引擎极速拦截 ===
     if text_content and latest_input.get("type") == "text":
         rule_ans, rule_src = check_rules(text_content)
         if rule_ans:
@@ -54,93 +84,272 @@ async def get_legal_response(history: list, latest_input: dict):
                 "content": rule_ans,
                 "message_type": "text",
                 "media_url": None,
-                "citations": f"【系统速查 - {rule_src}】\n(注：此回复基于专家规则库自动匹配)"
+                "citations": f"【系统速查 - {rule_src}】\n(注：此回复基于专家规则库自动匹配)",
+                "tier": "rule"
             }
+    return None
+
+def _effective_history(history: list, text_content: str) -> list:
+    """本轮之前的历史（不含刚追加的这条用户消息）"""
+    return history[:-1] if history and history[-1].content == text_content else history
+
+async def _lookup_answer_cache(history: list, latest_input: dict):
+    """
+    === Level 1.5: 答案缓存 ===，返回 (缓存结果 | None, probe | None)
+    缓存键只有问题文本，只服务没有前文的提问：辩论合成会带入会话历史，
+    带历史生成的答案可能包含该用户的案情，不能缓存给其它会话，带历史的提问也不读缓存。
+    probe 为 None 时 _store_answer 不写入。
+    """
+    text_content = latest_input.get("content", "")
+    if not ANSWER_CACHE_ENABLED or not text_content or latest_input.get("type") != "text":
+        return None, None
+    if _effective_history(history, text_content):
+        return None, None
+    return await run_in_threadpool(answer_cache.lookup, text_content, embed_query)
+
+def _store_answer(probe, result: dict):
+    # 失败兜底文案不进缓存，避免一次上游故障被反复复用
+    if probe is not None and result["content"] and result["content"] != SYNTHESIS_FAILED_TEXT:
+        answer_cache.store(probe, result)
 
-    # === Level 2: 真·RAG 向量检索 ===
-    citations = []
-    rag_context = ""
+async def _retrieve_context(latest_input: dict):
+    """=== Level 2: 真·RAG 向量检索 ===，返回 (docs, confidence)，docs 按相关度排序，同时作为引用来源"""
+    text_content = latest_input.get("content", "")
+    docs = []
+    confidence = 0.0
     if text_content and latest_input.get("type") == "text":
         try:
-            knowledge_docs = await run_in_threadpool(search_knowledge, text_content)
-            if knowledge_docs:
-                rag_context = "\n".join(knowledge_docs)
-                citations = knowledge_docs
+            with RETRIEVAL_LATENCY.time():
+                knowledge_docs, confidence = await run_in_threadpool(search_knowledge_scored, text_content)
+            docs = knowledge_docs or []
         except Exception as e:
             logger.error(f"RAG Error: {e}")
+    return docs, confidence
 
-    is_complex = len(text_content) > 15 or "起诉" in text_content or "怎么办" in text_content or "合同" in text_content
+def _route(text_content: str, confidence: float) -> str:
+    """=== Level 3 分级 ===：按问题复杂度与检索置信度选择单 Agent 或 Multi-Agent 辩论"""
+    decision = route_query(text_content, confidence)
+    logger.info(f"🧭 路由: {decision.tier} (score={decision.score}, {', '.join(decision.reasons)})")
+    return decision.tier
+
+async def _analyze_image(latest_input: dict) -> str:
+    # 【核心修复】：拦截本地图片路径，转为 Base64，否则 OpenAI 会报下载失败
+    # 预处理（缩放、重新编码）在线程池中完成，并按内容哈希缓存
+    raw_url = latest_input.get("url", "")
+    openai_image_url = raw_url
     
-    if latest_input.get("type") == "image":
-        # 【核心修复】：拦截本地图片路径，转为 Base64，否则 OpenAI 会报下载失败
-        raw_url = latest_input.get("url", "")
-        openai_image_url = raw_url
-        
-        if "/static/uploads/" in raw_url:
-            filename = raw_url.split("/static/uploads/")[-1]
-            local_path = f"static/uploads/{filename}"
-            
-            if os.path.exists(local_path):
-                base64_data = encode_image_to_base64(local_path)
-                if base64_data:
-                    ext = filename.split('.')[-1].lower()
-                    mime_type = f"image/{ext}" if ext != 'jpg' else "image/jpeg"
-                    openai_image_url = f"data:{mime_type};base64,{base64_data}"
-        
-        messages = [{"role": "system", "content": SYNTHESIS_AGENT_PROMPT}]
-        messages.append({
-            "role": "user", 
-            "content": [
-                {"type": "text", "text": "请分析这张图片中的法律风险，并提供防范建议。"},
-                {"type": "image_url", "image_url": {"url": openai_image_url}}
-            ]
-        })
-        try:
-            response = await client.chat.completions.create(
-                model=os.getenv("VISION_MODEL", "gpt-4o"), # 保证使用视觉模型
-                messages=messages,
-                temperature=0.3
-            )
-            ai_text = response.choices[0].message.content
-        except Exception as e:
-            logger.error(f"Vision Agent Error: {e}")
-            ai_text = "图片分析失败，请检查模型配置是否支持视觉处理。"
+    local_path = resolve_upload_path(raw_url)
+    if local_path and os.path.exists(local_path):
+        data_url = await image_data_url(local_path)
+        if data_url:
+            openai_image_url = data_url
     
-    elif is_complex:
-        # === Level 3: Multi-Agent 协作辩论 ===
-        print("⚡ 启动 Multi-Agent 辩论模式")
-        lawyer_reply, judge_reply = await asyncio.gather(
-            agent_inference(LAWYER_AGENT_PROMPT, rag_context, text_content),
-            agent_inference(JUDGE_AGENT_PROMPT, rag_context, text_content)
+    messages = [{"role": "system", "content": SYNTHESIS_AGENT_PROMPT}]
+    messages.append({
+        "role": "user", 
+        "content": [
+            {"type": "text", "text": "请分析这张图片中的法律风险，并提供防范建议。"},
+            {"type": "image_url", "image_url": {"url": openai_image_url}}
+        ]
+    })
+    try:
+        response = await chat_completion(
+            PRIORITY_HIGH,
+            "vision",
+            model=os.getenv("VISION_MODEL", "gpt-4o"), # 保证使用视觉模型
+            messages=messages,
+            temperature=0.3
         )
-        
-        synthesis_context = f"【RAG检索依据】:\n{rag_context}\n\n【激进律师观点】:\n{lawyer_reply}\n\n【保守法官观点】:\n{judge_reply}"
-        
-        messages = [{"role": "system", "content": SYNTHESIS_AGENT_PROMPT}]
-        effective_history = history[:-1] if history and history[-1].content == text_content else history
-        for msg in effective_history[-6:]:
-            messages.append({"role": msg.role, "content": msg.content})
-            
-        messages.append({"role": "user", "content": f"上下文参考：\n{synthesis_context}\n\n当前用户问题：{text_content}"})
-        
-        try:
-            response = await client.chat.completions.create(
-                model=os.getenv("LLM_MODEL", "gpt-4o"),
-                messages=messages,
-                temperature=0.3
-            )
-            ai_text = response.choices[0].message.content
-        except Exception as e:
-            ai_text = "系统思考超时，请检查服务配置。"
-    else:
-        ai_text = await agent_inference(SYNTHESIS_AGENT_PROMPT, rag_context, text_content)
+        return response.choices[0].message.content
+    except LLMQueueTimeout:
+        raise
+    except Exception as e:
+        logger.error(f"Vision Agent Error: {e}")
+        return "图片分析失败，请检查模型配置是否支持视觉处理。"
+
+async def _build_final_request(history: list, text_content: str, docs: list, tier: str):
+    """
+    构造最终回答（合成）调用的 (messages, temperature)。
+    辩论档位先并发跑律师 / 法官两个 Agent，再把观点交给合成 Agent。
+    各分段由 prompt_builder 按 token 预算与优先级裁剪。
+    """
+    if tier != TIER_DEBATE:
+        return build_agent_messages(SYNTHESIS_AGENT_PROMPT, docs, text_content, "single"), 0.5
+
+    # === Level 3: Multi-Agent 协作辩论 ===
+    logger.info("⚡ 启动 Multi-Agent 辩论模式")
+    # 律师 / 法官调用排在单 Agent 请求之后；最终合成调用按高优先级，尽快收尾已投入的辩论
+    lawyer_reply, judge_reply = await asyncio.gather(
+        agent_inference(LAWYER_AGENT_PROMPT, docs, text_content, PRIORITY_LOW, "lawyer"),
+        agent_inference(JUDGE_AGENT_PROMPT, docs, text_content, PRIORITY_LOW, "judge")
+    )
+    
+    effective_history = _effective_history(history, text_content)
+    messages = build_synthesis_messages(
+        SYNTHESIS_AGENT_PROMPT, docs, lawyer_reply, judge_reply,
+        effective_history[-HISTORY_MAX_MESSAGES:], text_content
+    )
+    return messages, 0.3
 
+def _text_result(ai_text: str, citations: list, tier: str) -> dict:
     return {
         "content": ai_text,
         "message_type": "text",
         "media_url": None,
-        "citations": "\n".join(citations) if citations else None
+        "citations": "\n".join(citations) if citations else None,
+        "tier": tier
     }
 
-async def synthesize_dialect_audio(text, voice):
-    return None
\ No newline at end of file
+async def get_legal_response(history: list, latest_input: dict):
+    """
+    非流式回答入口。相同问题（规范化文本 + 输入类型 + 历史指纹）同时在处理中时，
+    合并为一次 RAG + Agent 调用，所有等待者拿到同一结果的副本。
+    """
+    if not SINGLE_FLIGHT_ENABLED:
+        return await _compute_legal_response(history, latest_input)
+    result = await single_flight.do(
+        coalescing_key(history, latest_input),
+        lambda: _compute_legal_response(history, latest_input)
+    )
+    return dict(result)
+
+async def _compute_legal_response(history: list, latest_input: dict):
+    started = time.perf_counter()
+    text_content = latest_input.get("content", "")
+    
+    rule_res = _match_rules(latest_input)
+    if rule_res:
+        router_stats.observe("rule", time.perf_counter() - started)
+        return rule_res
+
+    cached, probe = await _lookup_answer_cache(history, latest_input)
+    if cached:
+        router_stats.observe("cache", time.perf_counter() - started)
+        return {**cached, "tier": "cache"}
+
+    docs, confidence = await _retrieve_context(latest_input)
+
+    if latest_input.get("type") == "image":
+        tier = "vision"
+        ai_text = await _analyze_image(latest_input)
+    else:
+        tier = _route(text_content, confidence)
+        if tier == TIER_DEBATE:
+            messages, temperature = await _build_final_request(history, text_content, docs, tier)
+            try:
+                response = await chat_completion(
+                    PRIORITY_HIGH,
+                    "synthesis",
+                    model=os.getenv("LLM_MODEL", "gpt-4o"),
+                    messages=messages,
+                    temperature=temperature
+                )
+                ai_text = response.choices[0].message.content
+            except LLMQueueTimeout:
+                raise
+            except Exception as e:
+                logger.error(f"Synthesis Agent Error: {e}")
+                ai_text = SYNTHESIS_FAILED_TEXT
+        else:
+            ai_text = await agent_inference(SYNTHESIS_AGENT_PROMPT, docs, text_content)
+
+    result = _text_result(ai_text, docs, tier)
+    _store_answer(probe, result)
+    router_stats.observe(tier, time.perf_counter() - started)
+    return result
+
+async def stream_legal_response(history: list, latest_input: dict):
+    """
+    流式版本的 get_legal_response，逐个产出事件：
+      {"event": "delta", "content": "..."}  合成调用的增量 token
+      {"event": "done", "result": {...}}     与 get_legal_response 返回值相同的完整结果
+    规则命中、答案缓存命中与图片分析没有可流式的合成调用，直接产出 done。
+    相同问题（与 get_legal_response 同一合并键）同时在处理中时，规则、缓存、RAG、路由、
+    律师 / 法官辩论与合成调用都只执行一次，合成的 token 流广播给所有等待的连接。
+    """
+    if SINGLE_FLIGHT_ENABLED:
+        events = single_flight.stream(
+            coalescing_key(history, latest_input),
+            lambda: _compute_stream(history, latest_input)
+        )
+    else:
+        events = _compute_stream(history, latest_input)
+    async with aclosing(events) as events:
+        async for event in events:
+            if event["event"] == "done":
+                # 每个连接拿到结果的副本
+                event = {"event": "done", "result": dict(event["result"])}
+            yield event
+
+async def _compute_stream(history: list, latest_input: dict):
+    started = time.perf_counter()
+    text_content = latest_input.get("content", "")
+
+    rule_res = _match_rules(latest_input)
+    if rule_res:
+        router_stats.observe("rule", time.perf_counter() - started)
+        yield {"event": "done", "result": rule_res}
+        return
+
+    cached, probe = await _lookup_answer_cache(history, latest_input)
+    if cached:
+        router_stats.observe("cache", time.perf_counter() - started)
+        yield {"event": "done", "result": {**cached, "tier": "cache"}}
+        return
+
+    docs, confidence = await _retrieve_context(latest_input)
+
+    if latest_input.get("type") == "image":
+        ai_text = await _analyze_image(latest_input)
+        router_stats.observe("vision", time.perf_counter() - started)
+        yield {"event": "done", "result": _text_result(ai_text, docs, "vision")}
+        return
+
+    tier = _route(text_content, confidence)
+    messages, temperature = await _build_final_request(history, text_content, docs, tier)
+    agent = "synthesis" if tier == TIER_DEBATE else "single"
+    model = os.getenv("LLM_MODEL", "gpt-4o")
+    parts = []
+    failed = False
+    try:
+        # 名额一直占用到流结束
+        async with llm_scheduler.slot(PRIORITY_HIGH, estimate_request_tokens(messages)) as usage:
+            started_call = time.perf_counter()
+            try:
+                stream = await get_client().chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    # 最后一个 chunk 附带 usage，用于 token 计数与令牌桶校正
+                    stream_options={"include_usage": True}
+                )
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        usage.actual_tokens = record_usage(agent, model, chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield {"event": "delta", "content": delta}
+            except Exception:
+                LLM_CALL_ERRORS.inc(agent=agent, model=model)
+                raise
+            finally:
+                LLM_CALL_LATENCY.observe(time.perf_counter() - started_call, agent=agent, model=model)
+    except LLMQueueTimeout:
+        raise
+    except Exception as e:
+        logger.error(f"Stream Error: {e}")
+        failed = True
+        parts.append(STREAM_INTERRUPTED_TEXT if parts else SYNTHESIS_FAILED_TEXT)
+
+    result = _text_result("".join(parts), docs, tier)
+    if failed:
+        # 中途失败的回答不完整，标记后交给调用方落库，不写入答案缓存
+        result["incomplete"] = True
+    else:
+        _store_answer(probe, result)
+    router_stats.observe(tier, time.perf_counter() - started)
+    yield {"event": "done", "result": result}
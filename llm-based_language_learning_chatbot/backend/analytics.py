@@ -0,0 +1,317 @@
+"""
+管理后台统计：每日消息量、各档位响应耗时、按档位与引用来源的评分分布、工单积压。
+原始数据（messages / tickets）由定时任务按 ID 水位线增量汇总进 analytics_* 表，
+统计接口只读汇总表，耗时与汇总行数成正比，与消息总量无关。
+评分会被修改，无法按水位线增量汇总，改为在提交评分时直接增减汇总计数。
+
+手动刷新一次（在 backend 目录下）：
+    python analytics.py
+"""
+import os
+import re
+import json
+import bisect
+import asyncio
+import logging
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy import delete, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import models
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_REFRESH_INTERVAL = float(os.getenv("ANALYTICS_REFRESH_INTERVAL", "300"))
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "5000"))
+# 只汇总创建超过该秒数的行：并发事务拿到的自增 ID 可能乱序提交，留出余量，避免水位线越过尚未提交的行
+ANALYTICS_SETTLE_SECONDS = float(os.getenv("ANALYTICS_SETTLE_SECONDS", "60"))
+
+# 响应耗时分桶上界（毫秒），超出最后一档的计入 OVERFLOW_BUCKET_MS
+LATENCY_BUCKETS_MS = (100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000, 60000, 120000)
+OVERFLOW_BUCKET_MS = 2 ** 31 - 1
+
+NO_SOURCE = "（无引用）"
+_SOURCE_RES = (re.compile(r"【来源：(.+?)】"), re.compile(r"【系统速查 - (.+?)】"))
+
+
+def citation_sources(citations: Optional[str]) -> List[str]:
+    """从回复的 citations 文本中取出引用来源（RAG 文档来源或命中的规则来源），去重保序"""
+    sources = []
+    for regex in _SOURCE_RES:
+        sources.extend(regex.findall(citations or ""))
+    return list(dict.fromkeys(sources)) or [NO_SOURCE]
+
+
+def latency_bucket(latency_ms: int) -> int:
+    index = bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)
+    return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else OVERFLOW_BUCKET_MS
+
+
+def _add(deltas: Dict[tuple, int], key: tuple, amount: int = 1):
+    deltas[key] = deltas.get(key, 0) + amount
+
+
+async def _upsert_counts(db: AsyncSession, model, keys: Sequence[str], deltas: Dict[tuple, int]):
+    """把 {主键元组: 增量} 累加到汇总表（INSERT ... ON CONFLICT DO UPDATE SET count = count + excluded.count）"""
+    if not deltas:
+        return
+    stmt = insert(model).values([{**dict(zip(keys, key)), "count": amount} for key, amount in deltas.items()])
+    await db.execute(stmt.on_conflict_do_update(index_elements=list(keys), set_={"count": model.count + stmt.excluded.count}))
+
+
+async def _lock_state(db: AsyncSession, name: str) -> models.AnalyticsState:
+    """取水位线并加行锁：多个 worker 同时刷新时串行执行，同一批数据不会被重复累加"""
+    await db.execute(insert(models.AnalyticsState).values(name=name, value=0).on_conflict_do_nothing(index_elements=["name"]))
+    result = await db.execute(select(models.AnalyticsState).filter(models.AnalyticsState.name == name).with_for_update())
+    return result.scalars().first()
+
+
+# ==========================================
+# 1. 增量刷新
+# ==========================================
+async def _refresh_messages_batch(db: AsyncSession) -> int:
+    """汇总水位线之后的一批消息，返回本批汇总的行数；每批一个事务，大表首次刷新也可以分批推进、随时中断"""
+    state = await _lock_state(db, "messages")
+    cutoff = models.get_utc_now() - timedelta(seconds=ANALYTICS_SETTLE_SECONDS)
+    m = models.Message
+    result = await db.execute(
+        select(m.id, m.created_at, m.role, m.tier, m.latency_ms, (m.created_at < cutoff).label("settled"))
+        .filter(m.id > state.value)
+        .order_by(m.id)
+        .limit(ANALYTICS_BATCH_SIZE)
+    )
+    daily: Dict[tuple, int] = {}
+    latency: Dict[tuple, int] = {}
+    processed = 0
+    for message_id, created_at, role, tier, latency_ms, settled in result.all():
+        if not settled:
+            break
+        day = created_at.date()
+        _add(daily, (day, role or "", tier or ""))
+        if role == "assistant" and latency_ms is not None:
+            _add(latency, (day, tier or "", latency_bucket(latency_ms)))
+        state.value = message_id
+        processed += 1
+    await _upsert_counts(db, models.AnalyticsDailyMessages, ("day", "role", "tier"), daily)
+    await _upsert_counts(db, models.AnalyticsLatency, ("day", "tier", "bucket_ms"), latency)
+    await db.commit()
+    return processed
+
+
+async def _refresh_tickets(db: AsyncSession) -> int:
+    state = await _lock_state(db, "tickets")
+    cutoff = models.get_utc_now() - timedelta(seconds=ANALYTICS_SETTLE_SECONDS)
+    t = models.Ticket
+    result = await db.execute(
+        select(t.id, t.created_at, (t.created_at < cutoff).label("settled"))
+        .filter(t.id > state.value)
+        .order_by(t.id)
+    )
+    created: Dict[date, int] = {}
+    processed = 0
+    for ticket_id, created_at, settled in result.all():
+        if not settled:
+            break
+        created[created_at.date()] = created.get(created_at.date(), 0) + 1
+        state.value = ticket_id
+        processed += 1
+    if created:
+        stmt = insert(models.AnalyticsTicketDaily).values([{"day": day, "created": n} for day, n in created.items()])
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=["day"], set_={"created": models.AnalyticsTicketDaily.created + stmt.excluded.created}
+        ))
+
+    # 当天的积压快照：待处理工单数（走 tickets(status, created_at, id) 索引）
+    pending = (await db.execute(select(func.count()).select_from(t).filter(t.status == "pending"))).scalar()
+    stmt = insert(models.AnalyticsTicketDaily).values(day=models.get_utc_now().date(), created=0, pending=pending)
+    await db.execute(stmt.on_conflict_do_update(index_elements=["day"], set_={"pending": stmt.excluded.pending}))
+    await db.commit()
+    return processed
+
+
+async def _backfill_feedback(db: AsyncSession) -> bool:
+    """首次运行时按现有评分重建评分汇总；之后评分汇总由 record_feedback 在提交评分时维护"""
+    state = await _lock_state(db, "feedback")
+    if state.value:
+        await db.commit()
+        return False
+    m = models.Message
+    await db.execute(delete(models.AnalyticsFeedback))
+    last_id = 0
+    while True:
+        result = await db.execute(
+            select(m.id, m.created_at, m.tier, m.citations, m.feedback_score)
+            .filter(m.id > last_id, m.role == "assistant", m.feedback_score.isnot(None))
+            .order_by(m.id)
+            .limit(ANALYTICS_BATCH_SIZE)
+        )
+        rows = result.all()
+        deltas: Dict[tuple, int] = {}
+        for message_id, created_at, tier, citations, score in rows:
+            for source in citation_sources(citations):
+                _add(deltas, (created_at.date(), tier or "", source, score))
+            last_id = message_id
+        await _upsert_counts(db, models.AnalyticsFeedback, ("day", "tier", "source", "score"), deltas)
+        if len(rows) < ANALYTICS_BATCH_SIZE:
+            break
+    state.value = 1
+    await db.commit()
+    return True
+
+
+async def refresh(db: AsyncSession) -> dict:
+    messages = 0
+    while True:
+        processed = await _refresh_messages_batch(db)
+        messages += processed
+        if processed < ANALYTICS_BATCH_SIZE:
+            break
+    tickets = await _refresh_tickets(db)
+    backfilled = await _backfill_feedback(db)
+    return {"messages": messages, "tickets": tickets, "feedback_backfilled": backfilled}
+
+
+async def record_feedback(db: AsyncSession, message: models.Message, old_score: Optional[int], new_score: Optional[int]):
+    """提交评分时调用（与评分修改同一事务）：旧评分计数减一、新评分计数加一"""
+    if message.role != "assistant" or old_score == new_score:
+        return
+    day = (message.created_at or models.get_utc_now()).date()
+    deltas: Dict[tuple, int] = {}
+    for source in citation_sources(message.citations):
+        if old_score is not None:
+            _add(deltas, (day, message.tier or "", source, old_score), -1)
+        if new_score is not None:
+            _add(deltas, (day, message.tier or "", source, new_score), 1)
+    await _upsert_counts(db, models.AnalyticsFeedback, ("day", "tier", "source", "score"), deltas)
+
+
+async def run_refresh_loop(session_factory, interval: float = ANALYTICS_REFRESH_INTERVAL):
+    """在 lifespan 中以后台任务启动，周期性增量刷新汇总表"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with session_factory() as db:
+                stats = await refresh(db)
+            if stats["messages"] or stats["tickets"]:
+                logger.info(f"📊 统计汇总已刷新: {stats}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ 统计汇总刷新失败: {e}")
+
+
+# ==========================================
+# 2. 查询（只读汇总表）
+# ==========================================
+def _since(days: int) -> date:
+    return models.get_utc_now().date() - timedelta(days=days - 1)
+
+
+async def feedback_distribution(db: AsyncSession, days: int) -> dict:
+    """评分分布：按档位，以及按引用来源（好评率从低到高排序，低分来源排在最前）"""
+    f = models.AnalyticsFeedback
+    result = await db.execute(
+        select(f.tier, f.source, f.score, func.sum(f.count))
+        .filter(f.day >= _since(days))
+        .group_by(f.tier, f.source, f.score)
+    )
+    by_tier: Dict[str, Dict[str, int]] = {}
+    by_source: Dict[str, Dict[str, int]] = {}
+    for tier, source, score, count in result.all():
+        count = int(count)
+        if not count:
+            continue
+        tier_scores = by_tier.setdefault(tier or "unknown", {})
+        tier_scores[str(score)] = tier_scores.get(str(score), 0) + count
+        totals = by_source.setdefault(source, {"positive": 0, "negative": 0})
+        totals["positive" if score > 0 else "negative"] += count
+    sources = [
+        {"source": source, **totals, "total": totals["positive"] + totals["negative"],
+         "positive_rate": round(totals["positive"] / (totals["positive"] + totals["negative"]), 4)}
+        for source, totals in by_source.items()
+    ]
+    sources.sort(key=lambda s: (s["positive_rate"], -s["total"]))
+    return {"days": days, "by_tier": by_tier, "by_source": sources}
+
+
+async def messages_per_day(db: AsyncSession, days: int) -> dict:
+    d = models.AnalyticsDailyMessages
+    result = await db.execute(select(d.day, d.role, d.tier, d.count).filter(d.day >= _since(days)).order_by(d.day))
+    per_day: Dict[date, dict] = {}
+    for day, role, tier, count in result.all():
+        entry = per_day.setdefault(day, {"day": day.isoformat(), "user": 0, "assistant": 0, "by_tier": {}})
+        entry[role] = entry.get(role, 0) + count
+        if role == "assistant":
+            entry["by_tier"][tier or "unknown"] = entry["by_tier"].get(tier or "unknown", 0) + count
+    return {"days": days, "items": list(per_day.values())}
+
+
+async def ticket_backlog(db: AsyncSession, days: int) -> dict:
+    """每天新建工单数与待处理积压（积压为当天最后一次刷新时的快照，未运行刷新的日期为 null）"""
+    t = models.AnalyticsTicketDaily
+    result = await db.execute(select(t.day, t.created, t.pending).filter(t.day >= _since(days)).order_by(t.day))
+    return {
+        "days": days,
+        "items": [{"day": day.isoformat(), "created": created, "pending": pending} for day, created, pending in result.all()],
+    }
+
+
+def _bucket_percentile(buckets: List[tuple], total: int, q: float) -> int:
+    """由分桶计数估算分位数，返回所在桶的上界（超出最后一档时返回最后一档的上界）"""
+    rank = q * total
+    seen = 0
+    for bound, count in buckets:
+        seen += count
+        if seen >= rank:
+            return min(bound, LATENCY_BUCKETS_MS[-1])
+    return LATENCY_BUCKETS_MS[-1]
+
+
+async def response_times(db: AsyncSession, days: int) -> dict:
+    """各档位与整体的响应耗时中位数 / p95（毫秒，按分桶上界估算）"""
+    a = models.AnalyticsLatency
+    result = await db.execute(
+        select(a.tier, a.bucket_ms, func.sum(a.count))
+        .filter(a.day >= _since(days))
+        .group_by(a.tier, a.bucket_ms)
+        .order_by(a.tier, a.bucket_ms)
+    )
+    per_tier: Dict[str, Dict[int, int]] = {}
+    overall: Dict[int, int] = {}
+    for tier, bound, count in result.all():
+        per_tier.setdefault(tier or "unknown", {})[bound] = int(count)
+        overall[bound] = overall.get(bound, 0) + int(count)
+
+    def summarize(counts: Dict[int, int]) -> dict:
+        buckets = sorted(counts.items())
+        total = sum(counts.values())
+        return {
+            "count": total,
+            "median_ms": _bucket_percentile(buckets, total, 0.5),
+            "p95_ms": _bucket_percentile(buckets, total, 0.95),
+        }
+
+    return {
+        "days": days,
+        "overall": summarize(overall) if overall else None,
+        "by_tier": {tier: summarize(counts) for tier, counts in per_tier.items()},
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    from database import AsyncSessionLocal
+
+    async def run():
+        async with AsyncSessionLocal() as db:
+            return await refresh(db)
+
+    print(json.dumps(asyncio.run(run()), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
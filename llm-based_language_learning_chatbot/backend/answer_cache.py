@@ -0,0 +1,163 @@
+import os
+import re
+import time
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+# 余弦相似度阈值：法律问题一字之差可能答案完全不同，默认取得比较保守
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# 去掉空白和标点，只保留"问的是什么"
+_STRIP_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_query(text: str) -> str:
+    """全半角统一、大小写折叠、去空白标点"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return _STRIP_RE.sub("", text).casefold()
+
+
+class CacheProbe:
+    """一次查找的中间结果，未命中时原样交回 store，避免重复计算向量"""
+    __slots__ = ("key", "embedding", "generation")
+
+    def __init__(self, key: str, embedding: Optional[np.ndarray], generation: int):
+        self.key = key
+        self.embedding = embedding
+        self.generation = generation
+
+
+class SemanticAnswerCache:
+    """
+    位于 Level 1 规则与 Level 2 RAG 之间的答案缓存：
+      1. 先按规范化后的问题文本精确匹配；
+      2. 再按问题向量的余弦相似度匹配（需要可用的向量函数）。
+    LRU + TTL 淘汰，容量有上限；知识库或规则变化时整体失效。
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 threshold: float = ANSWER_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        # key -> (result, unit embedding | None, expires_at)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        # 相似度检索用的矩阵，条目变化后惰性重建
+        self._matrix = None
+        self._matrix_keys: list = []
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    # --- 查询 ---
+    def lookup(self, query: str, embed: Optional[Callable[[str], Optional[Sequence[float]]]] = None):
+        """
+        返回 (result | None, probe)。embed 为同步向量函数，失败时返回 None 即退化为精确匹配。
+        注意 embed 可能发起网络请求，调用方应放到线程池执行。
+        """
+        key = normalize_query(query)
+        now = time.monotonic()
+        with self._lock:
+            generation = self._generation
+            hit = self._get_live(key, now)
+            if hit is not None:
+                self.stats["exact_hits"] += 1
+                return hit, CacheProbe(key, None, generation)
+            has_vectors = any(e[1] is not None for e in self._entries.values())
+
+        embedding = None
+        if embed is not None:
+            try:
+                vec = embed(query)
+                if vec is not None:
+                    embedding = _unit(vec)
+            except Exception as e:
+                logger.warning(f"答案缓存向量化失败: {e}")
+
+        with self._lock:
+            if embedding is not None and has_vectors and generation == self._generation:
+                matched = self._nearest(embedding, now)
+                if matched is not None:
+                    self.stats["semantic_hits"] += 1
+                    return matched, CacheProbe(key, embedding, generation)
+            self.stats["misses"] += 1
+        return None, CacheProbe(key, embedding, generation)
+
+    def store(self, probe: CacheProbe, result: dict):
+        with self._lock:
+            # 计算期间发生过失效，结果可能基于旧知识，不写入
+            if probe.generation != self._generation or not probe.key:
+                return
+            self._entries[probe.key] = (result, probe.embedding, time.monotonic() + self.ttl)
+            self._entries.move_to_end(probe.key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            self._matrix = None
+
+    def invalidate(self, reason: str = ""):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self._generation += 1
+            self.stats["invalidations"] += 1
+        logger.info(f"🧹 答案缓存已清空 {reason}".rstrip())
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.stats["exact_hits"] + self.stats["semantic_hits"] + self.stats["misses"]
+            hits = lookups - self.stats["misses"]
+            return {
+                **self.stats,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+    # --- 内部工具（调用方持有锁） ---
+    def _get_live(self, key: str, now: float) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < now:
+            del self._entries[key]
+            self._matrix = None
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _nearest(self, embedding: np.ndarray, now: float) -> Optional[dict]:
+        if self._matrix is None:
+            keys = [k for k, e in self._entries.items() if e[1] is not None]
+            if not keys:
+                return None
+            self._matrix = np.vstack([self._entries[k][1] for k in keys])
+            self._matrix_keys = keys
+        if self._matrix.shape[1] != embedding.shape[0]:
+            return None
+        scores = self._matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        return self._get_live(self._matrix_keys[best], now)
+
+
+def _unit(vec) -> Optional[np.ndarray]:
+    arr = np.asarray(vec, dtype=np.float32)
+    norm = float(np.linalg.norm(arr))
+    if norm == 0.0:
+        return None
+    return arr / norm
+
+
+answer_cache = SemanticAnswerCache()
@@ -1,4 +1,7 @@
 import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 from jose import JWTError, jwt
@@ -13,16 +16,53 @@ if not SECRET_KEY:
     SECRET_KEY = "your-super-secret-key-change-it"
 
 ALGORITHM = "HS256"
+# 开启后 token 额外携带 uid 与 role，鉴权时无需查库（角色变更需等旧 token 过期或在本进程内失效）
+TOKEN_EMBED_USER_CLAIMS = os.getenv("TOKEN_EMBED_USER_CLAIMS", "false").lower() == "true"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30  # Reduced from 300 (5 hours) to 30 minutes for better security
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt 单次几十毫秒且会释放 GIL，放到独立的有界线程池里执行，避免阻塞事件循环
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 排队 + 执行中的密码运算上限，超出即拒绝（登录风暴只影响登录本身）
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="pwd-hash")
+_hash_pending = 0
+_hash_pending_lock = threading.Lock()
+
+
+class PasswordHasherBusy(Exception):
+    """密码运算队列已满"""
+
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def _run_hash_job(func, *args):
+    global _hash_pending
+    with _hash_pending_lock:
+        if _hash_pending >= PASSWORD_HASH_MAX_PENDING:
+            raise PasswordHasherBusy()
+        _hash_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, func, *args)
+    finally:
+        with _hash_pending_lock:
+            _hash_pending -= 1
+
+async def verify_password_async(plain_password, hashed_password):
+    return await _run_hash_job(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await _run_hash_job(get_password_hash, password)
+
+def password_hash_queue_depth() -> int:
+    return _hash_pending
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     # 【修复重点】：采用携带时区信息的 UTC 时间
@@ -31,10 +71,20 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = now + expires_delta
     else:
         expire = now + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": now})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def user_token_claims(user) -> dict:
+    """
+    签发 token 的声明：始终包含 sub，开启 TOKEN_EMBED_USER_CLAIMS 时附带 uid 与 role。
+    role 可变，只用于普通用户免查库；管理员权限始终回库（或用户缓存）校验。
+    """
+    claims = {"sub": user.username}
+    if TOKEN_EMBED_USER_CLAIMS:
+        claims.update({"uid": user.id, "role": user.role})
+    return claims
+
 def decode_access_token(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
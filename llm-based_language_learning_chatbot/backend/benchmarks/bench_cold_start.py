@@ -0,0 +1,70 @@
+"""
+冷启动基准：启动 uvicorn 子进程，测量"进程启动 -> /health 首次 200"与"-> /ready 200"的耗时。
+需要可用的 DATABASE_URL；在不同版本上分别运行即可对比滚动发布时的不可用窗口。
+
+用法（在 backend 目录下）：
+    python benchmarks/bench_cold_start.py [--runs 3] [--port 8765] [--timeout 600]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _status(url: str) -> int:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return 0
+
+
+def measure_once(port: int, timeout: float) -> dict:
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+    )
+    result = {"health_ms": None, "ready_ms": None}
+    try:
+        base = f"http://127.0.0.1:{port}"
+        while time.perf_counter() - started < timeout:
+            if proc.poll() is not None:
+                raise SystemExit(f"服务进程提前退出，返回码 {proc.returncode}")
+            elapsed = round((time.perf_counter() - started) * 1000)
+            # /health 不存在的旧版本以 /docs 作为"开始接受请求"的信号
+            if result["health_ms"] is None and (_status(f"{base}/health") == 200 or _status(f"{base}/docs") == 200):
+                result["health_ms"] = elapsed
+            if result["health_ms"] is not None:
+                ready = _status(f"{base}/ready")
+                if ready in (200, 404):
+                    result["ready_ms"] = elapsed if ready == 200 else result["health_ms"]
+                    break
+            time.sleep(0.05)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    runs = [measure_once(args.port, args.timeout) for _ in range(args.runs)]
+    print(json.dumps({"runs": runs}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+登录风暴基准：并发登录（bcrypt）期间，其它 WebSocket 连接的响应延迟 p50/p95/p99。
+
+两种模式（在 backend 目录下）：
+  1. 进程内（默认，不需要数据库）：用事件循环延迟模拟 WebSocket 帧的排队时间，
+     对比 bcrypt 直接在事件循环上执行 与 放入有界线程池执行 两种方式。
+        python benchmarks/bench_login_storm.py [--logins 200] [--concurrency 50]
+  2. 真实服务：对已启动的服务发起 /token 登录风暴，同时用若干 WebSocket 连接发送
+     非 JSON 的探测帧（服务端不查库、不调模型，立即回错误帧）测量往返延迟。
+        python benchmarks/bench_login_storm.py --url http://127.0.0.1:8000 [--ws-clients 20]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+BENCH_USER = "bench_login_user"
+BENCH_PASSWORD = "BenchPassw0rd"
+
+
+def percentiles(samples_ms: list) -> dict:
+    if not samples_ms:
+        return {"count": 0}
+    data = sorted(samples_ms)
+
+    def pick(p):
+        return round(data[min(len(data) - 1, int(len(data) * p))], 2)
+
+    return {"count": len(data), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(data[-1], 2)}
+
+
+# ==========================================
+# 1. 进程内：事件循环延迟
+# ==========================================
+async def _loop_lag_probe(stop: asyncio.Event, interval: float, samples: list):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, (loop.time() - expected) * 1000))
+
+
+async def run_in_process(mode: str, logins: int, concurrency: int) -> dict:
+    import auth_utils
+
+    hashed = auth_utils.get_password_hash(BENCH_PASSWORD)
+    semaphore = asyncio.Semaphore(concurrency)
+    login_ms, rejected = [], 0
+
+    async def login():
+        nonlocal rejected
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if mode == "inline":
+                    auth_utils.verify_password(BENCH_PASSWORD, hashed)
+                else:
+                    await auth_utils.verify_password_async(BENCH_PASSWORD, hashed)
+            except auth_utils.PasswordHasherBusy:
+                rejected += 1
+                return
+            login_ms.append((time.perf_counter() - started) * 1000)
+
+    stop, lag = asyncio.Event(), []
+    probe = asyncio.create_task(_loop_lag_probe(stop, 0.005, lag))
+    started = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    return {
+        "mode": mode,
+        "logins_per_sec": round(logins / elapsed, 1),
+        "rejected": rejected,
+        "login_ms": percentiles(login_ms),
+        "ws_delay_ms": percentiles(lag),
+    }
+
+
+# ==========================================
+# 2. 真实服务：WebSocket 往返延迟
+# ==========================================
+async def _ws_probe(url: str, stop: asyncio.Event, samples: list):
+    import websockets
+
+    async with websockets.connect(url) as ws:
+        while not stop.is_set():
+            started = time.perf_counter()
+            await ws.send("ping")
+            await ws.recv()
+            samples.append((time.perf_counter() - started) * 1000)
+            await asyncio.sleep(0.02)
+
+
+async def run_against_server(base_url: str, logins: int, concurrency: int, ws_clients: int, duration: float) -> dict:
+    import httpx
+
+    ws_base = base_url.replace("http", "ws", 1)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        await client.post("/register", json={"username": BENCH_USER, "password": BENCH_PASSWORD})
+        results = {}
+        for phase, n_logins in (("baseline", 0), ("login_storm", logins)):
+            stop, rtt = asyncio.Event(), []
+            probes = [
+                asyncio.create_task(_ws_probe(f"{ws_base}/ws/bench-{phase}-{i}", stop, rtt))
+                for i in range(ws_clients)
+            ]
+            semaphore = asyncio.Semaphore(concurrency)
+            login_ms, statuses = [], {}
+
+            async def login():
+                async with semaphore:
+                    started = time.perf_counter()
+                    resp = await client.post("/token", data={"username": BENCH_USER, "password": BENCH_PASSWORD})
+                    statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+                    login_ms.append((time.perf_counter() - started) * 1000)
+
+            if n_logins:
+                await asyncio.gather(*(login() for _ in range(n_logins)))
+            else:
+                await asyncio.sleep(duration)
+            stop.set()
+            await asyncio.gather(*probes, return_exceptions=True)
+            results[phase] = {"statuses": statuses, "login_ms": percentiles(login_ms), "ws_rtt_ms": percentiles(rtt)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--url", help="已启动服务的地址；不传则运行进程内模式")
+    parser.add_argument("--ws-clients", type=int, default=20)
+    parser.add_argument("--baseline-seconds", type=float, default=3)
+    args = parser.parse_args()
+
+    if args.url:
+        report = asyncio.run(run_against_server(args.url, args.logins, args.concurrency, args.ws_clients, args.baseline_seconds))
+    else:
+        report = [asyncio.run(run_in_process(mode, args.logins, args.concurrency)) for mode in ("inline", "executor")]
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+规则匹配微基准：对比旧的逐条正则线性扫描与 RuleMatcher（AC 预过滤 + 合并正则兜底）。
+
+用法（在 backend 目录下）：
+    python benchmarks/bench_rule_matcher.py [--queries 2000] [--sizes 10,1000,10000]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rule_matcher import RuleMatcher  # noqa: E402
+
+# 常用汉字区间，用于随机生成关键词
+_CJK_START, _CJK_END = 0x4E00, 0x6FFF
+
+
+def _word(rng: random.Random, length: int) -> str:
+    return "".join(chr(rng.randint(_CJK_START, _CJK_END)) for _ in range(length))
+
+
+def build_rules(n: int, rng: random.Random):
+    """生成与种子规则形态一致的规则：多数为 "词A.*词B"，少量为分支结构（走兜底通道）"""
+    rules = []
+    for i in range(n):
+        patterns = []
+        for _ in range(rng.randint(1, 3)):
+            if rng.random() < 0.05:
+                patterns.append(f"({_word(rng, 2)}|{_word(rng, 2)}).*{_word(rng, 1)}")
+            else:
+                patterns.append(f"{_word(rng, rng.randint(2, 4))}.*{_word(rng, rng.randint(2, 4))}")
+        rules.append({
+            "patterns": [re.compile(p, re.IGNORECASE) for p in patterns],
+            "answer": f"answer-{i}",
+            "source": f"source-{i}",
+        })
+    return rules
+
+
+def build_queries(rules, count: int, rng: random.Random):
+    """约 20% 的查询命中某条规则，其余为随机文本（线性扫描的最坏情况）"""
+    queries = []
+    for _ in range(count):
+        if rules and rng.random() < 0.2:
+            rule = rng.choice(rules)
+            pattern = rng.choice(rule["patterns"]).pattern
+            parts = re.sub(r"\(([^|)]*)\|[^)]*\)", r"\1", pattern).split(".*")
+            queries.append(_word(rng, 5).join(parts) + "怎么办？")
+        else:
+            queries.append(_word(rng, rng.randint(15, 60)))
+    return queries
+
+
+def linear_check(rules, query: str):
+    for rule in rules:
+        for pattern in rule["patterns"]:
+            if pattern.search(query):
+                return rule
+    return None
+
+
+def _bench(fn, queries):
+    start = time.perf_counter()
+    results = [fn(q) for q in queries]
+    return (time.perf_counter() - start) / len(queries), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--sizes", default="10,1000,10000")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{'rules':>8} {'build(ms)':>10} {'linear(us/q)':>13} {'matcher(us/q)':>14} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        rng = random.Random(args.seed)
+        rules = build_rules(size, rng)
+        queries = build_queries(rules, args.queries, rng)
+
+        start = time.perf_counter()
+        matcher = RuleMatcher(rules)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        linear_t, linear_res = _bench(lambda q: linear_check(rules, q), queries)
+        matcher_t, matcher_res = _bench(matcher.match, queries)
+        if linear_res != matcher_res:
+            raise SystemExit(f"结果不一致：rules={size}")
+
+        print(f"{size:>8} {build_ms:>10.1f} {linear_t * 1e6:>13.1f} {matcher_t * 1e6:>14.1f} {linear_t / matcher_t:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+本地 OpenAI 兼容替身：/v1/chat/completions（含 stream）与 /v1/embeddings。
+延迟与 token 产出速率可配置，返回 usage 字段，供负载测试在没有真实上游的情况下跑通全部链路。
+
+用法（在 backend 目录下）：
+    python benchmarks/fake_openai.py [--port 9100] [--latency-ms 300] [--tokens-per-sec 50] [--reply-tokens 120]
+    # 后端指向替身：OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=sk-bench
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+EMBEDDING_DIM = 1536
+SETTINGS = {"latency_ms": 300.0, "tokens_per_sec": 50.0, "reply_tokens": 120, "embedding_latency_ms": 30.0}
+STATS = {"chat": 0, "chat_stream": 0, "embeddings": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+app = FastAPI(title="Fake OpenAI")
+
+
+def _prompt_tokens(messages: list) -> int:
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            total += sum(len(p.get("text", "")) if p.get("type") == "text" else 765 for p in content)
+        else:
+            total += len(content or "")
+    return total
+
+
+def _reply_tokens() -> list:
+    return [f"第{i}段" for i in range(SETTINGS["reply_tokens"])]
+
+
+def _usage(prompt: int, completion: int) -> dict:
+    STATS["prompt_tokens"] += prompt
+    STATS["completion_tokens"] += completion
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake")
+    prompt = _prompt_tokens(body.get("messages", []))
+    tokens = _reply_tokens()
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+    await asyncio.sleep(SETTINGS["latency_ms"] / 1000)
+
+    if not body.get("stream"):
+        STATS["chat"] += 1
+        await asyncio.sleep(len(tokens) / SETTINGS["tokens_per_sec"])
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": _usage(prompt, len(tokens)),
+        }
+
+    STATS["chat_stream"] += 1
+
+    async def events():
+        for token in tokens:
+            await asyncio.sleep(1 / SETTINGS["tokens_per_sec"])
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        usage = _usage(prompt, len(tokens))
+        done = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        yield f"data: {json.dumps(done)}\n\n"
+        if (body.get("stream_options") or {}).get("include_usage"):
+            # 与 OpenAI 一致：usage 放在 choices 为空的最后一个 chunk 里
+            final = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [], "usage": usage}
+            yield f"data: {json.dumps(final)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def _embed(text: str) -> list:
+    """由文本哈希确定的单位向量：相同文本向量相同，便于缓存命中测试"""
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    values = [((seed[i % len(seed)] ^ (i * 131 & 0xFF)) - 127.5) for i in range(EMBEDDING_DIM)]
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    STATS["embeddings"] += 1
+    await asyncio.sleep(SETTINGS["embedding_latency_ms"] / 1000)
+    prompt = sum(len(str(text)) for text in inputs)
+    return {
+        "object": "list",
+        "model": body.get("model", "fake-embedding"),
+        "data": [{"object": "embedding", "index": i, "embedding": _embed(str(text))} for i, text in enumerate(inputs)],
+        "usage": {"prompt_tokens": prompt, "total_tokens": prompt},
+    }
+
+
+@app.get("/stats")
+async def stats():
+    return STATS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=SETTINGS["latency_ms"])
+    parser.add_argument("--tokens-per-sec", type=float, default=SETTINGS["tokens_per_sec"])
+    parser.add_argument("--reply-tokens", type=int, default=SETTINGS["reply_tokens"])
+    parser.add_argument("--embedding-latency-ms", type=float, default=SETTINGS["embedding_latency_ms"])
+    args = parser.parse_args()
+    SETTINGS.update(latency_ms=args.latency_ms, tokens_per_sec=args.tokens_per_sec,
+                    reply_tokens=args.reply_tokens, embedding_latency_ms=args.embedding_latency_ms)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
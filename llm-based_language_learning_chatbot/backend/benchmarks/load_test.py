@@ -0,0 +1,291 @@
+"""
+端到端负载测试：大量并发 /ws/{session_id} 连接 + REST 流量（登录、上传、会话），
+问题混合覆盖 get_legal_response 的各个档位（规则 / 单 Agent / Multi-Agent / 图片），
+输出各档位 p50/p95/p99 延迟、吞吐、数据库语句数与上游调用量（JSON，便于多次运行对比）。
+
+用法（在 backend 目录下，先安装依赖：pip install -r benchmarks/requirements.txt）：
+  1. 自动启动本地 OpenAI 替身与后端（需要可用的 DATABASE_URL）：
+        python benchmarks/load_test.py --spawn [--ws-clients 50] [--messages 10] [--out report.json]
+  2. 对已启动的服务压测（后端应已指向 fake_openai.py）：
+        python benchmarks/load_test.py --url http://127.0.0.1:8000 [--fake-openai http://127.0.0.1:9100]
+管理员统计接口使用 admin 账户（密码取 ADMIN_DEFAULT_PASSWORD，默认 admin123）。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import httpx
+import websockets
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_USER = "bench_load_user"
+BENCH_PASSWORD = "BenchPassw0rd"
+
+# 各档位的问题样本与默认权重
+QUERY_MIX = {
+    # 命中种子规则（Level 1）
+    "rule": ["借款的诉讼时效是多久", "欠钱多久不还可以起诉", "民间借贷利息上限是多少", "高利贷的认定标准"],
+    # 简短、单一的问题（单 Agent）
+    "single": ["醉驾怎么处罚", "试用期最长多久", "产假有多少天", "什么是不可抗力"],
+    # 案情复杂、多问的问题（Multi-Agent 辩论）
+    "debate": [
+        "我在公司干了3年，老板拖欠工资5万元，签了劳动合同但是没交社保，应该先仲裁还是直接起诉？需要准备哪些证据？",
+        "房东提前两个月要求解除租赁合同并拒绝退还押金8000元，合同里没有约定违约金，我可以索赔吗？如果对方不同意怎么办？",
+        "朋友借我10万元写了借条但没约定还款日期，已经过去4年，现在起诉还来得及吗？另外利息怎么计算？",
+    ],
+    "vision": ["请分析这张图片"],
+}
+FALLBACK_REPLY = "系统繁忙，请稍后再试。"
+DEFAULT_WEIGHTS = {"rule": 0.3, "single": 0.35, "debate": 0.25, "vision": 0.1}
+
+# 1x1 像素 PNG，用于上传与图片档位
+PNG_BYTES = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+def percentiles(samples_ms: List[float]) -> dict:
+    if not samples_ms:
+        return {"count": 0}
+    data = sorted(samples_ms)
+
+    def pick(p):
+        return round(data[min(len(data) - 1, int(len(data) * p))], 1)
+
+    return {"count": len(data), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(data[-1], 1)}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def ok(self, name: str, started: float):
+        self.latencies.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+
+    def fail(self, name: str):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self) -> dict:
+        names = sorted(set(self.latencies) | set(self.errors))
+        return {name: {**percentiles(self.latencies.get(name, [])), "errors": self.errors.get(name, 0)} for name in names}
+
+
+# ==========================================
+# 1. 准备与统计
+# ==========================================
+async def login(client: httpx.AsyncClient, username: str, password: str) -> Optional[str]:
+    resp = await client.post("/token", data={"username": username, "password": password})
+    return resp.json()["access_token"] if resp.status_code == 200 else None
+
+
+async def admin_stats(client: httpx.AsyncClient, token: Optional[str]) -> dict:
+    if not token:
+        return {}
+    headers = {"Authorization": f"Bearer {token}"}
+    stats = {}
+    for name, path in (("db", "/admin/db/stats"), ("router", "/admin/router/stats"), ("llm", "/admin/llm/stats")):
+        resp = await client.get(path, headers=headers)
+        if resp.status_code == 200:
+            stats[name] = resp.json()
+    return stats
+
+
+async def fake_openai_stats(url: Optional[str]) -> dict:
+    if not url:
+        return {}
+    try:
+        async with httpx.AsyncClient(base_url=url, timeout=5) as client:
+            return (await client.get("/stats")).json()
+    except httpx.HTTPError:
+        return {}
+
+
+def _diff(after: dict, before: dict) -> dict:
+    return {k: v - before.get(k, 0) for k, v in after.items() if isinstance(v, (int, float))}
+
+
+# ==========================================
+# 2. 负载
+# ==========================================
+async def ws_client(base_url: str, client: httpx.AsyncClient, messages: int, weights: dict, image_url: str,
+                    stream: bool, unique: bool, recorder: Recorder):
+    resp = await client.post("/sessions/")
+    if resp.status_code != 200:
+        recorder.fail("ws_session")
+        return
+    session_id = resp.json()["id"]
+    ws_url = f"{base_url.replace('http', 'ws', 1)}/ws/{session_id}"
+    categories, category_weights = zip(*weights.items())
+    try:
+        async with websockets.connect(ws_url, max_size=None) as ws:
+            for _ in range(messages):
+                category = random.choices(categories, category_weights)[0]
+                text = random.choice(QUERY_MIX[category])
+                # 追加随机编号绕过答案缓存，测量真实档位耗时
+                if unique and category in ("single", "debate"):
+                    text = f"{text}（编号{random.randint(0, 10 ** 9)}）"
+                payload = {"type": "image", "url": image_url, "content": text} if category == "vision" else {"type": "text", "content": text}
+                payload["stream"] = stream
+                started = time.perf_counter()
+                first_frame = None
+                await ws.send(json.dumps(payload, ensure_ascii=False))
+                while True:
+                    frame = json.loads(await ws.recv())
+                    if first_frame is None:
+                        first_frame = time.perf_counter()
+                        recorder.latencies.setdefault(f"ttfb_{category}", []).append((first_frame - started) * 1000)
+                    if frame.get("type") == "delta":
+                        continue
+                    break
+                # 上游异常时服务端回退为固定文案，同样计为失败
+                if frame.get("type") == "error" or frame.get("content") == FALLBACK_REPLY:
+                    recorder.fail(category)
+                else:
+                    recorder.ok(category, started)
+    except (OSError, websockets.WebSocketException):
+        recorder.fail("ws_connection")
+
+
+async def rest_worker(client: httpx.AsyncClient, stop: asyncio.Event, recorder: Recorder):
+    while not stop.is_set():
+        op = random.choice(("login", "upload", "session"))
+        started = time.perf_counter()
+        try:
+            if op == "login":
+                ok = await login(client, BENCH_USER, BENCH_PASSWORD) is not None
+            elif op == "upload":
+                files = {"file": (f"{uuid.uuid4().hex}.png", PNG_BYTES, "image/png")}
+                ok = (await client.post("/upload/", files=files)).status_code == 200
+            else:
+                resp = await client.post("/sessions/")
+                ok = resp.status_code == 200 and (await client.get(f"/sessions/{resp.json()['id']}/messages")).status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        recorder.ok(f"rest_{op}", started) if ok else recorder.fail(f"rest_{op}")
+        await asyncio.sleep(0.05)
+
+
+async def run_load(args) -> dict:
+    weights = dict(DEFAULT_WEIGHTS)
+    if args.mix:
+        weights = {k: float(v) for k, v in (item.split("=") for item in args.mix.split(","))}
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.ws_clients + args.rest_workers + 10)
+    async with httpx.AsyncClient(base_url=args.url, timeout=120, limits=limits) as client:
+        await client.post("/register", json={"username": BENCH_USER, "password": BENCH_PASSWORD})
+        admin_token = await login(client, "admin", os.getenv("ADMIN_DEFAULT_PASSWORD", "admin123"))
+        upload = await client.post("/upload/", files={"file": ("bench.png", PNG_BYTES, "image/png")})
+        image_url = upload.json()["url"] if upload.status_code == 200 else ""
+
+        before, fake_before = await admin_stats(client, admin_token), await fake_openai_stats(args.fake_openai)
+        stop = asyncio.Event()
+        rest = [asyncio.create_task(rest_worker(client, stop, recorder)) for _ in range(args.rest_workers)]
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            ws_client(args.url, client, args.messages, weights, image_url, args.stream, not args.allow_cache_hits, recorder)
+            for _ in range(args.ws_clients)
+        ))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*rest)
+        after, fake_after = await admin_stats(client, admin_token), await fake_openai_stats(args.fake_openai)
+
+    turns = sum(len(recorder.latencies.get(c, [])) + recorder.errors.get(c, 0) for c in QUERY_MIX)
+    db_before = before.get("db", {}).get("statements", {})
+    db_after = after.get("db", {}).get("statements", {})
+    db_diff = _diff(db_after, db_before)
+    return {
+        "config": {
+            "ws_clients": args.ws_clients, "messages_per_client": args.messages, "rest_workers": args.rest_workers,
+            "stream": args.stream, "mix": weights,
+        },
+        "duration_s": round(elapsed, 2),
+        "chat_turns": turns,
+        "throughput_turns_per_s": round(turns / elapsed, 2) if elapsed else 0,
+        "latency_ms": recorder.report(),
+        "db_statements": {"by_type": db_diff, "total": sum(db_diff.values()), "per_turn": round(sum(db_diff.values()) / turns, 2) if turns else None},
+        "router": after.get("router"),
+        "llm_scheduler": after.get("llm"),
+        "upstream": _diff(fake_after, fake_before),
+    }
+
+
+# ==========================================
+# 3. 自动启动替身与后端
+# ==========================================
+def _wait_http(url: str, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"等待 {url} 超时")
+
+
+def spawn(args) -> list:
+    fake_port, app_port = args.fake_port, args.port
+    fake = subprocess.Popen(
+        [sys.executable, "benchmarks/fake_openai.py", "--port", str(fake_port),
+         "--latency-ms", str(args.llm_latency_ms), "--tokens-per-sec", str(args.llm_tokens_per_sec)],
+        cwd=BACKEND_DIR,
+    )
+    env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{fake_port}/v1", OPENAI_API_KEY="sk-bench",
+               EMBEDDING_BACKEND="openai")
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(app_port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+    _wait_http(f"http://127.0.0.1:{fake_port}/stats", 30)
+    _wait_http(f"http://127.0.0.1:{app_port}/ready", args.startup_timeout)
+    args.url = f"http://127.0.0.1:{app_port}"
+    args.fake_openai = f"http://127.0.0.1:{fake_port}"
+    return [app, fake]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--fake-openai", help="fake_openai.py 的地址，用于统计上游调用量")
+    parser.add_argument("--spawn", action="store_true", help="自动启动 fake_openai.py 与 uvicorn")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-tokens-per-sec", type=float, default=50)
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--ws-clients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=10, help="每个 WebSocket 连接发送的消息数")
+    parser.add_argument("--rest-workers", type=int, default=5)
+    parser.add_argument("--mix", help="档位权重，如 rule=0.3,single=0.4,debate=0.2,vision=0.1")
+    parser.add_argument("--stream", action="store_true", help="使用流式回复（额外统计首帧延迟）")
+    parser.add_argument("--allow-cache-hits", action="store_true", help="不加随机编号，允许答案缓存命中")
+    parser.add_argument("--out", help="把报告写入该文件（同时打印到标准输出）")
+    args = parser.parse_args()
+
+    procs = spawn(args) if args.spawn else []
+    try:
+        report = asyncio.run(run_load(args))
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait(timeout=30)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# 后端模块以顶层模块互相 import（与 uvicorn main:app 的运行方式一致）
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# benchmarks/load_test.py 是负载测试脚本（依赖 httpx 等），不是 pytest 用例
+collect_ignore = ["benchmarks"]
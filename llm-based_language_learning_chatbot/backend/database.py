@@ -1,7 +1,10 @@
+import time
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
 from dotenv import load_dotenv
+from metrics import DB_COMMIT_LATENCY
 
 load_dotenv()
 
@@ -14,10 +17,28 @@ SQLALCHEMY_DATABASE_URL = os.getenv(
 # 使用 create_async_engine
 engine = create_async_engine(SQLALCHEMY_DATABASE_URL, echo=True)
 
+# 按语句类型统计发往数据库的 SQL 条数（基准测试对比每轮对话的查询次数）
+STATEMENT_COUNTS = {}
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    STATEMENT_COUNTS[verb] = STATEMENT_COUNTS.get(verb, 0) + 1
+
+class TimedAsyncSession(AsyncSession):
+    """记录每次事务提交耗时的 AsyncSession（/metrics 中的 legal_db_commit_seconds）"""
+
+    async def commit(self):
+        started = time.perf_counter()
+        try:
+            await super().commit()
+        finally:
+            DB_COMMIT_LATENCY.observe(time.perf_counter() - started)
+
 # 使用 AsyncSession
 AsyncSessionLocal = sessionmaker(
     bind=engine,
-    class_=AsyncSession,
+    class_=TimedAsyncSession,
     expire_on_commit=False,
     autoflush=False
 )
@@ -0,0 +1,104 @@
+import os
+import re
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Callable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite3")
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "5000"))
+
+_WS_RE = re.compile(r"\s+")
+
+
+def text_key(text: str) -> str:
+    """规范化后取 SHA-256：全半角统一、合并空白（标点会影响向量，保留）"""
+    normalized = _WS_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    两级查询向量缓存，键为 (模型名, 规范化文本哈希)：
+      - 内存 LRU：进程内命中，零拷贝返回；
+      - SQLite：跨重启持久化，向量以 float32 字节存储。
+    磁盘层不可用（只读卷等）时自动退化为纯内存缓存。
+    """
+
+    def __init__(self, path: Optional[str] = EMBEDDING_CACHE_PATH, memory_size: int = EMBEDDING_CACHE_MEMORY_SIZE):
+        self.memory_size = memory_size
+        self._memory: "OrderedDict[tuple, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if path:
+            try:
+                self._conn = sqlite3.connect(path, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                    " model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL,"
+                    " PRIMARY KEY (model, text_hash))"
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"向量缓存磁盘层不可用，仅使用内存缓存: {e}")
+                self._conn = None
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = (model, text_key(text))
+        with self._lock:
+            vec = self._memory.get(key)
+            if vec is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return vec
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT vector FROM query_embeddings WHERE model = ? AND text_hash = ?", key
+                ).fetchone()
+                if row is not None:
+                    vec = array("f", row[0]).tolist()
+                    self._remember(key, vec)
+                    self.stats["disk_hits"] += 1
+                    return vec
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, model: str, text: str, vector: Sequence[float]):
+        key = (model, text_key(text))
+        vec = [float(x) for x in vector]
+        with self._lock:
+            self._remember(key, vec)
+            if self._conn is not None:
+                try:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO query_embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                        (*key, array("f", vec).tobytes())
+                    )
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"向量缓存写盘失败: {e}")
+
+    def get_or_compute(self, model: str, text: str, compute: Callable[[str], Sequence[float]]) -> List[float]:
+        vec = self.get(model, text)
+        if vec is None:
+            vec = list(compute(text))
+            self.put(model, text, vec)
+        return vec
+
+    def _remember(self, key: tuple, vec: List[float]):
+        self._memory[key] = vec
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+
+embedding_cache = EmbeddingCache()
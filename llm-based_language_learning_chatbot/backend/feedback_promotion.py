@@ -0,0 +1,313 @@
+"""
+好评答案晋升：把用户好评、管理员纠正过的回答按规范化后的问题归并为候选规则（rule_candidates），
+管理员审核通过（或开启自动通过）后写入 Level 1 规则表，常见且已验证的问题直接由规则引擎回答，不再调用 LLM。
+每次运行同时按统计窗口内的提问次数估算候选规则能接管的流量占比。
+
+手动运行一次（在 backend 目录下）：
+    python feedback_promotion.py [--window-days 30]
+"""
+import os
+import re
+import json
+import asyncio
+import logging
+import argparse
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, or_, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+
+import models
+import rule_sync
+from answer_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# 后台运行间隔（秒，0 表示不在服务进程内运行）与统计窗口
+FEEDBACK_PROMOTION_INTERVAL = float(os.getenv("FEEDBACK_PROMOTION_INTERVAL", "3600"))
+FEEDBACK_PROMOTION_WINDOW_DAYS = int(os.getenv("FEEDBACK_PROMOTION_WINDOW_DAYS", "30"))
+# 成为候选所需的最少好评数与好评占比；管理员纠正过的回答直接成为候选
+FEEDBACK_PROMOTION_MIN_VOTES = int(os.getenv("FEEDBACK_PROMOTION_MIN_VOTES", "3"))
+FEEDBACK_PROMOTION_MIN_RATIO = float(os.getenv("FEEDBACK_PROMOTION_MIN_RATIO", "0.8"))
+# 自动通过：管理员纠正过的回答，或好评数达到 AUTO_MIN_VOTES 的回答，无需人工审核直接写入规则表
+FEEDBACK_PROMOTION_AUTO_APPROVE = os.getenv("FEEDBACK_PROMOTION_AUTO_APPROVE", "false").lower() == "true"
+FEEDBACK_PROMOTION_AUTO_MIN_VOTES = int(os.getenv("FEEDBACK_PROMOTION_AUTO_MIN_VOTES", "10"))
+
+ORIGIN_FEEDBACK = "feedback"
+ORIGIN_CORRECTION = "correction"
+RULE_SOURCES = {
+    ORIGIN_FEEDBACK: "已验证回答（用户好评）",
+    ORIGIN_CORRECTION: "已验证回答（管理员纠正）",
+}
+# 规则引擎命中的回答本来就在快速通道上，不参与晋升
+RULE_CITATION_PREFIX = "【系统速查"
+
+_SEPARATOR_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+_SEPARATOR = r"[\s\W_]*"
+
+
+def question_pattern(question: str) -> str:
+    """
+    由原始提问生成规则模式：整句匹配，任意位置容忍空白与标点，与候选归并用的 normalize_query 口径一致
+    （"借款 诉讼时效是多久" "借款，诉讼时效是多久?" 都能命中）。
+    规则引擎在去掉分隔符的文本上做字面量预过滤，整句仍是一个完整字面量，不会拖慢其它查询。
+    """
+    core = _SEPARATOR_RE.sub("", question)
+    return "^" + _SEPARATOR + _SEPARATOR.join(re.escape(ch) for ch in core) + _SEPARATOR + "$"
+
+
+# ==========================================
+# 1. 统计
+# ==========================================
+async def _rated_answers(db: AsyncSession, since) -> list:
+    """窗口内有评分或被纠正的助手回答，连同它前一条用户提问（只取文本提问）"""
+    answer = aliased(models.Message)
+    previous = aliased(models.Message)
+    question = aliased(models.Message)
+    # 同一会话中、排在这条回答之前的最近一条用户消息（走 session_id, created_at, id 索引）
+    previous_id = (
+        select(previous.id)
+        .where(
+            previous.session_id == answer.session_id,
+            previous.role == "user",
+            tuple_(previous.created_at, previous.id) < tuple_(answer.created_at, answer.id)
+        )
+        .order_by(previous.created_at.desc(), previous.id.desc())
+        .limit(1)
+        .correlate(answer)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        select(question.content, answer.content, answer.feedback_score, answer.is_corrected, answer.admin_correction)
+        .select_from(answer)
+        .join(question, question.id == previous_id)
+        .where(
+            answer.role == "assistant",
+            answer.created_at >= since,
+            or_(answer.feedback_score.isnot(None), answer.is_corrected.is_(True)),
+            or_(answer.citations.is_(None), ~answer.citations.startswith(RULE_CITATION_PREFIX)),
+            question.message_type == "text"
+        )
+        .order_by(answer.created_at, answer.id)
+    )
+    return result.all()
+
+
+def group_answers(rows) -> Dict[str, dict]:
+    """按规范化问题归并；同一问题以最新的管理员纠正为准，没有纠正时取最新的好评回答"""
+    groups: Dict[str, dict] = {}
+    for question, content, score, corrected, correction in rows:
+        key = normalize_query(question)
+        if not key:
+            continue
+        group = groups.setdefault(key, {"question": question, "answer": None, "origin": None, "positive": 0, "negative": 0})
+        group["question"] = question
+        if corrected and correction:
+            group["answer"], group["origin"] = correction, ORIGIN_CORRECTION
+        if score is not None and score > 0:
+            group["positive"] += 1
+            if group["origin"] != ORIGIN_CORRECTION:
+                group["answer"], group["origin"] = content, ORIGIN_FEEDBACK
+        elif score is not None and score < 0:
+            group["negative"] += 1
+    return groups
+
+
+def qualifies(group: dict) -> bool:
+    if group["origin"] == ORIGIN_CORRECTION:
+        return True
+    votes = group["positive"] + group["negative"]
+    return bool(votes) and group["positive"] >= FEEDBACK_PROMOTION_MIN_VOTES and group["positive"] / votes >= FEEDBACK_PROMOTION_MIN_RATIO
+
+
+def auto_approvable(candidate: models.RuleCandidate) -> bool:
+    return candidate.origin == ORIGIN_CORRECTION or candidate.positive_votes >= FEEDBACK_PROMOTION_AUTO_MIN_VOTES
+
+
+async def _ask_counts(db: AsyncSession, since):
+    """
+    窗口内的提问按规范化问题分组：{key: [(原文, 次数), ...]}，以及文本提问总数
+    （先在数据库里按原文分组，再在 Python 里合并）
+    """
+    result = await db.execute(
+        select(models.Message.content, func.count())
+        .where(models.Message.role == "user", models.Message.message_type == "text", models.Message.created_at >= since)
+        .group_by(models.Message.content)
+    )
+    asks: Dict[str, List[tuple]] = {}
+    total = 0
+    for content, n in result.all():
+        total += n
+        asks.setdefault(normalize_query(content), []).append((content, n))
+    return asks, total
+
+
+async def _candidate_patterns(db: AsyncSession, candidates) -> Dict[str, List[re.Pattern]]:
+    """各候选实际生效（或将要生效）的模式：已通过的用规则表里的模式（审核时可能改过），其余按问题生成"""
+    rule_ids = [c.rule_id for c in candidates if c.status == "approved" and c.rule_id]
+    rule_patterns: Dict[int, List[str]] = {}
+    if rule_ids:
+        result = await db.execute(select(models.Rule.id, models.Rule.patterns).where(models.Rule.id.in_(rule_ids)))
+        for rule_id, patterns in result.all():
+            try:
+                rule_patterns[rule_id] = list(json.loads(patterns))
+            except (TypeError, ValueError):
+                continue
+    compiled: Dict[str, List[re.Pattern]] = {}
+    for candidate in candidates:
+        sources = rule_patterns.get(candidate.rule_id) or [question_pattern(candidate.question or "")]
+        try:
+            compiled[candidate.question_key] = [re.compile(p, re.IGNORECASE) for p in sources]
+        except re.error:
+            compiled[candidate.question_key] = []
+    return compiled
+
+
+def matched_asks(asks: List[tuple], patterns: List[re.Pattern]) -> int:
+    """同组提问中真正会被规则命中的次数：流量估算与规则引擎的实际行为一致"""
+    return sum(n for content, n in asks if any(p.search(content) for p in patterns))
+
+
+# ==========================================
+# 2. 审核
+# ==========================================
+async def approve_candidate(db: AsyncSession, candidate: models.RuleCandidate,
+                            patterns: Optional[List[str]] = None, answer: Optional[str] = None) -> models.Rule:
+    """写入规则表并发布规则变更（同一事务提交），所有 worker 随后同步生效"""
+    if answer:
+        candidate.answer = answer
+    rule = models.Rule(
+        patterns=json.dumps(patterns or [question_pattern(candidate.question)], ensure_ascii=False),
+        answer=candidate.answer,
+        source=RULE_SOURCES.get(candidate.origin, RULE_SOURCES[ORIGIN_FEEDBACK]),
+        active=True
+    )
+    db.add(rule)
+    await db.flush()
+    candidate.status = "approved"
+    candidate.rule_id = rule.id
+    await rule_sync.publish_rule_change(db, rule, rule.id, "upsert")
+    return rule
+
+
+async def projection(db: AsyncSession) -> dict:
+    """按状态汇总候选数与最近一次统计的流量占比；pending + approved 即晋升后可接管的流量"""
+    result = await db.execute(
+        select(
+            models.RuleCandidate.status,
+            func.count(),
+            func.coalesce(func.sum(models.RuleCandidate.ask_count), 0),
+            func.coalesce(func.sum(models.RuleCandidate.traffic_share), 0.0)
+        ).group_by(models.RuleCandidate.status)
+    )
+    by_status = {
+        status: {"candidates": n, "ask_count": int(asks), "traffic_share": round(float(share), 4)}
+        for status, n, asks, share in result.all()
+    }
+    served = sum(by_status.get(s, {}).get("traffic_share", 0.0) for s in ("pending", "approved"))
+    return {"by_status": by_status, "projected_traffic_share": round(served, 4)}
+
+
+# ==========================================
+# 3. 晋升任务
+# ==========================================
+async def run_promotion(db: AsyncSession, window_days: int = FEEDBACK_PROMOTION_WINDOW_DAYS) -> dict:
+    since = models.get_utc_now() - timedelta(days=window_days)
+    rows = await _rated_answers(db, since)
+    groups = group_answers(rows)
+    asks, total_asks = await _ask_counts(db, since)
+
+    result = await db.execute(select(models.RuleCandidate))
+    candidates = {c.question_key: c for c in result.scalars().all()}
+    created = updated = 0
+    for key, group in groups.items():
+        if not qualifies(group):
+            continue
+        candidate = candidates.get(key)
+        if candidate is None:
+            candidate = models.RuleCandidate(question_key=key, status="pending")
+            db.add(candidate)
+            candidates[key] = candidate
+            created += 1
+        else:
+            updated += 1
+        candidate.positive_votes = group["positive"]
+        candidate.negative_votes = group["negative"]
+        # 已审核的候选保留审核时的问题与答案
+        if candidate.status == "pending":
+            candidate.question = group["question"]
+            candidate.answer = group["answer"]
+            candidate.origin = group["origin"]
+
+    # 所有候选（含已审核的）都刷新流量统计，报告反映当前的提问分布；
+    # 只计入规则模式真正能命中的提问，归并到同组但匹配不上的变体不算作可接管流量
+    patterns = await _candidate_patterns(db, list(candidates.values()))
+    for key, candidate in candidates.items():
+        candidate.ask_count = matched_asks(asks.get(key, []), patterns.get(key, []))
+        candidate.traffic_share = candidate.ask_count / total_asks if total_asks else 0.0
+
+    try:
+        await db.commit()
+    except IntegrityError:
+        # 多个 worker 同时运行时可能插入同一问题，下一轮会以已存在的行为准
+        await db.rollback()
+        logger.warning("好评答案晋升：候选规则并发写入冲突，本轮跳过")
+        return {"skipped": True}
+
+    auto_approved = 0
+    if FEEDBACK_PROMOTION_AUTO_APPROVE:
+        for candidate in list(candidates.values()):
+            if candidate.status == "pending" and auto_approvable(candidate):
+                await approve_candidate(db, candidate)
+                auto_approved += 1
+
+    return {
+        "window_days": window_days,
+        "rated_answers": len(rows),
+        "questions_asked": total_asks,
+        "created": created,
+        "updated": updated,
+        "auto_approved": auto_approved,
+        **(await projection(db)),
+    }
+
+
+async def run_promotion_loop(session_factory, interval: float = FEEDBACK_PROMOTION_INTERVAL):
+    """在 lifespan 中以后台任务启动，周期性归并好评答案并更新流量估算"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with session_factory() as db:
+                report = await run_promotion(db)
+            if not report.get("skipped"):
+                logger.info(
+                    f"⭐ 好评答案晋升：新增候选 {report['created']}，自动通过 {report['auto_approved']}，"
+                    f"预计可接管流量 {report['projected_traffic_share']:.1%}"
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ 好评答案晋升失败: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--window-days", type=int, default=FEEDBACK_PROMOTION_WINDOW_DAYS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from database import AsyncSessionLocal
+
+    async def run():
+        async with AsyncSessionLocal() as db:
+            return await run_promotion(db, args.window_days)
+
+    print(json.dumps(asyncio.run(run()), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+from collections import deque
+from typing import List, NamedTuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import models
+from prompt_builder import count_tokens
+
+# 送入模型的历史消息条数上限，以及可选的 token 预算（0 表示不按 token 截断，按 tiktoken 计数）
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "6"))
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "0"))
+
+class HistoryEntry(NamedTuple):
+    """轻量的历史消息，只保留拼 prompt 需要的字段（与 models.Message 一样可用 .role / .content 访问）"""
+    role: str
+    content: str
+
+
+class SessionHistory:
+    """
+    单个 WebSocket 连接的会话历史环形缓冲：
+      - 首次使用时用 LIMIT 只取最近 N 条（不加载整段会话，也不构造 ORM 对象）；
+      - 之后每条新消息直接追加到缓冲，不再查库。
+    缓冲多留 1 条，用来容纳当前这轮刚写入的用户消息。
+    """
+
+    def __init__(self, session_id: str, max_messages: int = HISTORY_MAX_MESSAGES,
+                 max_tokens: int = HISTORY_MAX_TOKENS):
+        self.session_id = session_id
+        self.max_tokens = max_tokens
+        self._buffer = deque(maxlen=max_messages + 1)
+        self._loaded = False
+
+    async def ensure_loaded(self, db: AsyncSession):
+        if self._loaded:
+            return
+        result = await db.execute(
+            select(models.Message.role, models.Message.content)
+            .filter(models.Message.session_id == self.session_id)
+            .order_by(models.Message.created_at.desc(), models.Message.id.desc())
+            .limit(self._buffer.maxlen)
+        )
+        for role, content in reversed(result.all()):
+            self._buffer.append(HistoryEntry(role, content or ""))
+        self._loaded = True
+
+    def append(self, role: str, content: str):
+        self._buffer.append(HistoryEntry(role, content or ""))
+
+    def window(self) -> List[HistoryEntry]:
+        """按时间正序返回历史；配置了 token 预算时从最新一条往前累计，超出预算即截断"""
+        entries = list(self._buffer)
+        if not self.max_tokens:
+            return entries
+        kept = []
+        budget = self.max_tokens
+        for entry in reversed(entries):
+            cost = count_tokens(entry.content)
+            if cost > budget and kept:
+                break
+            kept.append(entry)
+            budget -= cost
+        return list(reversed(kept))
@@ -0,0 +1,129 @@
+import io
+import os
+import re
+import base64
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 送给视觉模型前的最长边（像素）与 JPEG 质量；超出的图片等比缩小后重新编码
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+# data URL 缓存的总字节上限（按 base64 字符串长度计）
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_CONTENT_NAME_RE = re.compile(r"^([0-9a-f]{64})\.[a-z0-9]+$")
+_MIME_BY_EXT = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png", "gif": "image/gif", "webp": "image/webp"}
+
+
+class DataUrlCache:
+    """按内容哈希缓存编码后的 data URL，超出总字节上限时按 LRU 淘汰"""
+
+    def __init__(self, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, str]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Tuple, value: str):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = value
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def snapshot(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+data_url_cache = DataUrlCache()
+
+
+def _cache_key(sha256: str) -> Tuple:
+    # 缩放参数变化后旧缓存自然失效
+    return (sha256, IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY)
+
+
+def _downscale(raw: bytes, ext: str) -> Tuple[bytes, str]:
+    """缩放并重新编码，返回 (图片字节, mime)；未安装 Pillow 或无法解码时原样返回"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return raw, _MIME_BY_EXT.get(ext, f"image/{ext}")
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            img = ImageOps.exif_transpose(img)
+            if max(img.size) <= IMAGE_MAX_SIDE and ext in ("jpg", "jpeg", "png"):
+                return raw, _MIME_BY_EXT[ext]
+            img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+            out = io.BytesIO()
+            # 带透明通道的图保留 PNG，其余统一转 JPEG（体积最小）
+            has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            if has_alpha:
+                img.save(out, format="PNG", optimize=True)
+                return out.getvalue(), "image/png"
+            img.convert("RGB").save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            return out.getvalue(), "image/jpeg"
+    except Exception as e:
+        logger.warning(f"图片预处理失败，按原图发送: {e}")
+        return raw, _MIME_BY_EXT.get(ext, f"image/{ext}")
+
+
+def _content_hash_from_name(path: str) -> Optional[str]:
+    """内容寻址文件名本身就是 SHA-256，无需读文件即可得到缓存键"""
+    match = _CONTENT_NAME_RE.match(os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def _encode(path: str, sha256: Optional[str]) -> Optional[str]:
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except OSError as e:
+        logger.error(f"读取图片失败: {e}")
+        return None
+    if sha256 is None:
+        # 旧的 uuid 文件名：读出内容后再按哈希查缓存
+        sha256 = hashlib.sha256(raw).hexdigest()
+        cached = data_url_cache.get(_cache_key(sha256))
+        if cached:
+            return cached
+    ext = path.rsplit(".", 1)[-1].lower()
+    data, mime_type = _downscale(raw, ext)
+    data_url = f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+    data_url_cache.put(_cache_key(sha256), data_url)
+    logger.info(f"🖼️ 图片预处理: {len(raw) // 1024}KB -> {len(data) // 1024}KB ({mime_type})")
+    return data_url
+
+
+async def image_data_url(path: str) -> Optional[str]:
+    """读取本地图片，缩放并编码为 data URL；命中缓存时直接返回，否则读文件与缩放都放到线程池执行"""
+    sha256 = _content_hash_from_name(path)
+    if sha256:
+        cached = data_url_cache.get(_cache_key(sha256))
+        if cached:
+            return cached
+    return await asyncio.to_thread(_encode, path, sha256)
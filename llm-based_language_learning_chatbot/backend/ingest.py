@@ -0,0 +1,188 @@
+"""
+法律知识库批量导入：流式解析 JSON / JSONL，按批向量化写入 Chroma，并同步写入本地词法索引。
+文档 ID 由内容哈希确定，重复运行只会写入新增或变化的文档。
+
+用法（在 backend 目录下）：
+    python ingest.py legal_data.json [--batch-size 64]
+    python ingest.py statutes.jsonl --batch-size 256
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+from typing import Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+_READ_CHUNK = 64 * 1024
+
+# ==========================================
+# 1. 流式解析
+# ==========================================
+def _iter_json_array(f) -> Iterator[dict]:
+    """逐个解析顶层 JSON 数组中的元素，内存占用与单个元素大小相关而非整个文件"""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        # 跳过空白与分隔符
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            chunk = f.read(_READ_CHUNK)
+            buf, pos = buf[pos:] + chunk, 0
+            eof = not chunk
+
+        if pos >= len(buf):
+            if started:
+                raise ValueError("JSON 数组未闭合")
+            return
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError("顶层必须是 JSON 数组")
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == "]":
+            return
+
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(_READ_CHUNK)
+            buf, pos = buf[pos:] + chunk, 0
+            eof = not chunk
+            continue
+        if end >= len(buf) and not eof:
+            # 数字等标量可能恰好在块边界被截断，读到更多内容再确认
+            chunk = f.read(_READ_CHUNK)
+            buf, pos = buf[pos:] + chunk, 0
+            eof = not chunk
+            continue
+        pos = end
+        yield item
+
+
+def iter_documents(file_path: str) -> Iterator[dict]:
+    """.jsonl 逐行解析，其余按顶层 JSON 数组流式解析"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        if file_path.endswith(".jsonl"):
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"第 {line_no} 行不是合法 JSON，已跳过: {e}")
+        else:
+            yield from _iter_json_array(f)
+
+# ==========================================
+# 2. 批量写入
+# ==========================================
+def document_id(content: str, source: str) -> str:
+    """由 (来源, 内容) 确定的文档 ID，同一文档重复导入得到同一个 ID"""
+    return hashlib.sha256(f"{source}\x00{content}".encode("utf-8")).hexdigest()[:32]
+
+
+def _batched(items: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ingest_documents(collection, documents: Iterable[dict], batch_size: int = INGEST_BATCH_SIZE,
+                     lexical_index=None) -> dict:
+    """
+    documents 为 {"content": ..., "source": ...} 的可迭代对象。
+    每批先按 ID 查询已存在的文档并跳过，剩余部分一次 collection.add（一次向量化请求）。
+    lexical_index 不为空时同步写入词法索引；collection 为 None（无向量后端）时只写词法索引，两者都为 None 时抛出 ValueError。
+    返回统计：processed / added / skipped / invalid / seconds。
+    """
+    if collection is None and lexical_index is None:
+        raise ValueError("ingest_documents 需要向量集合或词法索引至少一个")
+    stats = {"processed": 0, "added": 0, "skipped": 0, "invalid": 0, "seconds": 0.0}
+    started = time.perf_counter()
+
+    for batch in _batched(documents, batch_size):
+        pending = {}
+        for item in batch:
+            stats["processed"] += 1
+            content = item.get("content") if isinstance(item, dict) else None
+            source = item.get("source", "") if isinstance(item, dict) else ""
+            if not content:
+                stats["invalid"] += 1
+                continue
+            pending[document_id(content, source)] = (content, source)
+
+        if pending:
+            if collection is not None:
+                existing = set(collection.get(ids=list(pending), include=[])["ids"])
+            else:
+                existing = {doc_id for doc_id in pending if doc_id in lexical_index}
+            new_ids = [doc_id for doc_id in pending if doc_id not in existing]
+            stats["skipped"] += len(pending) - len(new_ids)
+            if new_ids and collection is not None:
+                collection.add(
+                    ids=new_ids,
+                    documents=[pending[i][0] for i in new_ids],
+                    metadatas=[{"source": pending[i][1]} for i in new_ids]
+                )
+            stats["added"] += len(new_ids)
+            if lexical_index is not None:
+                # 词法索引自行忽略已存在的 ID，可覆盖向量库已有但索引缺失的文档
+                lexical_index.add_documents((doc_id, content, source) for doc_id, (content, source) in pending.items())
+
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"📥 已处理 {stats['processed']} 条（新增 {stats['added']}，跳过 {stats['skipped']}），"
+            f"{stats['processed'] / elapsed if elapsed else 0:.1f} 条/秒"
+        )
+
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def ingest_file(collection, file_path: str, batch_size: int = INGEST_BATCH_SIZE, lexical_index=None) -> Optional[dict]:
+    if not os.path.exists(file_path):
+        logger.warning(f"数据文件 {file_path} 不存在，跳过导入。")
+        return None
+    stats = ingest_documents(collection, iter_documents(file_path), batch_size, lexical_index)
+    logger.info(f"✅ {file_path} 导入完成: {stats}")
+    return stats
+
+# ==========================================
+# 3. 命令行入口
+# ==========================================
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="JSON 数组或 JSONL 文件，每条包含 content 与 source")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from rag_service import get_collection, get_lexical_index, save_lexical_index
+
+    stats = ingest_file(get_collection(), args.file, args.batch_size, get_lexical_index())
+    save_lexical_index()
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
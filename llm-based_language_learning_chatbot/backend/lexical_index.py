@@ -0,0 +1,215 @@
+import os
+import re
+import math
+import pickle
+import uuid
+import logging
+import threading
+from array import array
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_INDEX_FORMAT = 1
+
+# 连续汉字 / 连续字母数字
+_CJK_RUN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+_WORD_RE = re.compile(r"[0-9a-zA-Z]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    中文按字切分出 unigram + bigram（"第一百八十八条" -> 第, 一, ..., 第一, 一百, ...），
+    英文/数字按词切分并转小写。无需分词词典，法条编号这类精确查询命中率高。
+    """
+    tokens: List[str] = []
+    for run in _CJK_RUN_RE.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(w.lower() for w in _WORD_RE.findall(text))
+    return tokens
+
+
+class LexicalIndex:
+    """
+    数组存储的 BM25 倒排索引（CSR 布局）：
+      vocab[term] -> term_id
+      postings[offsets[term_id]:offsets[term_id + 1]] 为包含该词的文档序号，tfs 为对应词频
+    新增文档先进入待合并区，下一次检索前统一并入数组，适合"批量导入、频繁查询"的场景。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.vocab: Dict[str, int] = {}
+        self._terms: List[str] = []  # term_id -> term
+        self.offsets = array("L", [0])
+        self.postings = array("L")
+        self.tfs = array("H")
+        self.doc_ids: List[str] = []
+        self.doc_lens = array("L")
+        self.docs: List[Tuple[str, str]] = []  # (content, source)
+        self._id_to_doc: Dict[str, int] = {}
+        self._pending: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self._total_len = 0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id: str):
+        return doc_id in self._id_to_doc
+
+    # --- 写入 ---
+    def add_documents(self, items: Iterable[Tuple[str, str, str]]):
+        """items: (doc_id, content, source)，已存在的 ID 会被忽略"""
+        with self._lock:
+            for doc_id, content, source in items:
+                if doc_id in self._id_to_doc:
+                    continue
+                doc_no = len(self.doc_ids)
+                counts = Counter(tokenize(f"{source} {content}"))
+                for term, tf in counts.items():
+                    self._pending[term].append((doc_no, min(tf, 0xFFFF)))
+                length = sum(counts.values())
+                self.doc_ids.append(doc_id)
+                self.doc_lens.append(length)
+                self.docs.append((content, source))
+                self._id_to_doc[doc_id] = doc_no
+                self._total_len += length
+                self.dirty = True
+
+    def _merge_pending(self):
+        """把待合并区并入 CSR 数组：旧词追加在原有倒排之后，新词排在末尾"""
+        if not self._pending:
+            return
+        new_offsets = array("L", [0])
+        new_postings = array("L")
+        new_tfs = array("H")
+        for term_id in range(len(self.vocab)):
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            new_postings.extend(self.postings[start:end])
+            new_tfs.extend(self.tfs[start:end])
+            extra = self._pending.pop(self._terms[term_id], None)
+            if extra:
+                new_postings.extend(d for d, _ in extra)
+                new_tfs.extend(tf for _, tf in extra)
+            new_offsets.append(len(new_postings))
+        for term, extra in self._pending.items():
+            self.vocab[term] = len(self.vocab)
+            self._terms.append(term)
+            new_postings.extend(d for d, _ in extra)
+            new_tfs.extend(tf for _, tf in extra)
+            new_offsets.append(len(new_postings))
+        self._pending.clear()
+        self.offsets, self.postings, self.tfs = new_offsets, new_postings, new_tfs
+
+    # --- 检索 ---
+    def search(self, query: str, n_results: int = 3) -> List[Tuple[str, float]]:
+        """返回 [(doc_id, bm25_score)]，按分数降序"""
+        with self._lock:
+            self._merge_pending()
+            n_docs = len(self.doc_ids)
+            if not n_docs:
+                return []
+            avg_len = self._total_len / n_docs
+            scores: Dict[int, float] = defaultdict(float)
+            for term, qtf in Counter(tokenize(query)).items():
+                term_id = self.vocab.get(term)
+                if term_id is None:
+                    continue
+                start, end = self.offsets[term_id], self.offsets[term_id + 1]
+                df = end - start
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for i in range(start, end):
+                    doc_no = self.postings[i]
+                    tf = self.tfs[i]
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lens[doc_no] / avg_len)
+                    scores[doc_no] += qtf * idf * tf * (BM25_K1 + 1) / (tf + norm)
+            top = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:n_results]
+            return [(self.doc_ids[doc_no], score) for doc_no, score in top]
+
+    def reference_score(self, query: str) -> float:
+        """
+        查询的参照满分：一篇平均长度、恰好包含每个查询词一次的文档的 BM25 分数，即 Σ qtf × idf。
+        索引中不存在的词按 df = 0 计入，查询里知识库没有的内容会拉低 search 分数与它的比值。
+        """
+        with self._lock:
+            self._merge_pending()
+            n_docs = len(self.doc_ids)
+            if not n_docs:
+                return 0.0
+            total = 0.0
+            for term, qtf in Counter(tokenize(query)).items():
+                term_id = self.vocab.get(term)
+                df = self.offsets[term_id + 1] - self.offsets[term_id] if term_id is not None else 0
+                total += qtf * math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            return total
+
+    def get(self, doc_id: str) -> Optional[Tuple[str, str]]:
+        doc_no = self._id_to_doc.get(doc_id)
+        return self.docs[doc_no] if doc_no is not None else None
+
+    # --- 持久化 ---
+    def save(self, path: str):
+        with self._lock:
+            self._merge_pending()
+            state = {
+                "format": _INDEX_FORMAT,
+                "vocab": self.vocab,
+                "offsets": self.offsets,
+                "postings": self.postings,
+                "tfs": self.tfs,
+                "doc_ids": self.doc_ids,
+                "doc_lens": self.doc_lens,
+                "docs": self.docs,
+            }
+            # 每次写入使用独立的临时文件：多个 worker 或导入脚本同时保存时，不会替换掉别人写了一半的文件
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+                raise
+            self.dirty = False
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        index = cls()
+        if not os.path.exists(path):
+            return index
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+            if state.get("format") != _INDEX_FORMAT:
+                logger.warning("词法索引格式已变化，将重新构建")
+                return index
+            for key in ("vocab", "offsets", "postings", "tfs", "doc_ids", "doc_lens", "docs"):
+                setattr(index, key, state[key])
+            index._id_to_doc = {doc_id: i for i, doc_id in enumerate(index.doc_ids)}
+            index._total_len = sum(index.doc_lens)
+            index._terms = [None] * len(index.vocab)
+            for term, term_id in index.vocab.items():
+                index._terms[term_id] = term
+        except Exception as e:
+            logger.warning(f"词法索引加载失败，将重新构建: {e}")
+            return cls()
+        return index
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """RRF：score(d) = Σ 1 / (k + rank)，对各路召回的分数尺度不敏感"""
+    fused: Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            fused[doc_id] += 1.0 / (k + rank)
+    return [doc_id for doc_id, _ in sorted(fused.items(), key=lambda kv: kv[1], reverse=True)]
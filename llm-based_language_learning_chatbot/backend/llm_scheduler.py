@@ -0,0 +1,212 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional
+
+from prompt_builder import estimate_tokens
+from metrics import LLM_QUEUE_WAIT
+
+logger = logging.getLogger(__name__)
+
+# 全局并发上限、每分钟 token 上限（0 表示不限）、排队超时秒数
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+# 预估 token 时按此计入输出与每张图片的开销，调用结束后按实际 usage 校正
+# （只是准入用的预估，用字符估算即可，不必对每次拼好的 prompt 重新分词）
+LLM_OUTPUT_TOKENS_ESTIMATE = int(os.getenv("LLM_OUTPUT_TOKENS_ESTIMATE", "800"))
+LLM_IMAGE_TOKENS_ESTIMATE = 1000
+
+# 数值越小越优先：单 Agent / 图片 / 辩论收尾的合成调用优先于辩论中的律师、法官调用
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+# 公平排队的键：WebSocket 处理函数在每个连接上设置为 session_id，asyncio 任务会自动继承
+llm_session_key: ContextVar[str] = ContextVar("llm_session_key", default="anonymous")
+
+
+class LLMQueueTimeout(Exception):
+    """排队超过 LLM_QUEUE_TIMEOUT 仍未获得调用名额"""
+
+
+def estimate_request_tokens(messages: list) -> int:
+    tokens = LLM_OUTPUT_TOKENS_ESTIMATE
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                tokens += estimate_tokens(part.get("text", "")) if part.get("type") == "text" else LLM_IMAGE_TOKENS_ESTIMATE
+        else:
+            tokens += estimate_tokens(content or "")
+    return tokens
+
+
+class _Waiter:
+    __slots__ = ("future", "key", "priority", "tokens", "enqueued_at")
+
+    def __init__(self, future, key, priority, tokens):
+        self.future = future
+        self.key = key
+        self.priority = priority
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+
+
+class SlotUsage:
+    """调用方在拿到 usage 后写入 actual_tokens，释放名额时据此校正令牌桶"""
+    __slots__ = ("estimated_tokens", "actual_tokens")
+
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.actual_tokens: Optional[int] = None
+
+
+class LLMScheduler:
+    """
+    所有上游 LLM 调用的准入调度：
+      - 并发名额 + 令牌桶（按预估 token 扣减）双重限流；
+      - 先按优先级，同一优先级内按会话轮转（每个会话每轮最多放行一个请求），单个会话刷屏不会饿死其他人；
+      - 排队超时抛出 LLMQueueTimeout，由上层告知用户，而不是无声挂起。
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+                 queue_timeout: float = LLM_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._queues: Dict[int, "OrderedDict[str, Deque[_Waiter]]"] = {}
+        self._bucket = float(tokens_per_minute)
+        self._bucket_updated = time.monotonic()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        # 指标
+        self.granted = 0
+        self.timeouts = 0
+        self._wait_ms: Deque[float] = deque(maxlen=1000)
+
+    # --- 令牌桶 ---
+    def _refill(self):
+        now = time.monotonic()
+        rate = self.tokens_per_minute / 60
+        self._bucket = min(float(self.tokens_per_minute), self._bucket + (now - self._bucket_updated) * rate)
+        self._bucket_updated = now
+
+    def _schedule_wakeup(self, delay: float):
+        if self._wakeup is None:
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+    # --- 排队与放行 ---
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            if sessions:
+                return next(iter(sessions.values()))[0]
+        return None
+
+    def _remove(self, waiter: _Waiter):
+        sessions = self._queues.get(waiter.priority, {})
+        queue = sessions.get(waiter.key)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        if not queue:
+            del sessions[waiter.key]
+
+    def _dispatch(self):
+        while self._in_flight < self.max_concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            if self.tokens_per_minute:
+                self._refill()
+                # 单个请求超过桶容量时，按桶满放行，避免永远无法调度
+                need = min(waiter.tokens, self.tokens_per_minute)
+                if self._bucket < need:
+                    self._schedule_wakeup((need - self._bucket) / (self.tokens_per_minute / 60))
+                    return
+                self._bucket -= waiter.tokens
+            sessions = self._queues[waiter.priority]
+            sessions[waiter.key].popleft()
+            if sessions[waiter.key]:
+                # 轮转：本会话放行一个后排到队尾
+                sessions.move_to_end(waiter.key)
+            else:
+                del sessions[waiter.key]
+            self._in_flight += 1
+            self.granted += 1
+            waited = time.monotonic() - waiter.enqueued_at
+            self._wait_ms.append(waited * 1000)
+            LLM_QUEUE_WAIT.observe(waited, priority=waiter.priority)
+            waiter.future.set_result(None)
+
+    async def _acquire(self, priority: int, tokens: int):
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop.create_future(), llm_session_key.get(), priority, tokens)
+        self._queues.setdefault(priority, OrderedDict()).setdefault(waiter.key, deque()).append(waiter)
+        self._dispatch()
+        if waiter.future.done():
+            return
+        try:
+            # 不用 wait_for：超时与放行同时发生时，不能把已经分到的名额取消掉
+            done, _ = await asyncio.wait({waiter.future}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if waiter.future.done():
+                self._release(SlotUsage(tokens))
+            else:
+                self._remove(waiter)
+                waiter.future.cancel()
+            raise
+        if not done:
+            self._remove(waiter)
+            waiter.future.cancel()
+            self.timeouts += 1
+            logger.warning(f"⏳ LLM 排队超时 ({self.queue_timeout}s)，会话 {waiter.key}")
+            raise LLMQueueTimeout()
+
+    def _release(self, usage: SlotUsage):
+        self._in_flight -= 1
+        if self.tokens_per_minute and usage.actual_tokens is not None:
+            # 按实际用量校正：预估多了还回去，少了补扣
+            self._refill()
+            self._bucket = min(float(self.tokens_per_minute), self._bucket + usage.estimated_tokens - usage.actual_tokens)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_HIGH, tokens: int = 0):
+        await self._acquire(priority, tokens)
+        usage = SlotUsage(tokens)
+        try:
+            yield usage
+        finally:
+            self._release(usage)
+
+    # --- 指标 ---
+    def queue_depth(self) -> Dict[int, int]:
+        return {priority: sum(len(q) for q in sessions.values()) for priority, sessions in self._queues.items()}
+
+    def snapshot(self) -> dict:
+        samples = sorted(self._wait_ms)
+        return {
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "queued": self.queue_depth(),
+            "granted": self.granted,
+            "timeouts": self.timeouts,
+            "wait_p50_ms": round(samples[len(samples) // 2], 1) if samples else 0.0,
+            "wait_p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1) if samples else 0.0,
+            "tokens_available": round(self._bucket) if self.tokens_per_minute else None,
+        }
+
+
+llm_scheduler = LLMScheduler()
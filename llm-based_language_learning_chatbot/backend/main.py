@@ -2,14 +2,17 @@ import json
 import os
 import shutil
 import uuid
+import time
+import asyncio
 import logging
-from contextlib import asynccontextmanager
-from typing import List
+from contextlib import aclosing, asynccontextmanager
+from typing import List, Optional
 
-from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File, Form, APIRouter, Request
+from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File, Form, APIRouter, Request, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
@@ -18,8 +21,24 @@ import models
 import schemas
 import auth_utils
 import rule_service
-from database import engine, get_db, AsyncSessionLocal
-from ai_service import get_legal_response, synthesize_dialect_audio
+import rule_sync
+import feedback_promotion
+import analytics
+import metrics
+from answer_cache import answer_cache
+from embedding_cache import embedding_cache
+from image_pipeline import data_url_cache
+from user_cache import CurrentUser, user_cache
+from query_router import router_stats
+from single_flight import single_flight
+import tts_service
+from llm_scheduler import LLMQueueTimeout, llm_scheduler, llm_session_key
+from history_service import SessionHistory
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, keyset_page, split_page
+from message_writer import enqueue_message, message_writer, save_message
+from upload_service import UPLOAD_DIR, stream_upload, uploads_router
+from database import engine, get_db, AsyncSessionLocal, STATEMENT_COUNTS
+from ai_service import get_legal_response, stream_legal_response
 from rag_service import init_knowledge_base
 
 # 配置日志
@@ -38,9 +57,32 @@ def validate_environment():
     logger.info(f"Environment: {os.getenv('ENVIRONMENT', 'development')}")
     logger.info("Environment validation passed")
 
+# --- 启动状态 ---
+# liveness 永远可用；knowledge_base 就绪前 RAG 检索返回空，规则与 LLM 照常服务
+READINESS = {
+    "status": "starting",
+    "knowledge_base": "pending",
+    "startup_ms": None,
+    "knowledge_base_ms": None,
+}
+
+async def init_knowledge_base_in_background():
+    """知识库初始化可能需要向量化整个语料，放到线程池里跑，不阻塞事件循环和启动"""
+    started = time.perf_counter()
+    READINESS["knowledge_base"] = "loading"
+    try:
+        await asyncio.to_thread(init_knowledge_base)
+        READINESS["knowledge_base"] = "ready"
+    except Exception as e:
+        logger.error(f"知识库初始化失败: {e}")
+        READINESS["knowledge_base"] = "failed"
+    READINESS["knowledge_base_ms"] = round((time.perf_counter() - started) * 1000)
+    logger.info(f"📚 知识库后台初始化结束 ({READINESS['knowledge_base']})，耗时 {READINESS['knowledge_base_ms']}ms")
+
 # --- 生命周期管理 ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    started = time.perf_counter()
     # 0. 验证环境变量
     validate_environment()
 
@@ -48,24 +90,39 @@ async def lifespan(app: FastAPI):
     async with engine.begin() as conn:
         await conn.run_sync(models.Base.metadata.create_all)
     
-    # 2. 初始化 RAG 知识库
-    init_knowledge_base()
-    
-    # 3. 初始化默认管理员和种子规则 (修复点：使用 AsyncSessionLocal)
+    # 2. 初始化默认管理员和种子规则 (修复点：使用 AsyncSessionLocal)
+    #    规则只需一次查询即可加载，启动后立刻可以给出规则命中的回答
     async with AsyncSessionLocal() as db:
         await init_admin_user(db)
         await init_rules(db)
         
-    logger.info("系统启动完成")
+    # 3. 启动消息合批写入；后台初始化 RAG 知识库；后台同步其它 worker 发布的规则变更
+    message_writer.start()
+    kb_task = asyncio.create_task(init_knowledge_base_in_background())
+    sync_task = asyncio.create_task(rule_sync.run_sync_loop(AsyncSessionLocal))
+    # 4. 定期把好评 / 纠正过的回答归并为候选规则
+    background_tasks = [sync_task, kb_task]
+    if feedback_promotion.FEEDBACK_PROMOTION_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(feedback_promotion.run_promotion_loop(AsyncSessionLocal)))
+    # 5. 定期把新增的消息与工单增量汇总到统计表
+    if analytics.ANALYTICS_REFRESH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(analytics.run_refresh_loop(AsyncSessionLocal)))
+
+    READINESS["status"] = "serving"
+    READINESS["startup_ms"] = round((time.perf_counter() - started) * 1000)
+    logger.info(f"系统启动完成，耗时 {READINESS['startup_ms']}ms（知识库在后台加载）")
     yield
     logger.info("系统正在关闭")
+    for task in background_tasks:
+        task.cancel()
+    await message_writer.close()
 
 async def init_admin_user(db: AsyncSession):
     """初始化管理员账户"""
     res = await db.execute(select(models.User).filter(models.User.username == "admin"))
     if not res.scalars().first():
         default_pwd = os.getenv("ADMIN_DEFAULT_PASSWORD", "admin123")
-        hp = auth_utils.get_password_hash(default_pwd)
+        hp = await auth_utils.get_password_hash_async(default_pwd)
         db.add(models.User(username="admin", hashed_password=hp, role="admin"))
         await db.commit()
         logger.info("👤 管理员已创建 (admin)")
@@ -85,7 +142,7 @@ async def init_rules(db: AsyncSession):
         logger.info("注入了默认种子规则")
     
     # 初始化完成后，统一加载到内存缓存中
-    await rule_service.load_rules_from_db(db)
+    await rule_sync.load_rules(db)
 
 # --- App 初始化 ---
 app = FastAPI(title="AI Legal Assistant", lifespan=lifespan)
@@ -100,24 +157,60 @@ app.add_middleware(
     allow_headers=["Content-Type", "Authorization"]
 )
 
-os.makedirs("static/uploads", exist_ok=True)
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+# 上传文件由 uploads_router 提供（强 ETag / immutable / Range），必须注册在 /static 挂载之前
+app.include_router(uploads_router)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+@app.middleware("http")
+async def track_in_flight_requests(request: Request, call_next):
+    with metrics.HTTP_REQUESTS_IN_FLIGHT.track_inprogress():
+        return await call_next(request)
+
+@app.exception_handler(auth_utils.PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: auth_utils.PasswordHasherBusy):
+    """密码运算排队已满：让客户端稍后重试，而不是无限排队拖慢整个 worker"""
+    return JSONResponse(status_code=503, content={"detail": "登录请求过多，请稍后再试"}, headers={"Retry-After": "1"})
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+MAX_TTS_CHARS = 5000
 
 # --- 依赖项 ---
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+def _token_payload(token: str) -> dict:
     payload = auth_utils.decode_access_token(token)
     if not payload:
         raise HTTPException(status_code=401, detail="无效的认证凭证")
+    return payload
+
+async def _resolve_user(payload: dict, db: AsyncSession) -> CurrentUser:
+    """按 sub 解析用户：同一 token 在 TTL 内复用已解析的结果，否则查库"""
     username = payload.get("sub")
-    result = await db.execute(select(models.User).filter(models.User.username == username))
-    user = result.scalars().first()
-    if not user:
+    iat = payload.get("iat")
+    cached = user_cache.get(username, iat)
+    if cached:
+        return cached
+    result = await db.execute(
+        select(models.User.id, models.User.username, models.User.role).filter(models.User.username == username)
+    )
+    row = result.first()
+    if not row:
         raise HTTPException(status_code=401, detail="用户不存在")
+    user = CurrentUser(*row)
+    user_cache.put(username, iat, user)
     return user
 
-async def get_current_admin(user: models.User = Depends(get_current_user)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> CurrentUser:
+    payload = _token_payload(token)
+    # token 内嵌了 uid/role 且签发后用户没有变更过：普通用户的身份完全不查库。
+    # 角色可变，撤销记录只在本进程内，内嵌的 admin 角色不作数，一律走缓存 / 查库
+    if (payload.get("role") == "user" and "uid" in payload
+            and user_cache.claims_trusted(payload.get("sub"), payload.get("iat"))):
+        return CurrentUser(payload["uid"], payload["sub"], payload["role"])
+    return await _resolve_user(payload, db)
+
+async def get_current_admin(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> CurrentUser:
+    """管理员权限始终按缓存 / 数据库中的当前角色判断，不信任 token 内嵌的角色"""
+    user = await _resolve_user(_token_payload(token), db)
     if user.role != "admin":
         raise HTTPException(status_code=403, detail="权限不足：需要管理员权限")
     return user
@@ -126,6 +219,47 @@ async def get_current_admin(user: models.User = Depends(get_current_user)):
 # API 路由分组
 # ============================
 
+# 0. 健康检查
+@app.get("/health", tags=["Health"])
+async def health():
+    """存活探针：进程能处理请求即返回 200，同时附带启动耗时"""
+    return READINESS
+
+@app.get("/ready", tags=["Health"])
+async def ready():
+    """就绪探针：知识库加载完成前返回 503，供滚动发布时切流参考"""
+    if READINESS["knowledge_base"] not in ("ready", "failed"):
+        raise HTTPException(status_code=503, detail=READINESS)
+    return READINESS
+
+def _collect_app_metrics():
+    """抓取时把各组件已有的统计快照转成指标，组件内部不再重复计数"""
+    cache_lookups = []
+    for cache, stats in (
+        ("answer", {"exact_hit": answer_cache.stats["exact_hits"], "semantic_hit": answer_cache.stats["semantic_hits"], "miss": answer_cache.stats["misses"]}),
+        ("embedding", {"memory_hit": embedding_cache.stats["memory_hits"], "disk_hit": embedding_cache.stats["disk_hits"], "miss": embedding_cache.stats["misses"]}),
+        ("user", {"hit": user_cache.hits, "miss": user_cache.misses}),
+        ("image", {"hit": data_url_cache.hits, "miss": data_url_cache.misses}),
+        ("tts", {"hit": tts_service.tts_cache.hits, "miss": tts_service.tts_cache.misses}),
+        ("single_flight", {"hit": single_flight.coalesced, "miss": single_flight.leaders}),
+    ):
+        cache_lookups.extend(({"cache": cache, "result": result}, value) for result, value in stats.items())
+    yield "legal_cache_lookups_total", "counter", "各缓存的命中 / 未命中次数（single_flight 的 hit 为被合并的请求）", cache_lookups
+
+    scheduler = llm_scheduler.snapshot()
+    yield "legal_llm_in_flight", "gauge", "正在进行的上游 LLM 调用数", [({}, scheduler["in_flight"])]
+    yield "legal_llm_queued", "gauge", "LLM 调度器中排队的请求数", [({"priority": str(p)}, n) for p, n in scheduler["queued"].items()]
+    yield "legal_llm_queue_timeouts_total", "counter", "LLM 排队超时次数", [({}, scheduler["timeouts"])]
+    yield "legal_password_hash_pending", "gauge", "排队或正在执行的密码哈希运算数", [({}, auth_utils.password_hash_queue_depth())]
+    yield "legal_db_statements_total", "counter", "按类型统计的 SQL 语句数", [({"verb": verb}, n) for verb, n in sorted(STATEMENT_COUNTS.items())]
+
+metrics.REGISTRY.register_collector(_collect_app_metrics)
+
+@app.get("/metrics", tags=["Health"])
+async def get_metrics():
+    """Prometheus 抓取端点（当前 worker）：各档位耗时、各阶段耗时、缓存命中、token 用量与连接数"""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 # 1. 认证模块
 auth_router = APIRouter(tags=["Auth"])
 
@@ -135,28 +269,28 @@ async def register(user_data: schemas.UserCreate, db: AsyncSession = Depends(get
     if existing.scalars().first():
         raise HTTPException(status_code=400, detail="用户名已被注册")
     
-    hashed_pw = auth_utils.get_password_hash(user_data.password)
+    hashed_pw = await auth_utils.get_password_hash_async(user_data.password)
     new_user = models.User(username=user_data.username, hashed_password=hashed_pw)
     db.add(new_user)
     await db.commit()
     
-    access_token = auth_utils.create_access_token(data={"sub": new_user.username})
+    access_token = auth_utils.create_access_token(data=auth_utils.user_token_claims(new_user))
     return {"access_token": access_token, "token_type": "bearer"}
 
 @auth_router.post("/token", response_model=schemas.Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(models.User).filter(models.User.username == form_data.username))
     user = result.scalars().first()
-    if not user or not auth_utils.verify_password(form_data.password, user.hashed_password):
+    if not user or not await auth_utils.verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=401, detail="用户名或密码错误")
-    access_token = auth_utils.create_access_token(data={"sub": user.username})
+    access_token = auth_utils.create_access_token(data=auth_utils.user_token_claims(user))
     return {"access_token": access_token, "token_type": "bearer"}
 
 # 2. 规则管理模块 (Admin)
 admin_router = APIRouter(prefix="/admin", tags=["Admin"])
 
 @admin_router.get("/rules", response_model=List[schemas.Rule])
-async def get_rules(admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+async def get_rules(admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(models.Rule).order_by(models.Rule.id.desc()))
     rules = result.scalars().all()
     for r in rules:
@@ -167,8 +301,31 @@ async def get_rules(admin: models.User = Depends(get_current_admin), db: AsyncSe
             r.patterns = [] 
     return rules
 
+@admin_router.get("/rules/page", response_model=schemas.RulePage)
+async def get_rules_page(
+    active: Optional[bool] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    admin: CurrentUser = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_db)
+):
+    """规则列表的键集分页版本：按 ID 倒序，可按启用状态筛选，只解析当前页的 patterns"""
+    keys = [models.Rule.id]
+    stmt = select(models.Rule)
+    if active is not None:
+        stmt = stmt.filter(models.Rule.active == active)
+    result = await db.execute(keyset_page(stmt, keys, cursor, limit, descending=True))
+    rules, next_cursor = split_page(result.scalars().all(), keys, limit)
+    for r in rules:
+        try:
+            r.patterns = json.loads(r.patterns)
+        except (json.JSONDecodeError, TypeError, ValueError) as e:
+            logger.warning(f"Failed to parse rule patterns: {e}")
+            r.patterns = [] 
+    return {"items": rules, "next_cursor": next_cursor}
+
 @admin_router.post("/rules", response_model=schemas.Rule)
-async def create_rule(rule: schemas.RuleCreate, admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+async def create_rule(rule: schemas.RuleCreate, admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     db_rule = models.Rule(
         patterns=json.dumps(rule.patterns, ensure_ascii=False),
         answer=rule.answer,
@@ -176,23 +333,166 @@ async def create_rule(rule: schemas.RuleCreate, admin: models.User = Depends(get
         active=rule.active
     )
     db.add(db_rule)
-    await db.commit()
+    await db.flush()
+    await rule_sync.publish_rule_change(db, db_rule, db_rule.id, "upsert")
     await db.refresh(db_rule)
-    await rule_service.load_rules_from_db(db)
     db_rule.patterns = json.loads(db_rule.patterns)
     return db_rule
 
+@admin_router.put("/rules/{rule_id}", response_model=schemas.Rule)
+async def update_rule(rule_id: int, update: schemas.RuleUpdate, admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """修改规则内容或启停状态，只增量更新这一条规则的缓存"""
+    result = await db.execute(select(models.Rule).filter(models.Rule.id == rule_id))
+    rule = result.scalars().first()
+    if not rule:
+        raise HTTPException(404, "规则不存在")
+    rule.patterns = json.dumps(update.patterns, ensure_ascii=False)
+    rule.answer = update.answer
+    rule.source = update.source
+    rule.active = update.active
+    await rule_sync.publish_rule_change(db, rule, rule_id, "upsert")
+    await db.refresh(rule)
+    rule.patterns = json.loads(rule.patterns)
+    return rule
+
 @admin_router.delete("/rules/{rule_id}")
-async def delete_rule(rule_id: int, admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+async def delete_rule(rule_id: int, admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(models.Rule).filter(models.Rule.id == rule_id))
     rule = result.scalars().first()
     if not rule:
         raise HTTPException(404, "规则不存在")
-    db.delete(rule)
-    await db.commit()
-    await rule_service.load_rules_from_db(db)
+    await db.delete(rule)
+    await rule_sync.publish_rule_change(db, None, rule_id, "delete")
     return {"status": "deleted"}
 
+@admin_router.get("/rule-candidates", response_model=schemas.RuleCandidatePage)
+async def get_rule_candidates(
+    status: Optional[str] = "pending",
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    admin: CurrentUser = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    候选规则审核列表：按 ID 倒序（新候选在前）分页，页内按窗口内提问次数倒序。
+    ask_count 每次晋升任务都会重写，不能作为游标键，否则跨一次刷新翻页会跳过或重复候选。
+    """
+    keys = [models.RuleCandidate.id]
+    stmt = select(models.RuleCandidate)
+    if status:
+        stmt = stmt.filter(models.RuleCandidate.status == status)
+    result = await db.execute(keyset_page(stmt, keys, cursor, limit, descending=True))
+    candidates, next_cursor = split_page(result.scalars().all(), keys, limit)
+    candidates.sort(key=lambda c: (c.ask_count or 0, c.id), reverse=True)
+    return {"items": candidates, "next_cursor": next_cursor}
+
+@admin_router.get("/rule-candidates/report")
+async def get_rule_candidate_report(admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """各状态候选规则数及预计可由规则引擎接管的流量占比（基于最近一次晋升任务的统计）"""
+    return await feedback_promotion.projection(db)
+
+@admin_router.post("/rule-candidates/refresh")
+async def refresh_rule_candidates(admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """立即运行一次好评答案晋升任务并返回报告"""
+    return await feedback_promotion.run_promotion(db)
+
+async def _pending_candidate(db: AsyncSession, candidate_id: int) -> models.RuleCandidate:
+    result = await db.execute(select(models.RuleCandidate).filter(models.RuleCandidate.id == candidate_id))
+    candidate = result.scalars().first()
+    if not candidate:
+        raise HTTPException(404, "候选规则不存在")
+    if candidate.status != "pending":
+        raise HTTPException(409, f"候选规则已处理（{candidate.status}）")
+    return candidate
+
+@admin_router.post("/rule-candidates/{candidate_id}/approve", response_model=schemas.RuleCandidate)
+async def approve_rule_candidate(
+    candidate_id: int,
+    body: Optional[schemas.RuleCandidateApprove] = None,
+    admin: CurrentUser = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_db)
+):
+    """审核通过：写入规则表（可修改匹配模式与答案），所有 worker 随规则同步生效"""
+    candidate = await _pending_candidate(db, candidate_id)
+    body = body or schemas.RuleCandidateApprove()
+    await feedback_promotion.approve_candidate(db, candidate, body.patterns, body.answer)
+    await db.refresh(candidate)
+    return candidate
+
+@admin_router.post("/rule-candidates/{candidate_id}/reject", response_model=schemas.RuleCandidate)
+async def reject_rule_candidate(candidate_id: int, admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """驳回：之后的晋升任务只更新统计，不会再把它列为待审核"""
+    candidate = await _pending_candidate(db, candidate_id)
+    candidate.status = "rejected"
+    await db.commit()
+    await db.refresh(candidate)
+    return candidate
+
+@admin_router.post("/corrections")
+async def submit_correction(correction: schemas.CorrectionCreate, admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """管理员纠正某条助手回答；纠正后的答案会在下一次晋升任务中成为候选规则"""
+    result = await db.execute(
+        select(models.Message).filter(models.Message.id == correction.message_id, models.Message.role == "assistant")
+    )
+    msg = result.scalars().first()
+    if not msg:
+        raise HTTPException(404, "Message not found")
+    msg.admin_correction = correction.correction_content
+    msg.is_corrected = True
+    await db.commit()
+    return {"status": "success"}
+
+# 统计接口只读 analytics_* 汇总表，由后台任务定期增量刷新（评分分布在提交评分时实时更新）
+
+@admin_router.get("/analytics/feedback")
+async def get_feedback_analytics(days: int = Query(30, ge=1, le=366), admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """评分分布：按回答档位，以及按引用来源（好评率最低的来源排在最前）"""
+    return await analytics.feedback_distribution(db, days)
+
+@admin_router.get("/analytics/messages")
+async def get_message_analytics(days: int = Query(30, ge=1, le=366), admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """每天的用户提问数、助手回复数及回复的档位分布"""
+    return await analytics.messages_per_day(db, days)
+
+@admin_router.get("/analytics/tickets")
+async def get_ticket_analytics(days: int = Query(30, ge=1, le=366), admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """每天新建工单数与待处理积压"""
+    return await analytics.ticket_backlog(db, days)
+
+@admin_router.get("/analytics/response-times")
+async def get_response_time_analytics(days: int = Query(30, ge=1, le=366), admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """整体与各回答档位的响应耗时中位数、p95"""
+    return await analytics.response_times(db, days)
+
+@admin_router.post("/analytics/refresh")
+async def refresh_analytics(admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    """立即增量刷新一次统计汇总表"""
+    return await analytics.refresh(db)
+
+@admin_router.get("/cache/stats")
+async def get_cache_stats(admin: CurrentUser = Depends(get_current_admin)):
+    """答案缓存、用户缓存与请求合并统计（当前 worker）"""
+    return {
+        "answer_cache": answer_cache.snapshot(), 
+        "user_cache": user_cache.snapshot(), 
+        "single_flight": single_flight.snapshot()
+    }
+
+@admin_router.get("/router/stats")
+async def get_router_stats(admin: CurrentUser = Depends(get_current_admin)):
+    """各回答档位（规则 / 缓存 / 单 Agent / 辩论 / 图片）的请求数与耗时（当前 worker）"""
+    return router_stats.snapshot()
+
+@admin_router.get("/llm/stats")
+async def get_llm_stats(admin: CurrentUser = Depends(get_current_admin)):
+    """LLM 调度器的并发、排队深度与排队等待时间（当前 worker）"""
+    return llm_scheduler.snapshot()
+
+@admin_router.get("/db/stats")
+async def get_db_stats(admin: CurrentUser = Depends(get_current_admin)):
+    """进程启动以来按类型统计的 SQL 语句条数（当前 worker）"""
+    return {"statements": dict(STATEMENT_COUNTS), "total": sum(STATEMENT_COUNTS.values())}
+
 # 3. 聊天与会话模块
 chat_router = APIRouter(tags=["Chat"])
 
@@ -219,13 +519,35 @@ async def get_session(session_id: str, db: AsyncSession = Depends(get_db)):
     session.messages = msg_result.scalars().all()
     return session
 
+@chat_router.get("/sessions/{session_id}/messages", response_model=schemas.MessagePage)
+async def get_session_messages(
+    session_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db)
+):
+    """会话消息的键集分页版本：按 (created_at, id) 正序，走 messages(session_id, created_at, id) 索引"""
+    keys = [models.Message.created_at, models.Message.id]
+    stmt = select(models.Message).filter(models.Message.session_id == session_id)
+    result = await db.execute(keyset_page(stmt, keys, cursor, limit))
+    messages, next_cursor = split_page(result.scalars().all(), keys, limit)
+    if not messages and not cursor:
+        exists = await db.execute(select(models.Session.id).filter(models.Session.id == session_id))
+        if exists.scalar() is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+    return {"items": messages, "next_cursor": next_cursor}
+
 @chat_router.post("/feedback/")
 async def submit_feedback(feedback: schemas.FeedbackCreate, db: AsyncSession = Depends(get_db)):
     try:
-        result = await db.execute(select(models.Message).filter(models.Message.id == feedback.message_id))
+        # 行锁：同一条消息的并发评分串行执行，评分汇总的增减不会错位
+        result = await db.execute(
+            select(models.Message).filter(models.Message.id == feedback.message_id).with_for_update()
+        )
         msg = result.scalars().first()
         if not msg:
             raise HTTPException(404, "Message not found")
+        await analytics.record_feedback(db, msg, msg.feedback_score, feedback.score)
         msg.feedback_score = feedback.score
         await db.commit()
         return {"status": "success"}
@@ -254,42 +576,16 @@ async def upload_file(request: Request, file: UploadFile = File(...)):
     if ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(400, f"不支持的文件类型: .{ext}")
 
-    # Validate file size (read file to check size)
-    file_size = 0
-    file_content = b""
-    chunk_size = 8192
-
-    try:
-        while True:
-            chunk = await file.read(chunk_size)
-            if not chunk:
-                break
-            file_size += len(chunk)
-            if file_size > MAX_FILE_SIZE:
-                raise HTTPException(413, f"文件不能超过 {MAX_FILE_SIZE // 1024 // 1024}MB")
-            file_content += chunk
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"文件读取失败: {e}")
-        raise HTTPException(500, "文件读取失败")
-
-    new_filename = f"{uuid.uuid4()}.{ext}"
-    file_path = f"static/uploads/{new_filename}"
-
-    try:
-        with open(file_path, "wb") as f:
-            f.write(file_content)
-    except Exception as e:
-        logger.error(f"文件上传失败: {e}")
-        raise HTTPException(500, "文件保存失败")
+    # 边接收边写入临时文件并计算哈希，按内容哈希命名；相同内容重复上传返回同一个 URL
+    stored = await stream_upload(file, ext, MAX_FILE_SIZE)
+    new_filename = os.path.basename(stored.path)
 
     base_url = str(request.base_url).rstrip("/")
     # Use proper URL joining instead of f-string
     return {"url": f"{base_url}/static/uploads/{new_filename}", "filename": new_filename}
 
 @misc_router.post("/tickets/", response_model=schemas.Ticket)
-async def create_ticket(ticket: schemas.TicketCreate, user: models.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+async def create_ticket(ticket: schemas.TicketCreate, user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     new_ticket = models.Ticket(
         user_id=user.id,
         title=ticket.title,
@@ -302,12 +598,29 @@ async def create_ticket(ticket: schemas.TicketCreate, user: models.User = Depend
     return new_ticket
 
 @misc_router.get("/admin/tickets", response_model=List[schemas.Ticket])
-async def get_all_tickets(admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+async def get_all_tickets(admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(models.Ticket).order_by(models.Ticket.created_at.desc()))
     return result.scalars().all()
 
+@misc_router.get("/admin/tickets/page", response_model=schemas.TicketPage)
+async def get_tickets_page(
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    admin: CurrentUser = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_db)
+):
+    """工单列表的键集分页版本：按 (created_at, id) 倒序，status 筛选在数据库侧完成"""
+    keys = [models.Ticket.created_at, models.Ticket.id]
+    stmt = select(models.Ticket)
+    if status:
+        stmt = stmt.filter(models.Ticket.status == status)
+    result = await db.execute(keyset_page(stmt, keys, cursor, limit, descending=True))
+    tickets, next_cursor = split_page(result.scalars().all(), keys, limit)
+    return {"items": tickets, "next_cursor": next_cursor}
+
 @misc_router.put("/admin/tickets/{ticket_id}", response_model=schemas.Ticket)
-async def reply_ticket(ticket_id: int, update: schemas.TicketUpdate, admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+async def reply_ticket(ticket_id: int, update: schemas.TicketUpdate, admin: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(models.Ticket).filter(models.Ticket.id == ticket_id))
     ticket = result.scalars().first()
     if not ticket:
@@ -322,20 +635,80 @@ async def reply_ticket(ticket_id: int, update: schemas.TicketUpdate, admin: mode
 
 @misc_router.post("/tts/")
 async def tts_endpoint(text: str = Form(...), dialect: str = Form(...)):
+    """按句分段并发合成，音频边合成边以 audio/mpeg 流返回；相同文本与音色的分段直接读磁盘缓存"""
     v_map = {
         "cantonese": "zh-HK-HiuGaaiNeural", 
         "sichuan": "zh-CN-Sichuan-YunxiNeural", 
         "mandarin": "zh-CN-XiaoxiaoNeural"
     }
-    url = await synthesize_dialect_audio(text, v_map.get(dialect, "zh-CN-XiaoxiaoNeural"))
-    if not url: 
+    if not text.strip():
+        raise HTTPException(400, "文本不能为空")
+    if len(text) > MAX_TTS_CHARS:
+        raise HTTPException(400, f"文本不能超过 {MAX_TTS_CHARS} 字")
+    try:
+        backend = tts_service.get_backend()
+    except tts_service.TTSError as e:
+        logger.error(f"TTS 后端不可用: {e}")
+        raise HTTPException(503, "语音服务暂不可用")
+    audio = tts_service.synthesize_stream(text, v_map.get(dialect, "zh-CN-XiaoxiaoNeural"))
+    # 先拿到第一段：失败时还能返回错误状态码，而不是一个中途断开的 200
+    try:
+        first_chunk = await audio.__anext__()
+    except Exception as e:
+        await audio.aclose()
+        logger.error(f"TTS Error: {e}")
         raise HTTPException(500, "TTS 生成失败")
-    return {"audio_url": url}
+
+    async def body():
+        yield first_chunk
+        try:
+            async for chunk in audio:
+                yield chunk
+        except Exception as e:
+            logger.error(f"TTS Error: {e}")
+        finally:
+            await audio.aclose()
+
+    return StreamingResponse(body(), media_type=backend.media_type)
+
+@admin_router.get("/tts/stats")
+async def get_tts_stats(admin: CurrentUser = Depends(get_current_admin)):
+    """TTS 后端与磁盘缓存命中统计（当前 worker）"""
+    return tts_service.cache_stats()
+
+async def forward_stream(websocket: WebSocket, session_id: str, history: list, user_input: dict) -> dict:
+    """把合成调用的 token 增量逐帧推给前端，返回完整结果供落库"""
+    started = time.perf_counter()
+    first_token_at = None
+    ai_res = None
+    # 客户端断开时 send_json 抛出异常：aclosing 立即关闭生成器，释放 LLM 调度名额与上游流，不必等垃圾回收
+    async with aclosing(stream_legal_response(history, user_input)) as events:
+        async for event in events:
+            if event["event"] == "delta":
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    logger.info(f"⏱️ 首 token 延迟 {(first_token_at - started) * 1000:.0f}ms: {session_id}")
+                await websocket.send_json({"role": "assistant", "type": "delta", "content": event["content"]})
+            else:
+                ai_res = event["result"]
+    return ai_res
 
 @app.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
+    # 会话不存在时拒绝握手：否则这条连接的每条消息都会违反外键约束
+    async with AsyncSessionLocal() as db:
+        exists = await db.execute(select(models.Session.id).filter(models.Session.id == session_id))
+    if exists.scalar() is None:
+        logger.warning(f"WebSocket rejected, session not found: {session_id}")
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
     logger.info(f"WebSocket connected: {session_id}")
+    metrics.WEBSOCKET_CONNECTIONS.inc()
+    # 每个连接维护最近 N 条消息的环形缓冲，每轮不再重新查询整段会话
+    history = SessionHistory(session_id)
+    # LLM 调度按会话公平排队；本连接内发起的调用（含 gather 出的子任务）都继承这个键
+    llm_session_key.set(session_id)
     try:
         while True:
             data = await websocket.receive_text()
@@ -348,51 +721,73 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
                 await websocket.send_json({"role": "system", "content": "错误：消息格式必须为 JSON 对象", "type": "error"})
                 continue
             
-            # 作用域内临时申请 DB Session
+            # 只有首轮需要查库加载历史
             async with AsyncSessionLocal() as db:
-                user_msg = models.Message(
-                    session_id=session_id, 
-                    role="user", 
-                    content=user_input.get("content", ""), 
-                    message_type=user_input.get("type", "text"), 
-                    media_url=user_input.get("url")
-                )
-                db.add(user_msg)
-                await db.commit()
-
-                hist_res = await db.execute(
-                    select(models.Message)
-                    .filter(models.Message.session_id == session_id)
-                    .order_by(models.Message.created_at)
-                )
-                history = hist_res.scalars().all()
-
-                try:
-                    ai_res = await get_legal_response(history, user_input)
-                except Exception as e:
-                    logger.error(f"AI Service Error: {e}")
-                    ai_res = {"content": "系统繁忙，请稍后再试。", "message_type": "text", "media_url": None}
-
-                ai_msg = models.Message(
-                    session_id=session_id, 
-                    role="assistant", 
-                    content=ai_res["content"], 
-                    message_type=ai_res["message_type"], 
-                    media_url=ai_res["media_url"], 
-                    citations=ai_res.get("citations")
-                )
-                db.add(ai_msg)
-                await db.commit()
-
-            # 发送给前端
-            await websocket.send_json({
+                await history.ensure_loaded(db)
+
+            # 消息插入交给合批写入器，与其它会话的写入合并为一条多行 INSERT；
+            # 用户消息的 ID 用不到，不等待落库，推理与首 token 不再被一次刷盘拖慢
+            user_content = user_input.get("content", "")
+            enqueue_message(
+                session_id=session_id, 
+                role="user", 
+                content=user_content, 
+                message_type=user_input.get("type", "text"), 
+                media_url=user_input.get("url")
+            )
+            history.append("user", user_content)
+
+            # 客户端在消息里带上 "stream": true 即开启逐 token 推送
+            streaming = bool(user_input.get("stream"))
+            turn_started = time.perf_counter()
+            try:
+                with metrics.CHAT_TURNS_IN_FLIGHT.track_inprogress():
+                    if streaming:
+                        ai_res = await forward_stream(websocket, session_id, history.window(), user_input)
+                    else:
+                        ai_res = await get_legal_response(history.window(), user_input)
+            except WebSocketDisconnect:
+                raise
+            except LLMQueueTimeout:
+                # 排队超时：明确告知用户，不把这次失败写成助手回复
+                await websocket.send_json({
+                    "role": "system", 
+                    "content": "当前咨询人数较多，请稍后重试。", 
+                    "type": "error", 
+                    "code": "queue_timeout"
+                })
+                continue
+            except Exception as e:
+                logger.error(f"AI Service Error: {e}")
+                ai_res = {"content": "系统繁忙，请稍后再试。", "message_type": "text", "media_url": None, "tier": "error"}
+
+            # durable 模式等待落库拿到 messageId；write_behind 模式立即返回 None
+            ai_msg_id = await save_message(
+                session_id=session_id, 
+                role="assistant", 
+                content=ai_res["content"], 
+                message_type=ai_res["message_type"], 
+                media_url=ai_res["media_url"], 
+                citations=ai_res.get("citations"),
+                tier=ai_res.get("tier"),
+                latency_ms=round((time.perf_counter() - turn_started) * 1000)
+            )
+            history.append("assistant", ai_res["content"])
+
+            # 发送给前端（流式模式下这是收尾帧，content 为完整回复）
+            reply = {
                 "role": "assistant", 
                 "content": ai_res["content"], 
                 "type": ai_res["message_type"], 
                 "mediaUrl": ai_res["media_url"],
                 "citations": ai_res.get("citations"),
-                "messageId": ai_msg.id
-            })
+                "messageId": ai_msg_id
+            }
+            if ai_res.get("incomplete"):
+                reply["incomplete"] = True
+            if streaming:
+                reply["done"] = True
+            await websocket.send_json(reply)
 
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected: {session_id}")
@@ -402,6 +797,8 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
             await websocket.close(code=1011)
         except RuntimeError as close_error:
             logger.warning(f"Failed to close WebSocket: {close_error}")
+    finally:
+        metrics.WEBSOCKET_CONNECTIONS.dec()
 
 app.include_router(auth_router)
 app.include_router(admin_router)
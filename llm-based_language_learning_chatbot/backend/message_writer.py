@@ -0,0 +1,146 @@
+import os
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from sqlalchemy import insert
+
+import models
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# 攒批参数：最多等待多少毫秒、一批最多多少行
+MESSAGE_FLUSH_INTERVAL_MS = float(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "20"))
+MESSAGE_FLUSH_BATCH_SIZE = int(os.getenv("MESSAGE_FLUSH_BATCH_SIZE", "100"))
+# durable：每轮对话等待自己的消息落库（仍与并发会话合批），回复中带 messageId
+# write_behind：不等待落库，回复更快，但 messageId 为空，进程崩溃可能丢失尚未刷盘的消息
+MESSAGE_WRITE_MODE = os.getenv("MESSAGE_WRITE_MODE", "durable").lower()
+
+_COLUMNS = ("session_id", "role", "content", "message_type", "media_url", "citations", "tier", "latency_ms", "created_at")
+
+
+class MessageWriter:
+    """
+    聊天消息的写后合批器：所有 WebSocket 连接的消息插入先进入队列，
+    由后台任务按时间或数量触发，用一条多行 INSERT ... RETURNING id 批量落库。
+    """
+
+    def __init__(self, session_factory, interval_ms: float = MESSAGE_FLUSH_INTERVAL_MS,
+                 batch_size: int = MESSAGE_FLUSH_BATCH_SIZE):
+        self._session_factory = session_factory
+        self._interval = interval_ms / 1000
+        self._batch_size = batch_size
+        self._queue: "asyncio.Queue[Tuple[dict, asyncio.Future]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def durable(self) -> bool:
+        return MESSAGE_WRITE_MODE != "write_behind"
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, **values) -> "asyncio.Future[int]":
+        """
+        排队插入一条消息，返回在落库后解析为消息 ID 的 Future。
+        created_at 在入队时确定，保证同一会话内消息顺序与提交顺序一致。
+        """
+        if self._closing:
+            raise RuntimeError("MessageWriter 已关闭")
+        # 多行 INSERT 要求每行列集合一致
+        values = {column: values.get(column) for column in _COLUMNS}
+        values["message_type"] = values["message_type"] or "text"
+        values["created_at"] = values["created_at"] or models.get_utc_now()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((values, future))
+        return future
+
+    async def close(self):
+        """lifespan 关闭时调用：停止接收新消息，把队列中剩余的消息全部刷盘"""
+        self._closing = True
+        if self._task is not None:
+            await self._queue.join()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        logger.info("💾 消息写入队列已清空")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _insert(self, rows: List[dict]) -> List[int]:
+        async with self._session_factory() as db:
+            result = await db.execute(
+                insert(models.Message).returning(models.Message.id, sort_by_parameter_order=True),
+                rows
+            )
+            ids = result.scalars().all()
+            await db.commit()
+        return ids
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        """
+        整批插入失败时对半拆分重试，直到定位出真正失败的行：
+        一条坏数据（如不存在的 session_id 触发外键约束）只让它自己失败，不连累同批其它会话的消息。
+        """
+        try:
+            ids = await self._insert([values for values, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                await self._flush(batch[:middle])
+                await self._flush(batch[middle:])
+                return
+            values, future = batch[0]
+            logger.error(f"❌ 消息写入失败 (session_id={values['session_id']}): {e}")
+            if not future.done():
+                future.set_exception(e)
+            return
+        for (_, future), message_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(message_id)
+
+
+def _log_write_failure(future: asyncio.Future):
+    """write_behind 模式下没人 await 的 Future，取走异常避免 'never retrieved' 警告"""
+    if not future.cancelled():
+        future.exception()
+
+
+def enqueue_message(**values):
+    """只入队不等待落库（不需要消息 ID 时使用）；created_at 在入队时确定，顺序与 await 的写入一致"""
+    message_writer.submit(**values).add_done_callback(_log_write_failure)
+
+
+async def save_message(**values) -> Optional[int]:
+    """按当前写入模式保存一条消息：durable 返回消息 ID，write_behind 立即返回 None"""
+    if not message_writer.durable:
+        enqueue_message(**values)
+        return None
+    return await message_writer.submit(**values)
+
+
+message_writer = MessageWriter(AsyncSessionLocal)
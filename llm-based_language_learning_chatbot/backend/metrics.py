@@ -0,0 +1,235 @@
+"""
+进程内指标，按 Prometheus 文本格式（0.0.4）由 GET /metrics 导出。
+不依赖 prometheus_client：只实现本项目用到的 Counter / Gauge / Histogram，
+以及抓取时才读取的回调指标（缓存命中、调度器队列等已有统计直接复用，不重复计数）。
+多 worker 部署时每个进程各自导出，由 Prometheus 按实例聚合。
+"""
+import math
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 通用耗时分桶（秒）：覆盖毫秒级的数据库提交到分钟级的辩论调用
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+# 规则匹配等纯内存操作的分桶
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05)
+
+# 回调指标的一条样本：(名称, 类型, 说明, [(标签, 值), ...])
+Sample = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and not self.labelnames:
+            # 无标签的计数器 / 仪表盘从 0 开始导出，抓取方不必等到第一次变化
+            items = [((), 0)]
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各桶计数..., sum]；桶计数非累积，导出时再累加
+                state = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """同步与 async 代码中均可用：with HISTOGRAM.time(label=...): ..."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], Iterable[Sample]]):
+        """抓取时调用 collector()，把已有的统计快照转成指标样本"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Optional[Sequence[float]] = None) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets or LATENCY_BUCKETS))
+
+
+# ==========================================
+# 指标定义（集中在此，便于对照 /metrics 输出）
+# ==========================================
+# 回答档位
+TIER_REQUESTS = counter("legal_tier_requests_total", "按回答档位（rule/cache/single/debate/vision）统计的请求数", ["tier"])
+TIER_LATENCY = histogram("legal_tier_latency_seconds", "各回答档位的端到端耗时", ["tier"])
+
+# 各阶段耗时
+RULE_MATCH_LATENCY = histogram("legal_rule_match_seconds", "规则引擎匹配耗时", buckets=FAST_BUCKETS)
+EMBEDDING_LATENCY = histogram("legal_embedding_seconds", "查询向量计算耗时（未命中向量缓存时的上游调用）")
+RETRIEVAL_LATENCY = histogram("legal_retrieval_seconds", "知识库混合检索（向量 + BM25 + RRF）耗时")
+DB_COMMIT_LATENCY = histogram("legal_db_commit_seconds", "数据库事务提交耗时")
+
+# 上游 LLM：每个 Agent 调用的耗时（不含排队）、失败数与 usage 中的 token 用量
+LLM_CALL_LATENCY = histogram("legal_llm_call_seconds", "上游 LLM 调用耗时（不含调度排队）", ["agent", "model"])
+LLM_CALL_ERRORS = counter("legal_llm_call_errors_total", "上游 LLM 调用失败次数", ["agent", "model"])
+LLM_TOKENS = counter("legal_llm_tokens_total", "上游返回的 usage token 用量", ["agent", "model", "kind"])
+LLM_QUEUE_WAIT = histogram("legal_llm_queue_wait_seconds", "LLM 调度器中的排队等待时间", ["priority"])
+
+# prompt 大小：按调用与分段统计 token 数，以及各分段因超出预算被截断的次数
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 12000, 16000, 32000)
+PROMPT_TOKENS = histogram("legal_prompt_tokens", "每次上游调用的输入 token 数（tiktoken 计数）", ["agent"], TOKEN_BUCKETS)
+PROMPT_SECTION_TOKENS = histogram("legal_prompt_section_tokens", "prompt 各分段裁剪后的 token 数", ["section"], TOKEN_BUCKETS)
+PROMPT_TRUNCATIONS = counter("legal_prompt_truncations_total", "prompt 分段因超出预算被截断或丢弃片段的次数", ["section"])
+
+# 连接与进行中的请求
+WEBSOCKET_CONNECTIONS = gauge("legal_websocket_connections", "当前打开的 WebSocket 连接数")
+CHAT_TURNS_IN_FLIGHT = gauge("legal_chat_turns_in_flight", "正在生成回复的对话轮数")
+HTTP_REQUESTS_IN_FLIGHT = gauge("legal_http_requests_in_flight", "正在处理的 HTTP 请求数")
+
+
+def record_usage(agent: str, model: str, usage) -> Optional[int]:
+    """把 completion 的 usage 计入 token 计数器，返回 total_tokens（无 usage 时为 None）"""
+    if usage is None:
+        return None
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    completion = getattr(usage, "completion_tokens", 0) or 0
+    LLM_TOKENS.inc(prompt, agent=agent, model=model, kind="prompt")
+    LLM_TOKENS.inc(completion, agent=agent, model=model, kind="completion")
+    return getattr(usage, "total_tokens", None) or prompt + completion
+
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,29 @@
+"""分页查询所需的复合索引
+
+Revision ID: 0001_pagination_indexes
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = "0001_pagination_indexes"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# 表由应用启动时的 create_all 创建，新库上索引可能已经存在，因此都带 if_not_exists
+INDEXES = [
+    ("ix_messages_session_id_created_at", "messages", ["session_id", "created_at", "id"]),
+    ("ix_tickets_status_created_at", "tickets", ["status", "created_at", "id"]),
+    ("ix_tickets_created_at", "tickets", ["created_at", "id"]),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, if_not_exists=True)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,40 @@
+"""messages 增加回答档位与响应耗时列（统计汇总使用）
+
+Revision ID: 0002_message_tier_latency
+Revises: 0001_pagination_indexes
+Create Date: 2026-10-17
+"""
+import sqlalchemy as sa
+from alembic import context, op
+
+revision = "0002_message_tier_latency"
+down_revision = "0001_pagination_indexes"
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    sa.Column("tier", sa.String(), nullable=True),
+    sa.Column("latency_ms", sa.Integer(), nullable=True),
+]
+
+
+def _existing_columns(offline_default):
+    # 只生成 SQL（--sql）时无法检查数据库，按 offline_default 处理
+    if context.is_offline_mode():
+        return offline_default
+    return {c["name"] for c in sa.inspect(op.get_bind()).get_columns("messages")}
+
+
+def upgrade():
+    # 汇总表是新表，由应用启动时的 create_all 创建；已有的 messages 表只能由迁移补列
+    existing = _existing_columns(set())
+    for column in COLUMNS:
+        if column.name not in existing:
+            op.add_column("messages", column)
+
+
+def downgrade():
+    existing = _existing_columns({column.name for column in COLUMNS})
+    for column in reversed(COLUMNS):
+        if column.name in existing:
+            op.drop_column("messages", column.name)
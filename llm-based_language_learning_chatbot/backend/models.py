@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Float
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Date, DateTime, ForeignKey, Boolean, Float, Index
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime, timezone
@@ -41,9 +41,17 @@ class Message(Base):
     feedback_score = Column(Integer, nullable=True) 
     admin_correction = Column(Text, nullable=True) 
     is_corrected = Column(Boolean, default=False)   
+    # 助手回复的回答档位（rule / cache / single / debate / vision）与本轮端到端耗时，供统计汇总使用
+    tier = Column(String, nullable=True)
+    latency_ms = Column(Integer, nullable=True)
 
     session = relationship("Session", back_populates="messages")
 
+    # 会话内按时间分页 / 取最近 N 条历史
+    __table_args__ = (
+        Index("ix_messages_session_id_created_at", "session_id", "created_at", "id"),
+    )
+
 class Ticket(Base):
     __tablename__ = "tickets"
     id = Column(Integer, primary_key=True, index=True)
@@ -61,6 +69,12 @@ class Ticket(Base):
 
     user = relationship("User", foreign_keys=[user_id], back_populates="tickets")
 
+    # 工单列表按状态筛选、按创建时间倒序分页
+    __table_args__ = (
+        Index("ix_tickets_status_created_at", "status", "created_at", "id"),
+        Index("ix_tickets_created_at", "created_at", "id"),
+    )
+
 class Rule(Base):
     __tablename__ = "rules"
     id = Column(Integer, primary_key=True, index=True)
@@ -68,4 +82,76 @@ class Rule(Base):
     answer = Column(Text)   
     source = Column(String) 
     active = Column(Boolean, default=True) 
-    created_at = Column(DateTime, default=get_utc_now)
\ No newline at end of file
+    created_at = Column(DateTime, default=get_utc_now)
+
+class RuleCandidate(Base):
+    """由用户好评 / 管理员纠正的回答归纳出的候选规则，管理员审核通过后写入 rules 表"""
+    __tablename__ = "rule_candidates"
+    id = Column(Integer, primary_key=True, index=True)
+    question_key = Column(String, unique=True, index=True)  # normalize_query 后的问题
+    question = Column(Text)  # 最近一次的原始提问，用于展示和生成匹配模式
+    answer = Column(Text)
+    origin = Column(String)  # feedback / correction
+    positive_votes = Column(Integer, default=0)
+    negative_votes = Column(Integer, default=0)
+    ask_count = Column(Integer, default=0)  # 统计窗口内被问到的次数
+    traffic_share = Column(Float, default=0.0)  # 占统计窗口内文本提问的比例
+    status = Column(String, default="pending")  # pending / approved / rejected
+    rule_id = Column(Integer, ForeignKey("rules.id"), nullable=True)
+    created_at = Column(DateTime, default=get_utc_now)
+    updated_at = Column(DateTime, default=get_utc_now, onupdate=get_utc_now)
+
+    # 审核列表按状态筛选、按 ID 倒序分页（ask_count 会被晋升任务反复改写，不做游标键）
+    __table_args__ = (
+        Index("ix_rule_candidates_status_id", "status", "id"),
+    )
+
+class RuleChange(Base):
+    """规则变更日志：自增 ID 即规则缓存版本号，供各 worker 轮询增量同步"""
+    __tablename__ = "rule_changes"
+    id = Column(Integer, primary_key=True, index=True)
+    rule_id = Column(Integer, index=True)
+    op = Column(String)  # upsert / delete
+    created_at = Column(DateTime, default=get_utc_now)
+
+# ==========================================
+# 统计汇总表：由 analytics.refresh 增量维护，管理后台只读这些表
+# ==========================================
+class AnalyticsDailyMessages(Base):
+    """每天各角色、各回答档位的消息数"""
+    __tablename__ = "analytics_daily_messages"
+    day = Column(Date, primary_key=True)
+    role = Column(String, primary_key=True)
+    tier = Column(String, primary_key=True)  # 非助手消息或未知档位为空串
+    count = Column(BigInteger, default=0)
+
+class AnalyticsLatency(Base):
+    """每天各回答档位的响应耗时分桶计数，中位数 / 分位数由分桶估算"""
+    __tablename__ = "analytics_latency"
+    day = Column(Date, primary_key=True)
+    tier = Column(String, primary_key=True)
+    bucket_ms = Column(Integer, primary_key=True)  # 桶上界（毫秒）
+    count = Column(BigInteger, default=0)
+
+class AnalyticsFeedback(Base):
+    """按回复日期、回答档位、引用来源统计的评分分布；一条回复引用多个来源时每个来源各计一次"""
+    __tablename__ = "analytics_feedback"
+    day = Column(Date, primary_key=True)
+    tier = Column(String, primary_key=True)
+    source = Column(String, primary_key=True)
+    score = Column(Integer, primary_key=True)
+    count = Column(BigInteger, default=0)
+
+class AnalyticsTicketDaily(Base):
+    """每天新建的工单数，以及当天最后一次刷新时的待处理工单数（积压快照）"""
+    __tablename__ = "analytics_ticket_daily"
+    day = Column(Date, primary_key=True)
+    created = Column(BigInteger, default=0)
+    pending = Column(BigInteger, nullable=True)
+
+class AnalyticsState(Base):
+    """增量刷新的水位线（已汇总到的最大 ID 等）"""
+    __tablename__ = "analytics_state"
+    name = Column(String, primary_key=True)
+    value = Column(BigInteger, default=0)
+    updated_at = Column(DateTime, default=get_utc_now, onupdate=get_utc_now)
@@ -0,0 +1,63 @@
+import json
+import base64
+import binascii
+from datetime import datetime
+from typing import Any, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+# 单页条数默认值与上限
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(*values: Any) -> str:
+    """把排序键（如 created_at, id）编码为不透明的游标字符串"""
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, types: Sequence[type]) -> Tuple:
+    """解析游标，按 types 还原各排序键；游标被篡改或格式不符时返回 400"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError("cursor arity")
+        return tuple(
+            datetime.fromisoformat(v) if t is datetime else t(v)
+            for v, t in zip(values, types)
+        )
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise HTTPException(400, "无效的分页游标")
+
+
+def keyset_page(stmt, columns: Sequence, cursor: Optional[str], limit: int, descending: bool = False):
+    """
+    给查询加上键集分页：WHERE (c1, c2) > (:v1, :v2) ORDER BY c1, c2 LIMIT n + 1。
+    与 OFFSET 不同，翻到第几页都只扫描一页数据（配合 (…, c1, c2) 复合索引）。
+    多取 1 条用来判断是否还有下一页。
+    """
+    if cursor:
+        values = decode_cursor(cursor, [_python_type(c) for c in columns])
+        key = tuple_(*columns)
+        stmt = stmt.where(key < tuple_(*values) if descending else key > tuple_(*values))
+    order = [c.desc() if descending else c.asc() for c in columns]
+    return stmt.order_by(*order).limit(limit + 1)
+
+
+def split_page(rows: List, columns: Sequence, limit: int) -> Tuple[List, Optional[str]]:
+    """截掉探测用的第 limit + 1 条，并用本页最后一条生成 next_cursor"""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(*(getattr(last, c.key) for c in columns))
+
+
+def _python_type(column) -> type:
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return str
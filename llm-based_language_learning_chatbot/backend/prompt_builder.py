@@ -0,0 +1,210 @@
+import os
+import re
+import logging
+import threading
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+from metrics import PROMPT_SECTION_TOKENS, PROMPT_TOKENS, PROMPT_TRUNCATIONS
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# 配置：整体输入预算与各分段上限（单位均为 token）
+# ==========================================
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "8000"))
+PROMPT_QUERY_MAX_TOKENS = int(os.getenv("PROMPT_QUERY_MAX_TOKENS", "1000"))
+PROMPT_DOCS_MAX_TOKENS = int(os.getenv("PROMPT_DOCS_MAX_TOKENS", "3000"))
+PROMPT_OPINION_MAX_TOKENS = int(os.getenv("PROMPT_OPINION_MAX_TOKENS", "800"))
+PROMPT_HISTORY_MAX_TOKENS = int(os.getenv("PROMPT_HISTORY_MAX_TOKENS", "1500"))
+# 分词器：默认按 LLM_MODEL 选择编码，也可直接指定编码名（如 o200k_base）
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "")
+PROMPT_TOKEN_CACHE_SIZE = int(os.getenv("PROMPT_TOKEN_CACHE_SIZE", "4096"))
+
+# 每条 chat 消息的格式开销（role、分隔符）
+MESSAGE_OVERHEAD_TOKENS = 4
+TRUNCATED_MARK = "…（已截断）"
+
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+
+# ==========================================
+# 1. 分词与计数
+# ==========================================
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：汉字约 1 个 token，其余字符约 4 个一个 token（tiktoken 不可用时的退路）"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """首次使用时加载 tiktoken 编码；未安装或编码文件下载失败时退化为估算并记录一次警告"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+
+                    if PROMPT_TOKENIZER:
+                        _encoding = tiktoken.get_encoding(PROMPT_TOKENIZER)
+                    else:
+                        try:
+                            _encoding = tiktoken.encoding_for_model(os.getenv("LLM_MODEL", "gpt-4o"))
+                        except KeyError:
+                            _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    logger.warning(f"tiktoken 不可用，按字符估算 token 数: {e}")
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+@lru_cache(maxsize=PROMPT_TOKEN_CACHE_SIZE)
+def count_tokens(text: str) -> int:
+    """
+    文本的 token 数。结果按文本缓存：系统提示词、检索到的法条、历史消息在多轮、多个 Agent 之间
+    反复出现，同一片段只分词一次。
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode_ordinary(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """截断到不超过 max_tokens（含截断标记）；放不下标记时返回空串"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    room = max_tokens - count_tokens(TRUNCATED_MARK)
+    if room <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        # errors="ignore"：截断点落在多字节字符中间时丢弃残缺的字节
+        return encoding.decode(encoding.encode_ordinary(text)[:room], errors="ignore") + TRUNCATED_MARK
+    # 估算模式：二分查找最长的合规前缀
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= room:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + TRUNCATED_MARK
+
+
+# ==========================================
+# 2. 分段与按优先级截断
+# ==========================================
+class Section:
+    """
+    prompt 中的一段。多片段的分段（检索文档、历史消息）超限时整片丢弃：
+    文档从排名最低的末尾丢，历史从最早的一条丢；只剩一片仍超限时再截断这一片的文本。
+    """
+
+    def __init__(self, name: str, pieces: Sequence[str], cap: int, drop_oldest: bool = False,
+                 roles: Optional[Sequence[str]] = None, piece_overhead: int = 0):
+        self.name = name
+        self.pieces = [p for p in pieces if p]
+        self.roles = [r for r, p in zip(roles, pieces) if p] if roles is not None else None
+        self.cap = cap
+        self.drop_oldest = drop_oldest
+        self.piece_overhead = piece_overhead
+        self.truncated = False
+
+    def tokens(self) -> int:
+        return sum(count_tokens(p) + self.piece_overhead for p in self.pieces)
+
+    def fit(self, limit: int):
+        total = self.tokens()
+        if total <= limit:
+            return
+        self.truncated = True
+        index = 0 if self.drop_oldest else -1
+        while self.pieces and total > limit:
+            if len(self.pieces) > 1:
+                total -= count_tokens(self.pieces.pop(index)) + self.piece_overhead
+                if self.roles is not None:
+                    self.roles.pop(index)
+                continue
+            self.pieces[0] = truncate_tokens(self.pieces[0], limit - self.piece_overhead)
+            if not self.pieces[0]:
+                self.pieces.clear()
+                if self.roles is not None:
+                    self.roles.clear()
+            break
+
+
+def _fit_sections(sections: List[Section], fixed: int, budget: int, agent: str):
+    """
+    先把每段裁到各自上限，再按列表顺序（优先级从高到低）分配剩余预算：
+    高优先级的分段完整保留，预算不足时由低优先级的分段承担截断，必要时整段丢弃。
+    fixed 为系统提示词、模板文字与消息格式的开销，不参与截断。
+    """
+    remaining = budget - fixed
+    total = fixed
+    for section in sections:
+        section.fit(min(section.cap, max(0, remaining)))
+        used = section.tokens()
+        remaining -= used
+        total += used
+        PROMPT_SECTION_TOKENS.observe(used, section=section.name)
+        if section.truncated:
+            PROMPT_TRUNCATIONS.inc(section=section.name)
+    # 由各段计数累加得到，不再对拼好的整段 prompt 重新分词
+    PROMPT_TOKENS.observe(total, agent=agent)
+
+
+def _fixed_tokens(*texts: str, messages: int) -> int:
+    return sum(count_tokens(t) for t in texts) + messages * MESSAGE_OVERHEAD_TOKENS
+
+
+# ==========================================
+# 3. 各类调用的 prompt
+# ==========================================
+def build_agent_messages(system_prompt: str, docs: Sequence[str], user_query: str, agent: str,
+                         budget: int = PROMPT_MAX_TOKENS) -> list:
+    """单 Agent / 律师 / 法官调用：系统提示词 + 检索依据 + 用户问题。优先级：问题 > 检索文档"""
+    header, separator = "【案件背景与法律依据】\n", "\n\n【用户问题】\n"
+    query = Section("query", [user_query], PROMPT_QUERY_MAX_TOKENS)
+    context = Section("docs", docs, PROMPT_DOCS_MAX_TOKENS, piece_overhead=1)
+    _fit_sections([query, context], _fixed_tokens(system_prompt, header, separator, messages=2), budget, agent)
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"{header}{chr(10).join(context.pieces)}{separator}{''.join(query.pieces)}"}
+    ]
+
+
+def build_synthesis_messages(system_prompt: str, docs: Sequence[str], lawyer_reply: str, judge_reply: str,
+                             history: Sequence, user_query: str, budget: int = PROMPT_MAX_TOKENS) -> list:
+    """
+    辩论收尾的合成调用：系统提示词 + 历史消息 + 检索依据、律师与法官观点 + 用户问题。
+    优先级：问题 > 检索文档 > 律师观点 > 法官观点 > 历史消息。
+    """
+    labels = ("上下文参考：\n【RAG检索依据】:\n", "\n\n【激进律师观点】:\n", "\n\n【保守法官观点】:\n", "\n\n当前用户问题：")
+    query = Section("query", [user_query], PROMPT_QUERY_MAX_TOKENS)
+    context = Section("docs", docs, PROMPT_DOCS_MAX_TOKENS, piece_overhead=1)
+    lawyer = Section("lawyer", [lawyer_reply], PROMPT_OPINION_MAX_TOKENS)
+    judge = Section("judge", [judge_reply], PROMPT_OPINION_MAX_TOKENS)
+    past = Section("history", [m.content for m in history], PROMPT_HISTORY_MAX_TOKENS, drop_oldest=True,
+                   roles=[m.role for m in history], piece_overhead=MESSAGE_OVERHEAD_TOKENS)
+    _fit_sections([query, context, lawyer, judge, past], _fixed_tokens(system_prompt, *labels, messages=2), budget, "synthesis")
+
+    messages = [{"role": "system", "content": system_prompt}]
+    messages.extend({"role": role, "content": content} for role, content in zip(past.roles, past.pieces))
+    synthesis_context = (
+        f"{labels[0]}{chr(10).join(context.pieces)}{labels[1]}{''.join(lawyer.pieces)}"
+        f"{labels[2]}{''.join(judge.pieces)}{labels[3]}{''.join(query.pieces)}"
+    )
+    messages.append({"role": "user", "content": synthesis_context})
+    return messages
@@ -0,0 +1,148 @@
+import os
+import re
+import math
+import threading
+from collections import deque
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from metrics import TIER_LATENCY, TIER_REQUESTS
+
+# ==========================================
+# 分级路由：决定一个文本问题走单 Agent（一次调用）还是 Multi-Agent 辩论（三次调用）
+# ==========================================
+TIER_SINGLE = "single"
+TIER_DEBATE = "debate"
+
+# 复杂度得分 + 检索不确定度加权 >= 阈值时进入辩论
+ROUTER_DEBATE_THRESHOLD = float(os.getenv("ROUTER_DEBATE_THRESHOLD", "3.0"))
+# 检索置信度的权重：知识库命中越明确，越不需要辩论
+ROUTER_RAG_WEIGHT = float(os.getenv("ROUTER_RAG_WEIGHT", "1.5"))
+# 路由实现：scoring（默认，打分规则）/ legacy（原长度 + 关键词启发式）/ single / debate（固定档位）
+QUERY_ROUTER = os.getenv("QUERY_ROUTER", "scoring").lower()
+
+# 需要权衡多方观点的诉讼、纠纷类用语
+_DISPUTE_TERMS = (
+    "起诉", "诉讼", "仲裁", "上诉", "申诉", "维权", "纠纷", "赔偿", "违约", "侵权",
+    "索赔", "追讨", "欠薪", "工伤", "离婚", "抚养", "继承", "遗产", "判决", "执行",
+)
+# 说明存在具体案情、需要分析责任的用语
+_FACT_TERMS = ("合同", "协议", "公司", "老板", "房东", "对方", "签了", "已经", "但是", "结果", "导致")
+# 明确的多问、条件、比较句式
+_MULTI_ASK_RE = re.compile(r"[？?]|还是|如果|假如|是否|以及|并且|同时|另外")
+_AMOUNT_RE = re.compile(r"\d+(?:\.\d+)?\s*(?:万|千|元|块|个月|年|天)")
+
+
+class RouteDecision(NamedTuple):
+    tier: str
+    score: float
+    reasons: List[str]
+
+
+def complexity_score(text: str) -> Tuple[float, List[str]]:
+    """本地打分规则：每类信号封顶，避免单一信号（如长度）主导"""
+    reasons = []
+    score = 0.0
+    disputes = sum(term in text for term in _DISPUTE_TERMS)
+    if disputes:
+        score += min(disputes, 2) * 1.0
+        reasons.append(f"dispute×{disputes}")
+    facts = sum(term in text for term in _FACT_TERMS)
+    if facts:
+        score += min(facts, 3) * 0.5
+        reasons.append(f"facts×{facts}")
+    asks = len(_MULTI_ASK_RE.findall(text))
+    if asks > 1:
+        score += min(asks - 1, 2) * 0.5
+        reasons.append(f"asks×{asks}")
+    if _AMOUNT_RE.search(text):
+        score += 0.5
+        reasons.append("amount")
+    # 长度只按对数计分：60 字以内不加分，之后每翻倍 +0.5
+    if len(text) > 60:
+        score += min(math.log2(len(text) / 60) * 0.5 + 0.5, 1.5)
+        reasons.append(f"len={len(text)}")
+    return score, reasons
+
+
+class ScoringRouter:
+    def __init__(self, threshold: float = ROUTER_DEBATE_THRESHOLD, rag_weight: float = ROUTER_RAG_WEIGHT):
+        self.threshold = threshold
+        self.rag_weight = rag_weight
+
+    def route(self, text: str, rag_confidence: float) -> RouteDecision:
+        score, reasons = complexity_score(text)
+        uncertainty = (1.0 - rag_confidence) * self.rag_weight
+        score += uncertainty
+        reasons.append(f"rag={rag_confidence:.2f}")
+        return RouteDecision(TIER_DEBATE if score >= self.threshold else TIER_SINGLE, round(score, 2), reasons)
+
+
+class LegacyRouter:
+    """原 _is_complex 启发式，保留用于对比"""
+
+    def route(self, text: str, rag_confidence: float) -> RouteDecision:
+        complex_ = len(text) > 15 or "起诉" in text or "怎么办" in text or "合同" in text
+        return RouteDecision(TIER_DEBATE if complex_ else TIER_SINGLE, 1.0 if complex_ else 0.0, ["legacy"])
+
+
+class FixedRouter:
+    def __init__(self, tier: str):
+        self.tier = tier
+
+    def route(self, text: str, rag_confidence: float) -> RouteDecision:
+        return RouteDecision(self.tier, 0.0, ["fixed"])
+
+
+ROUTERS: Dict[str, Callable[[], object]] = {
+    "scoring": ScoringRouter,
+    "legacy": LegacyRouter,
+    TIER_SINGLE: lambda: FixedRouter(TIER_SINGLE),
+    TIER_DEBATE: lambda: FixedRouter(TIER_DEBATE),
+}
+
+_router = ROUTERS.get(QUERY_ROUTER, ScoringRouter)()
+
+
+def set_router(router):
+    """替换路由实现（任何带 route(text, rag_confidence) -> RouteDecision 方法的对象）"""
+    global _router
+    _router = router
+
+
+def route_query(text: str, rag_confidence: float) -> RouteDecision:
+    return _router.route(text, rag_confidence)
+
+
+# ==========================================
+# 分档统计：各档位请求数与耗时，用于调整阈值
+# ==========================================
+class RouterStats:
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._window = window
+        self._counts: Dict[str, int] = {}
+        self._latencies: Dict[str, deque] = {}
+
+    def observe(self, tier: str, seconds: float):
+        with self._lock:
+            self._counts[tier] = self._counts.get(tier, 0) + 1
+            self._latencies.setdefault(tier, deque(maxlen=self._window)).append(seconds * 1000)
+        TIER_REQUESTS.inc(tier=tier)
+        TIER_LATENCY.observe(seconds, tier=tier)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = sum(self._counts.values())
+            tiers = {}
+            for tier, count in self._counts.items():
+                samples = sorted(self._latencies[tier])
+                tiers[tier] = {
+                    "count": count,
+                    "share": round(count / total, 4),
+                    "p50_ms": round(samples[len(samples) // 2], 1),
+                    "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1),
+                }
+            return {"router": type(_router).__name__, "threshold": getattr(_router, "threshold", None), "tiers": tiers}
+
+
+router_stats = RouterStats()
@@ -1,101 +1,263 @@
-import chromadb
-from chromadb.utils import embedding_functions
 import os
-import uuid
-import json
 import logging
+import threading
+from answer_cache import answer_cache
+from embedding_cache import embedding_cache
+from ingest import document_id, ingest_documents, ingest_file
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from metrics import EMBEDDING_LATENCY
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 初始化 ChromaDB (本地持久化)
+# ChromaDB 本地持久化目录；客户端、向量函数与集合都在首次使用时才创建，
+# 导入本模块不再有打开数据库、加载模型之类的副作用
 CHROMA_DATA_PATH = "./chroma_db"
-client = chromadb.PersistentClient(path=CHROMA_DATA_PATH)
-
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    logger.error("无 OpenAI Key，RAG 服务将不可用")
-    logger.warning("未检测到 OPENAI_API_KEY，RAG 功能将无法正常工作。")
-    openai_ef = None
-else:
-    # 【修复重点】：这里必须要有缩进！
-    openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-        api_key=api_key or "sk-placeholder", 
-        model_name="text-embedding-3-small"
-    )
 
-# 获取或创建集合
-collection = client.get_or_create_collection(
-    name="legal_knowledge",
-    embedding_function=openai_ef if openai_ef else None
-)
+# ==========================================
+# 向量后端：openai（默认，有 Key 时）/ local（本地 SentenceTransformer，离线可用）/ none（仅词法检索）
+# ==========================================
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "BAAI/bge-small-zh-v1.5")
+# 本地词法索引（BM25），不依赖任何向量服务
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", os.path.join(CHROMA_DATA_PATH, "lexical_index.pkl"))
+# hybrid（向量 + 词法，RRF 融合）/ vector / lexical
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").lower()
+RRF_K = 60
+# 检索置信度的向量相似度区间：第一名文档的余弦相似度 <= FLOOR 记 0，>= CEIL 记 1，之间线性插值
+RAG_VECTOR_CONFIDENCE_FLOOR = float(os.getenv("RAG_VECTOR_CONFIDENCE_FLOOR", "0.3"))
+RAG_VECTOR_CONFIDENCE_CEIL = float(os.getenv("RAG_VECTOR_CONFIDENCE_CEIL", "0.75"))
+# 词法检索：BM25 分数达到查询参照满分的该比例即记 1（口语化提问里的虚词也计入参照满分，很难全部覆盖）
+RAG_LEXICAL_CONFIDENCE_CEIL = float(os.getenv("RAG_LEXICAL_CONFIDENCE_CEIL", "0.5"))
+
+EMBEDDING_BACKEND = None
+EMBEDDING_MODEL = None
+openai_ef = None
+collection = None
+lexical_index = None
+
+_init_lock = threading.Lock()
+_backend_loaded = False
+_ready = threading.Event()
+
+def _load_embedding_function():
+    """按 EMBEDDING_BACKEND 创建向量函数，返回 (backend, model_name, embedding_function)"""
+    from chromadb.utils import embedding_functions
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    backend = os.getenv("EMBEDDING_BACKEND", "openai" if api_key else "none").lower()
+    if backend == "openai":
+        if not api_key:
+            logger.error("无 OpenAI Key，向量检索将不可用")
+            logger.warning("未检测到 OPENAI_API_KEY，RAG 将仅使用本地词法检索。")
+            return "none", None, None
+        # 【修复重点】：这里必须要有缩进！
+        model = "text-embedding-3-small"
+        # 与聊天客户端共用 OPENAI_BASE_URL（代理、兼容服务或本地替身）
+        return backend, model, embedding_functions.OpenAIEmbeddingFunction(
+            api_key=api_key or "sk-placeholder", 
+            model_name=model,
+            api_base=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+        )
+    if backend == "local":
+        try:
+            return backend, LOCAL_EMBEDDING_MODEL, embedding_functions.SentenceTransformerEmbeddingFunction(
+                model_name=LOCAL_EMBEDDING_MODEL
+            )
+        except Exception as e:
+            logger.warning(f"本地向量模型加载失败（需要安装 sentence-transformers），RAG 将仅使用词法检索: {e}")
+    return "none", None, None
+
+def _ensure_backend():
+    """首次使用时创建 Chroma 客户端、向量函数、集合并加载词法索引（线程安全，只执行一次）"""
+    global EMBEDDING_BACKEND, EMBEDDING_MODEL, openai_ef, collection, lexical_index, _backend_loaded
+    if _backend_loaded:
+        return
+    with _init_lock:
+        if _backend_loaded:
+            return
+        EMBEDDING_BACKEND, EMBEDDING_MODEL, openai_ef = _load_embedding_function()
+        if openai_ef:
+            import chromadb
+            client = chromadb.PersistentClient(path=CHROMA_DATA_PATH)
+            # 获取或创建集合；不同向量模型维度不同，本地模型使用单独的集合
+            collection = client.get_or_create_collection(
+                name="legal_knowledge" if EMBEDDING_BACKEND == "openai" else f"legal_knowledge_{EMBEDDING_BACKEND}",
+                embedding_function=openai_ef
+            )
+        lexical_index = LexicalIndex.load(LEXICAL_INDEX_PATH)
+        _backend_loaded = True
+
+def get_collection():
+    _ensure_backend()
+    return collection
+
+def get_lexical_index() -> LexicalIndex:
+    _ensure_backend()
+    return lexical_index
+
+def is_ready() -> bool:
+    """知识库是否已完成初始化；未就绪时检索直接返回空，请求不会被冷启动阻塞"""
+    return _ready.is_set()
+
+def save_lexical_index():
+    _ensure_backend()
+    if lexical_index.dirty:
+        os.makedirs(os.path.dirname(LEXICAL_INDEX_PATH) or ".", exist_ok=True)
+        lexical_index.save(LEXICAL_INDEX_PATH)
+
+def document_count() -> int:
+    _ensure_backend()
+    return collection.count() if collection is not None else len(lexical_index)
 
 def add_legal_document(content: str, source: str):
     try:
-        doc_id = str(uuid.uuid4())
-        collection.add(
-            documents=[content],
-            metadatas=[{"source": source}],
-            ids=[doc_id]
-        )
-        return doc_id
+        _ensure_backend()
+        stats = ingest_documents(collection, [{"content": content, "source": source}], lexical_index=lexical_index)
+        if stats["added"]:
+            save_lexical_index()
+            answer_cache.invalidate("(知识库新增文档)")
+        return document_id(content, source)
     except Exception as e:
         logger.error(f"添加文档失败: {e}")
         return None
 
-def search_knowledge(query: str, n_results: int = 3):
+def embed_query(query: str):
+    """计算查询向量（先查两级向量缓存），无可用向量函数时返回 None"""
+    _ensure_backend()
+    if not openai_ef:
+        return None
+    return embedding_cache.get_or_compute(EMBEDDING_MODEL, query, _compute_embedding)
+
+def _compute_embedding(query: str):
+    with EMBEDDING_LATENCY.time():
+        return openai_ef([query])[0]
+
+def _vector_quality(distance: float) -> float:
+    """
+    Chroma 默认 L2 距离 -> 余弦相似度（单位向量下 d² = 2 - 2cos；OpenAI 向量已归一化，bge 输出接近单位长度），
+    再按 FLOOR / CEIL 映射到 [0, 1]
+    """
+    cosine = 1.0 - distance / 2.0
+    span = max(RAG_VECTOR_CONFIDENCE_CEIL - RAG_VECTOR_CONFIDENCE_FLOOR, 1e-6)
+    return min(1.0, max(0.0, (cosine - RAG_VECTOR_CONFIDENCE_FLOOR) / span))
+
+def _vector_search(query: str, n_results: int):
+    """向量召回，返回 ({doc_id: (content, source)}（按相似度排序）, {doc_id: 匹配质量 0~1})"""
+    if collection is None or RETRIEVAL_MODE == "lexical":
+        return {}, {}
+    # 用缓存的查询向量直接检索，重复问题不再有 embeddings 往返
+    results = collection.query(
+        query_embeddings=[embed_query(query)],
+        n_results=n_results,
+        include=["documents", "metadatas", "distances"]
+    )
+    hits, quality = {}, {}
+    if results['documents']:
+        for i, doc in enumerate(results['documents'][0]):
+            doc_id = results['ids'][0][i]
+            meta = results['metadatas'][0][i]
+            hits[doc_id] = (doc, meta['source'])
+            quality[doc_id] = _vector_quality(results['distances'][0][i])
+    return hits, quality
+
+def _lexical_search(query: str, n_results: int):
+    """BM25 召回，返回 ({doc_id: (content, source)}（按分数排序）, {doc_id: 匹配质量 0~1})"""
+    if RETRIEVAL_MODE == "vector" and collection is not None:
+        return {}, {}
+    results = lexical_index.search(query, n_results)
+    reference = lexical_index.reference_score(query) if results else 0.0
+    hits = {doc_id: lexical_index.get(doc_id) for doc_id, _ in results}
+    scale = reference * RAG_LEXICAL_CONFIDENCE_CEIL
+    quality = {doc_id: min(1.0, score / scale) if scale > 0 else 0.0 for doc_id, score in results}
+    return hits, quality
+
+def search_knowledge_scored(query: str, n_results: int = 3):
+    """
+    返回 (docs, confidence)。confidence ∈ [0, 1] 衡量融合后第一名文档本身的匹配质量，而不是各路排名是否一致
+    （单路检索时排名一致恒成立，会让任何命中都得满分）：
+      - 词法：BM25 分数相对查询参照满分的比例（≈ 按 idf 加权的查询词覆盖率），按 RAG_LEXICAL_CONFIDENCE_CEIL 放大；
+      - 向量：余弦相似度按 RAG_VECTOR_CONFIDENCE_FLOOR / CEIL 映射；
+    两路都召回到时取较高者，无结果为 0。
+    """
+    if not is_ready():
+        return [], 0.0
     try:
-        if not openai_ef: return []
-        results = collection.query(
-            query_texts=[query],
-            n_results=n_results
-        )
-        
-        knowledge_list = []
-        if results['documents']:
-            for i, doc in enumerate(results['documents'][0]):
-                meta = results['metadatas'][0][i]
-                knowledge_list.append(f"【来源：{meta['source']}】\n内容：{doc}")
-                
-        return knowledge_list
+        vector_hits, vector_quality = {}, {}
+        try:
+            vector_hits, vector_quality = _vector_search(query, n_results * 2)
+        except Exception as e:
+            # 向量服务故障时退化为纯词法检索
+            logger.error(f"向量检索失败: {e}")
+        lexical_hits, lexical_quality = _lexical_search(query, n_results * 2)
+
+        docs = {**lexical_hits, **vector_hits}
+        rankings = [ranking for ranking in (list(vector_hits), list(lexical_hits)) if ranking]
+        fused = reciprocal_rank_fusion(rankings, k=RRF_K)
+        confidence = 0.0
+        if fused:
+            confidence = max(vector_quality.get(fused[0], 0.0), lexical_quality.get(fused[0], 0.0))
+        return [f"【来源：{docs[doc_id][1]}】\n内容：{docs[doc_id][0]}" for doc_id in fused[:n_results]], confidence
     except Exception as e:
         logger.error(f"检索失败: {e}")
-        return []
+        return [], 0.0
 
-def load_initial_data_from_file(file_path: str = "legal_data.json"):
-    if not os.path.exists(file_path):
-        logger.warning(f"数据文件 {file_path} 不存在，跳过初始化。")
+def search_knowledge(query: str, n_results: int = 3):
+    return search_knowledge_scored(query, n_results)[0]
+
+def _backfill_lexical_index():
+    """升级兼容：向量库已有文档但词法索引为空时，从 Chroma 分页回填"""
+    if collection is None or len(lexical_index) or not collection.count():
         return
+    logger.info("正在从向量库回填词法索引...")
+    offset, page = 0, 1000
+    while True:
+        batch = collection.get(limit=page, offset=offset, include=["documents", "metadatas"])
+        if not batch["ids"]:
+            break
+        lexical_index.add_documents(
+            (doc_id, doc, (meta or {}).get("source", ""))
+            for doc_id, doc, meta in zip(batch["ids"], batch["documents"], batch["metadatas"])
+        )
+        offset += len(batch["ids"])
+    save_lexical_index()
 
+def load_initial_data_from_file(file_path: str = "legal_data.json"):
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            
-        count = 0
-        for item in data:
-            add_legal_document(item["content"], item["source"])
-            count += 1
-        logger.info(f"成功从文件加载了 {count} 条法律条文。")
-    except json.JSONDecodeError:
+        _ensure_backend()
+        stats = ingest_file(collection, file_path, lexical_index=lexical_index)
+        if stats:
+            logger.info(f"成功从文件加载了 {stats['added']} 条法律条文（跳过已存在 {stats['skipped']} 条）。")
+    except ValueError:
         logger.error("数据文件格式错误，请检查 JSON 格式。")
     except Exception as e:
         logger.error(f"加载初始数据时发生未知错误: {e}")
 
 def init_knowledge_base():
-    if collection.count() == 0:
-        logger.info("正在初始化法律知识库...")
-        load_initial_data_from_file()
+    """在后台线程中执行：可能需要向量化整个语料，完成后标记就绪"""
+    try:
+        _ensure_backend()
+        _backfill_lexical_index()
+        if document_count() == 0:
+            logger.info("正在初始化法律知识库...")
+            load_initial_data_from_file()
         
-        # 【修复重点】：安全的导入，避免循环引用
-        try:
-            from rule_service import get_default_seed_rules
-            for patterns, answer, source in get_default_seed_rules():
-                content = f"问题关键词：{patterns[0]}。标准答案：{answer}"
-                add_legal_document(content, f"规则库-{source}")
-        except ImportError:
-            logger.warning("未能导入 rule_service 初始化默认规则到向量库。")
+            # 【修复重点】：安全的导入，避免循环引用
+            try:
+                from rule_service import get_default_seed_rules
+                ingest_documents(collection, (
+                    {"content": f"问题关键词：{patterns[0]}。标准答案：{answer}", "source": f"规则库-{source}"}
+                    for patterns, answer, source in get_default_seed_rules()
+                ), lexical_index=lexical_index)
+            except ImportError:
+                logger.warning("未能导入 rule_service 初始化默认规则到向量库。")
             
-        logger.info("法律知识库初始化完成！")
-    else:
-        logger.info(f"法律知识库已就绪，当前文档数: {collection.count()}")
\ No newline at end of file
+            save_lexical_index()
+            logger.info("法律知识库初始化完成！")
+        else:
+            logger.info(f"法律知识库已就绪，当前文档数: {document_count()}（检索模式: {RETRIEVAL_MODE}，向量后端: {EMBEDDING_BACKEND}）")
+    finally:
+        # 就绪前的回答没有检索依据，不能继续命中缓存
+        answer_cache.invalidate("(知识库就绪)")
+        # 初始化失败也标记就绪：检索会按已有数据尽力而为，而不是永远返回空
+        _ready.set()
\ No newline at end of file
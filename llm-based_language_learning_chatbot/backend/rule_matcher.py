@@ -0,0 +1,306 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+try:
+    # Python 3.11+
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # pragma: no cover - Python < 3.11
+    import sre_parse
+    import sre_constants
+
+# ==========================================
+# 1. 正则必需字面量提取
+# ==========================================
+# 少于该长度的字面量区分度太低（几乎每条消息都命中），不作为预过滤键
+MIN_LITERAL_LEN = 2
+
+# 分隔符（空白、标点、下划线）：预过滤在去掉分隔符的文本上进行，
+# 字面量之间允许任意分隔符的模式（如 "借[\s\W_]*款"）也能提取出整段字面量
+_SEPARATOR_RE = re.compile(r"[\s\W_]+")
+_SEPARATOR_ITEMS = {
+    (sre_constants.CATEGORY, sre_constants.CATEGORY_SPACE),
+    (sre_constants.CATEGORY, sre_constants.CATEGORY_NOT_WORD),
+    (sre_constants.LITERAL, ord("_")),
+}
+
+
+def strip_separators(text: str) -> str:
+    return _SEPARATOR_RE.sub("", text)
+
+
+def _is_separator_repeat(op, av) -> bool:
+    """min 为 0、只匹配分隔符的重复（如 [\s\W_]*）：去掉分隔符后不留痕迹，不打断连续字面量"""
+    if op not in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) or av[0] != 0:
+        return False
+    sub = list(av[2])
+    if len(sub) != 1 or sub[0][0] is not sre_constants.IN:
+        return False
+    return all(item in _SEPARATOR_ITEMS for item in sub[0][1])
+
+
+def _required_factors(parsed) -> List[List[str]]:
+    """
+    遍历 sre_parse 的解析树，收集"任意匹配都必然出现"的因子。
+    每个因子是一组候选字面量，匹配时至少出现其中之一：
+      - 连续的 LITERAL 构成单元素因子；
+      - 分组、min >= 1 的重复会展开内部因子；
+      - 每个分支都能给出因子的 BRANCH 合并为多元素因子。
+    可选/字符集/任意字符等都会打断连续片段。
+    """
+    factors: List[List[str]] = []
+    current: List[str] = []
+
+    def flush():
+        if current:
+            factors.append(["".join(current)])
+            current.clear()
+
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            current.append(chr(av))
+            continue
+        if _is_separator_repeat(op, av):
+            continue
+        flush()
+        if op is sre_constants.SUBPATTERN:
+            # av = (group, add_flags, del_flags, pattern)
+            factors.extend(_required_factors(av[-1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_count, _max_count, sub = av
+            if min_count >= 1:
+                factors.extend(_required_factors(sub))
+        elif op is sre_constants.BRANCH:
+            alternatives: List[str] = []
+            for branch in av[1]:
+                best = _best_factor(_required_factors(branch))
+                if best is None:
+                    alternatives = []
+                    break
+                alternatives.extend(best)
+            if alternatives:
+                factors.append(alternatives)
+        # 其余操作（IN / ANY / AT / ASSERT ...）不提供必需字面量
+    flush()
+    return factors
+
+
+def _best_factor(factors: List[List[str]]) -> Optional[List[str]]:
+    """选区分度最高的因子：最短候选越长越好，候选越少越好（长度按去掉分隔符后计算）"""
+    best = None
+    best_key = None
+    for alternatives in factors:
+        folded = [strip_separators(lit.casefold()) for lit in alternatives]
+        shortest = min(len(lit) for lit in folded)
+        if shortest < MIN_LITERAL_LEN:
+            continue
+        key = (shortest, -len(folded))
+        if best_key is None or key > best_key:
+            best, best_key = folded, key
+    return best
+
+
+def extract_required_literals(pattern: str) -> Optional[List[str]]:
+    """
+    返回模式的预过滤候选字面量（已做 casefold 并去掉分隔符，任一出现即可能命中），
+    无法提取时返回 None，此类模式会走合并正则兜底通道。
+    预过滤只判断"是否出现"，查询文本做同样的 casefold 与去分隔符即可对齐 IGNORECASE：
+    原文中连续出现的字面量，去掉分隔符后仍连续出现，预过滤不会漏掉真正命中的模式。
+    """
+    try:
+        parsed = sre_parse.parse(pattern, re.IGNORECASE)
+    except Exception:
+        return None
+    return _best_factor(_required_factors(parsed))
+
+
+# 反向引用 / 命名引用 / 条件分组
+_BACKREF_RE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+def _is_combinable(pattern: re.Pattern) -> bool:
+    """带分组名或反向引用的模式拼进合并正则后组号会错位，只能单独校验"""
+    if pattern.groupindex:
+        return False
+    return _BACKREF_RE.search(pattern.pattern) is None
+
+# ==========================================
+# 2. Aho-Corasick 多模式字面量自动机
+# ==========================================
+class AhoCorasick:
+    """
+    纯 Python 实现的 Aho-Corasick 自动机。
+    对输入文本只扫描一遍，返回所有出现过的关键词编号。
+    """
+
+    def __init__(self, keywords: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+
+        for kw_id, kw in enumerate(keywords):
+            node = 0
+            for ch in kw:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(kw_id)
+
+        # BFS 构造失败指针，并把失败链上的输出合并到当前节点
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                fallback = self._goto[f].get(ch, 0)
+                self._fail[child] = fallback if fallback != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def find_all(self, text: str) -> set:
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+# ==========================================
+# 3. 规则匹配器
+# ==========================================
+# 增量变更积累到该规模后，建议调用方重新编译基础自动机
+COMPACT_OVERLAY_RULES = 64
+COMPACT_REMOVED_RATIO = 0.1
+
+
+def rule_literals(rule: dict) -> List[Optional[List[str]]]:
+    """每个模式的预过滤字面量；缓存条目里已算好时直接复用，避免重复解析正则"""
+    literals = rule.get("literals")
+    if literals is None:
+        literals = [extract_required_literals(p.pattern) for p in rule["patterns"]]
+    return literals
+
+
+class RuleMatcher:
+    """
+    由 load_rules_from_db 一次性构建的编译期匹配器。
+    rules 为按优先级排好序的缓存条目：{"id": ..., "patterns": [re.Pattern], "answer": ..., "source": ...}
+    优先级取条目的 id（缺省时取列表下标），数值越小越优先。
+
+    查询流程：
+      1. Aho-Corasick 单遍扫描，得到"必需字面量已出现"的候选模式；
+      2. 无法提取字面量的模式合并为一个大正则，命中后再逐条确认；
+      3. 增量加入的规则（overlay）用子串判断做预过滤，被删除/停用的基础规则记为墓碑；
+      4. 候选按 (规则优先级, 模式序号) 排序后逐条 search 校验，第一个命中即返回。
+    """
+
+    def __init__(self, rules: List[dict]):
+        self._rules = rules
+        self._priority = [rule.get("id", idx) for idx, rule in enumerate(rules)]
+        # (rule_idx, pattern_idx) 与 AC 关键词编号一一对应
+        self._literal_slots: List[List[Tuple[int, int]]] = []
+        self._fallback_slots: List[Tuple[int, int]] = []
+        # 无法合并的兜底模式，每次查询都作为候选
+        self._standalone_slots: List[Tuple[int, int]] = []
+        # 增量变更：优先级 -> 条目；以及被移除的基础规则优先级
+        self._overlay: Dict[int, dict] = {}
+        self._removed: set = set()
+
+        keyword_ids: Dict[str, int] = {}
+        keywords: List[str] = []
+        fallback_sources: List[str] = []
+
+        for rule_idx, rule in enumerate(rules):
+            for pat_idx, literals in enumerate(rule_literals(rule)):
+                pattern = rule["patterns"][pat_idx]
+                if literals is None:
+                    if _is_combinable(pattern):
+                        self._fallback_slots.append((rule_idx, pat_idx))
+                        fallback_sources.append(f"(?:{pattern.pattern})")
+                    else:
+                        self._standalone_slots.append((rule_idx, pat_idx))
+                    continue
+                for literal in set(literals):
+                    kw_id = keyword_ids.get(literal)
+                    if kw_id is None:
+                        kw_id = len(keywords)
+                        keyword_ids[literal] = kw_id
+                        keywords.append(literal)
+                        self._literal_slots.append([])
+                    self._literal_slots[kw_id].append((rule_idx, pat_idx))
+
+        self._automaton = AhoCorasick(keywords) if keywords else None
+        self._fallback_regex = None
+        if fallback_sources:
+            try:
+                self._fallback_regex = re.compile("|".join(fallback_sources), re.IGNORECASE)
+            except re.error:
+                # 内联标志等导致无法合并时，兜底模式逐条匹配
+                self._fallback_regex = None
+
+    def __len__(self):
+        return len(self._rules) - len(self._removed) + len(self._overlay)
+
+    # --- 增量变更 ---
+    def upsert(self, rule: dict):
+        """新增或替换一条规则（按 id 识别），不重建自动机"""
+        priority = rule["id"]
+        self._removed.add(priority)
+        self._overlay[priority] = {**rule, "literals": rule_literals(rule)}
+
+    def remove(self, rule_id: int):
+        self._removed.add(rule_id)
+        self._overlay.pop(rule_id, None)
+
+    def needs_compaction(self) -> bool:
+        return (
+            len(self._overlay) > COMPACT_OVERLAY_RULES
+            or len(self._removed) > max(COMPACT_OVERLAY_RULES, len(self._rules) * COMPACT_REMOVED_RATIO)
+        )
+
+    # --- 查询 ---
+    def match(self, user_query: str) -> Optional[dict]:
+        candidates = set()
+        folded = strip_separators(user_query.casefold())
+
+        if self._automaton is not None:
+            for kw_id in self._automaton.find_all(folded):
+                candidates.update(self._literal_slots[kw_id])
+
+        if self._fallback_slots:
+            if self._fallback_regex is None or self._fallback_regex.search(user_query):
+                candidates.update(self._fallback_slots)
+        candidates.update(self._standalone_slots)
+
+        # (优先级, 模式序号, 条目)，多个字面量可能指向同一模式，已由 set 去重
+        ordered = [
+            (self._priority[rule_idx], pat_idx, self._rules[rule_idx])
+            for rule_idx, pat_idx in candidates
+            if self._priority[rule_idx] not in self._removed
+        ]
+        for priority, rule in self._overlay.items():
+            for pat_idx, literals in enumerate(rule["literals"]):
+                if literals is None or any(lit in folded for lit in literals):
+                    ordered.append((priority, pat_idx, rule))
+
+        if not ordered:
+            return None
+
+        ordered.sort(key=lambda c: (c[0], c[1]))
+        for _priority, pat_idx, rule in ordered:
+            if rule["patterns"][pat_idx].search(user_query):
+                return rule
+        return None
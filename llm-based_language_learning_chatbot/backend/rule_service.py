@@ -1,9 +1,13 @@
 import re
 import json
 import logging
+from typing import Dict, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 import models
+from rule_matcher import RuleMatcher, rule_literals
+from answer_cache import answer_cache
+from metrics import RULE_MATCH_LATENCY
 
 # Configure logger
 logger = logging.getLogger(__name__)
@@ -11,45 +15,89 @@ logger = logging.getLogger(__name__)
 # ==========================================
 # 1. 内存中的规则缓存
 # ==========================================
-_RULES_CACHE = []
+# 规则 ID -> 编译后的缓存条目
+_RULES_CACHE: Dict[int, dict] = {}
+# 由 _RULES_CACHE 编译出的多模式匹配器，check_rules 只扫描一遍查询文本
+_RULE_MATCHER = RuleMatcher([])
+# 本进程已应用到的规则变更版本号（对应 rule_changes 表的自增 ID）
+_RULES_VERSION = 0
 
-async def load_rules_from_db(db: AsyncSession):
+def compile_rule(r: models.Rule) -> Optional[dict]:
+    """把一行 Rule 编译为缓存条目，模式非法时返回 None"""
+    try:
+        # 数据库存的是 JSON 字符串 '["a", "b"]' -> 解析为 Python list
+        pattern_strs = json.loads(r.patterns)
+        if not isinstance(pattern_strs, list):
+            pattern_strs = [str(pattern_strs)]
+
+        # 预编译正则，忽略大小写
+        compiled_patterns = [re.compile(p, re.IGNORECASE) for p in pattern_strs]
+        entry = {
+            "id": r.id,
+            "patterns": compiled_patterns,
+            "answer": r.answer,
+            "source": r.source
+        }
+        entry["literals"] = rule_literals(entry)
+        return entry
+    except Exception as e:
+        logger.warning(f"❌ 规则 ID {r.id} 加载失败: {e}")
+        return None
+
+def get_rules_version() -> int:
+    return _RULES_VERSION
+
+async def load_rules_from_db(db: AsyncSession, version: Optional[int] = None):
     """
-    【热更新】从数据库读取所有启用规则，编译正则，更新到内存缓存。
-    此函数应在系统启动时调用，以及管理员修改规则后调用。
+    【全量加载】从数据库读取所有启用规则，编译正则，更新到内存缓存。
+    仅在系统启动时调用；之后的修改通过 apply_rule_change 增量生效。
+    version 为加载前读取的变更版本号，之后的变更由同步任务补齐。
     """
-    global _RULES_CACHE
+    global _RULES_CACHE, _RULE_MATCHER, _RULES_VERSION
     logger.info("🔄 正在从数据库重新加载高频规则库...")
     
     try:
-        result = await db.execute(select(models.Rule).filter(models.Rule.active == True))
+        result = await db.execute(select(models.Rule).filter(models.Rule.active == True).order_by(models.Rule.id))
         rules_db = result.scalars().all()
         
-        new_cache = []
+        new_cache = {}
         for r in rules_db:
-            try:
-                # 数据库存的是 JSON 字符串 '["a", "b"]' -> 解析为 Python list
-                pattern_strs = json.loads(r.patterns)
-                if not isinstance(pattern_strs, list):
-                    pattern_strs = [str(pattern_strs)]
-                
-                # 预编译正则，忽略大小写
-                compiled_patterns = [re.compile(p, re.IGNORECASE) for p in pattern_strs]
-                
-                new_cache.append({
-                    "patterns": compiled_patterns,
-                    "answer": r.answer,
-                    "source": r.source
-                })
-            except Exception as e:
-                logger.warning(f"❌ 规则 ID {r.id} 加载失败: {e}")
+            entry = compile_rule(r)
+            if entry:
+                new_cache[r.id] = entry
                 
         _RULES_CACHE = new_cache
-        logger.info(f"✅ 规则库加载完成，当前生效规则数: {len(_RULES_CACHE)}")
+        _RULE_MATCHER = RuleMatcher(list(new_cache.values()))
+        answer_cache.invalidate("(规则库重新加载)")
+        if version is not None:
+            _RULES_VERSION = version
+        logger.info(f"✅ 规则库加载完成，当前生效规则数: {len(_RULES_CACHE)}，版本: {_RULES_VERSION}")
         
     except Exception as e:
         logger.error(f"❌ 数据库连接失败: {e}")
 
+def apply_rule_change(rule_id: int, rule: Optional[models.Rule], version: int):
+    """
+    【增量热更新】应用单条规则变更：新增 / 修改 / 启停 / 删除。
+    rule 为变更后的数据库行，已删除时传 None；停用的规则会从缓存中移除。
+    只编译这一条规则，匹配器的重建推迟到积累足够多的增量之后。
+    """
+    global _RULE_MATCHER, _RULES_VERSION
+    entry = compile_rule(rule) if rule is not None and rule.active else None
+    if entry:
+        _RULES_CACHE[rule_id] = entry
+        _RULE_MATCHER.upsert(entry)
+    else:
+        _RULES_CACHE.pop(rule_id, None)
+        _RULE_MATCHER.remove(rule_id)
+
+    if _RULE_MATCHER.needs_compaction():
+        _RULE_MATCHER = RuleMatcher([_RULES_CACHE[k] for k in sorted(_RULES_CACHE)])
+    _RULES_VERSION = max(_RULES_VERSION, version)
+    # 新规则可能覆盖原本由 LLM 回答的问题，缓存的旧答案一律作废
+    answer_cache.invalidate("(规则变更)")
+    logger.info(f"🔁 规则 ID {rule_id} 已{'更新' if entry else '移除'}，当前版本: {_RULES_VERSION}")
+
 # ==========================================
 # 2. 种子规则（供数据库首次初始化使用）
 # ==========================================
@@ -83,11 +131,11 @@ def get_default_seed_rules():
 # ==========================================
 def check_rules(user_query: str):
     """
-    规则匹配引擎：直接使用从数据库加载到内存的 _RULES_CACHE，实现毫秒级响应。
+    规则匹配引擎：使用预编译并增量维护的 _RULE_MATCHER，
+    字面量预过滤单遍扫描查询文本，再按规则优先级（ID 顺序）校验候选正则。
     """
-    global _RULES_CACHE
-    for rule in _RULES_CACHE:
-        for pattern in rule["patterns"]:
-            if pattern.search(user_query):
-                return rule["answer"], rule["source"]
+    with RULE_MATCH_LATENCY.time():
+        rule = _RULE_MATCHER.match(user_query)
+    if rule:
+        return rule["answer"], rule["source"]
     return None, None
\ No newline at end of file
@@ -0,0 +1,137 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import models
+import rule_service
+
+logger = logging.getLogger(__name__)
+
+# (version, rule_id, op)
+RuleChangeRecord = Tuple[int, int, str]
+
+# ==========================================
+# 1. 规则变更通道
+# ==========================================
+class DatabaseRuleChangeFeed:
+    """
+    基于 rule_changes 表的变更通道：自增 ID 作为全局版本号，各 worker 轮询增量。
+    变更记录与规则本身写在同一个事务里，提交即对所有 worker 可见。
+    """
+
+    async def publish(self, db: AsyncSession, rule_id: int, op: str) -> int:
+        change = models.RuleChange(rule_id=rule_id, op=op)
+        db.add(change)
+        await db.flush()
+        return change.id
+
+    async def latest_version(self, db: AsyncSession) -> int:
+        result = await db.execute(select(func.max(models.RuleChange.id)))
+        return result.scalar() or 0
+
+    async def changes_since(self, db: AsyncSession, version: int) -> List[RuleChangeRecord]:
+        result = await db.execute(
+            select(models.RuleChange.id, models.RuleChange.rule_id, models.RuleChange.op)
+            .filter(models.RuleChange.id > version)
+            .order_by(models.RuleChange.id)
+        )
+        return [tuple(row) for row in result.all()]
+
+
+class LocalRuleChangeFeed:
+    """进程内的变更通道替身，供单 worker 开发环境和测试使用，不读写数据库"""
+
+    def __init__(self):
+        self._changes: List[RuleChangeRecord] = []
+
+    async def publish(self, db: AsyncSession, rule_id: int, op: str) -> int:
+        version = len(self._changes) + 1
+        self._changes.append((version, rule_id, op))
+        return version
+
+    async def latest_version(self, db: AsyncSession) -> int:
+        return len(self._changes)
+
+    async def changes_since(self, db: AsyncSession, version: int) -> List[RuleChangeRecord]:
+        return self._changes[max(version, 0):]
+
+
+def _create_feed():
+    backend = os.getenv("RULE_CHANGE_FEED", "database").lower()
+    if backend == "local":
+        return LocalRuleChangeFeed()
+    return DatabaseRuleChangeFeed()
+
+
+feed = _create_feed()
+
+# ==========================================
+# 2. 发布与同步
+# ==========================================
+# 自增 ID 可能乱序提交（事务 A 先拿到 5、事务 B 拿到 6 却先提交），
+# 因此每次轮询都回看一小段窗口，并用已应用集合去重
+SYNC_OVERLAP = int(os.getenv("RULE_SYNC_OVERLAP", "50"))
+_applied_versions = deque(maxlen=SYNC_OVERLAP * 4)
+
+
+async def publish_rule_change(db: AsyncSession, rule: Optional[models.Rule], rule_id: int, op: str) -> int:
+    """
+    记录一条规则变更，与调用方尚未提交的规则修改在同一事务中提交，随后立即在本 worker 生效。
+    op: "upsert"（新增 / 修改 / 启停）或 "delete"
+    """
+    version = await feed.publish(db, rule_id, op)
+    await db.commit()
+    _applied_versions.append(version)
+    rule_service.apply_rule_change(rule_id, rule if op != "delete" else None, version)
+    return version
+
+
+async def sync_rule_changes(db: AsyncSession) -> int:
+    """拉取其它 worker 发布的变更并逐条应用，返回应用的变更数"""
+    since = max(rule_service.get_rules_version() - SYNC_OVERLAP, 0)
+    changes = [c for c in await feed.changes_since(db, since) if c[0] not in _applied_versions]
+    if not changes:
+        return 0
+
+    rule_ids = {rule_id for _, rule_id, _ in changes}
+    result = await db.execute(select(models.Rule).filter(models.Rule.id.in_(rule_ids)))
+    rows = {r.id: r for r in result.scalars().all()}
+
+    for version, rule_id, _op in changes:
+        # 以数据库当前状态为准，重复或乱序应用都是幂等的
+        rule_service.apply_rule_change(rule_id, rows.get(rule_id), version)
+        _applied_versions.append(version)
+    return len(changes)
+
+
+async def load_rules(db: AsyncSession):
+    """启动时全量加载；先读版本号再读规则，期间发生的变更会被下一次同步补上"""
+    version = await feed.latest_version(db)
+    _applied_versions.clear()
+    await rule_service.load_rules_from_db(db, version)
+
+# ==========================================
+# 3. 后台轮询任务
+# ==========================================
+SYNC_INTERVAL = float(os.getenv("RULE_SYNC_INTERVAL", "2"))
+
+
+async def run_sync_loop(session_factory, interval: float = SYNC_INTERVAL):
+    """在 lifespan 中以后台任务启动，周期性同步其它 worker 的规则变更"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with session_factory() as db:
+                applied = await sync_rule_changes(db)
+            if applied:
+                logger.info(f"🔄 已同步 {applied} 条规则变更，当前版本: {rule_service.get_rules_version()}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ 规则变更同步失败: {e}")
@@ -60,6 +60,10 @@ class Message(MessageBase):
     class Config:
         from_attributes = True
 
+class MessagePage(BaseModel):
+    items: List[Message]
+    next_cursor: Optional[str] = None
+
 class Session(BaseModel):
     id: str
     created_at: datetime
@@ -88,6 +92,10 @@ class Ticket(BaseModel):
     class Config:
         from_attributes = True
 
+class TicketPage(BaseModel):
+    items: List[Ticket]
+    next_cursor: Optional[str] = None
+
 # --- Feedback ---
 class FeedbackCreate(BaseModel):
     message_id: int
@@ -113,4 +121,34 @@ class Rule(RuleBase):
     id: int
     created_at: datetime
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class RulePage(BaseModel):
+    items: List[Rule]
+    next_cursor: Optional[str] = None
+
+# --- Rule Candidates（好评答案晋升） ---
+class RuleCandidate(BaseModel):
+    id: int
+    question: str
+    answer: str
+    origin: str
+    positive_votes: int
+    negative_votes: int
+    ask_count: int
+    traffic_share: float
+    status: str
+    rule_id: Optional[int] = None
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    class Config:
+        from_attributes = True
+
+class RuleCandidatePage(BaseModel):
+    items: List[RuleCandidate]
+    next_cursor: Optional[str] = None
+
+class RuleCandidateApprove(BaseModel):
+    # 不填则使用按原问题生成的整句匹配模式与候选答案
+    patterns: Optional[List[str]] = None
+    answer: Optional[str] = None
@@ -0,0 +1,154 @@
+import os
+import asyncio
+import hashlib
+import logging
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from answer_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+
+def history_fingerprint(history: list, current_text: str) -> str:
+    """历史窗口的指纹（不含本轮刚追加的用户消息）；新会话的空历史指纹相同，突发的同类提问可以合并"""
+    entries = history[:-1] if history and history[-1].content == current_text else history
+    digest = hashlib.sha1()
+    for entry in entries:
+        digest.update(entry.role.encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update((entry.content or "").encode("utf-8"))
+        digest.update(b"\x01")
+    return digest.hexdigest()
+
+
+def coalescing_key(history: list, latest_input: dict) -> Tuple:
+    text = latest_input.get("content", "")
+    return (
+        latest_input.get("type", "text"),
+        normalize_query(text),
+        latest_input.get("url") or "",
+        history_fingerprint(history, text),
+    )
+
+
+class _Broadcast:
+    """一次流式生成的事件广播：保留已产出的事件，中途加入的订阅者先回放、再跟随后续事件"""
+
+    def __init__(self):
+        self.events: List[dict] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, event: dict):
+        self.events.append(event)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.finished = True
+        self.error = error
+        self._notify()
+
+    async def subscribe(self) -> AsyncIterator[dict]:
+        index = 0
+        while True:
+            while index < len(self.events):
+                yield self.events[index]
+                index += 1
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """
+    同一时刻相同键的请求只执行一次：第一个请求创建共享任务，后来者等待同一个结果。
+    每个等待者通过 asyncio.shield 等待，断开连接取消的只是自己的等待，不会取消共享任务。
+    流式请求（stream）共享同一个生成任务，产出的事件广播给所有订阅者；
+    最后一个订阅者离开时取消生成任务，释放 LLM 调度名额与上游连接。
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._streams: Dict[Hashable, _Broadcast] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable]):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._done(k, t))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            logger.info(f"🔗 合并相同的进行中请求（当前 {self.coalesced} 次）")
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有等待者都已取消时，取走异常避免 "exception was never retrieved"
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"合并请求失败: {task.exception()}")
+
+    async def stream(self, key: Hashable, factory: Callable[[], AsyncIterator[dict]]) -> AsyncIterator[dict]:
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+            broadcast.task = asyncio.create_task(self._pump(key, broadcast, factory))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            logger.info(f"🔗 合并相同的进行中流式请求（当前 {self.coalesced} 次）")
+        broadcast.subscribers += 1
+        try:
+            async for event in broadcast.subscribe():
+                yield event
+        finally:
+            broadcast.subscribers -= 1
+            if not broadcast.subscribers and not broadcast.finished:
+                # 没人再听：取消生成，之后的相同请求重新开始，而不是加入一个正在取消的广播
+                if self._streams.get(key) is broadcast:
+                    del self._streams[key]
+                broadcast.task.cancel()
+
+    async def _pump(self, key: Hashable, broadcast: _Broadcast, factory: Callable[[], AsyncIterator[dict]]):
+        try:
+            async with aclosing(factory()) as events:
+                async for event in events:
+                    broadcast.publish(event)
+            broadcast.finish()
+        except asyncio.CancelledError:
+            broadcast.finish(RuntimeError("合并的流式请求已取消"))
+            raise
+        except Exception as e:
+            logger.debug(f"合并的流式请求失败: {e}")
+            broadcast.finish(e)
+        finally:
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+
+    def snapshot(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "streams_in_flight": len(self._streams),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,156 @@
+import asyncio
+import time
+
+import pytest
+
+from llm_scheduler import PRIORITY_HIGH, LLMQueueTimeout, LLMScheduler, llm_session_key
+
+
+async def _until_queued(scheduler: LLMScheduler, count: int):
+    for _ in range(100):
+        if sum(scheduler.queue_depth().values()) >= count:
+            return
+        await asyncio.sleep(0)
+    raise AssertionError(f"排队数未达到 {count}: {scheduler.queue_depth()}")
+
+
+def test_round_robin_across_sessions():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, queue_timeout=5)
+        order = []
+
+        async def call(session: str, name: str):
+            llm_session_key.set(session)
+            async with scheduler.slot(PRIORITY_HIGH):
+                order.append(name)
+
+        async with scheduler.slot():
+            tasks = [asyncio.create_task(call(s, n)) for s, n in
+                     [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("b", "b2")]]
+            await _until_queued(scheduler, 5)
+        await asyncio.gather(*tasks)
+        return order, scheduler
+
+    order, scheduler = asyncio.run(scenario())
+    # 会话 a 先排了三个请求，也不会连续独占名额
+    assert order == ["a1", "b1", "a2", "b2", "a3"]
+    assert scheduler.snapshot()["in_flight"] == 0
+
+
+def test_higher_priority_goes_first():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, queue_timeout=5)
+        order = []
+
+        async def call(priority: int, name: str):
+            async with scheduler.slot(priority):
+                order.append(name)
+
+        async with scheduler.slot():
+            tasks = [asyncio.create_task(call(1, "low")), asyncio.create_task(call(0, "high"))]
+            await _until_queued(scheduler, 2)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["high", "low"]
+
+
+def test_queue_timeout_does_not_leak_slot():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, queue_timeout=0.05)
+        async with scheduler.slot():
+            with pytest.raises(LLMQueueTimeout):
+                async with scheduler.slot():
+                    pass
+            # 超时的请求已出队，占用的仍只有外层这一个名额
+            assert scheduler.snapshot()["in_flight"] == 1
+            assert sum(scheduler.queue_depth().values()) == 0
+        assert scheduler.snapshot()["in_flight"] == 0
+        # 名额已归还：新的请求立即放行
+        async with scheduler.slot():
+            assert scheduler.snapshot()["in_flight"] == 1
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.timeouts == 1
+    assert scheduler.snapshot()["in_flight"] == 0
+
+
+def test_cancel_after_grant_releases_slot():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, queue_timeout=5)
+        entered = False
+
+        async def call():
+            nonlocal entered
+            async with scheduler.slot():
+                entered = True
+
+        async with scheduler.slot():
+            task = asyncio.create_task(call())
+            await _until_queued(scheduler, 1)
+        # 外层退出时名额已同步转交给 task，但 task 还没来得及恢复执行就被取消
+        assert scheduler.snapshot()["in_flight"] == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not entered
+        assert scheduler.snapshot()["in_flight"] == 0
+        async with scheduler.slot():
+            pass
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.snapshot()["in_flight"] == 0
+
+
+def test_cancel_while_queued_removes_waiter():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, queue_timeout=5)
+        async with scheduler.slot():
+            task = asyncio.create_task(scheduler.slot().__aenter__())
+            await _until_queued(scheduler, 1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert sum(scheduler.queue_depth().values()) == 0
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.snapshot()["in_flight"] == 0
+    assert scheduler.granted == 1
+
+
+def test_token_bucket_wakes_waiter_when_refilled():
+    async def scenario():
+        # 6000 token/分钟 = 100 token/秒
+        scheduler = LLMScheduler(max_concurrency=10, tokens_per_minute=6000, queue_timeout=5)
+        async with scheduler.slot(tokens=6000):
+            pass
+        started = time.monotonic()
+        task = asyncio.create_task(scheduler.slot(tokens=20).__aenter__())
+        await asyncio.sleep(0)
+        # 并发名额空闲，但令牌桶不足：请求留在队列里，等定时唤醒
+        assert not task.done()
+        assert sum(scheduler.queue_depth().values()) == 1
+        await task
+        return scheduler, time.monotonic() - started
+
+    scheduler, waited = asyncio.run(scenario())
+    assert 0.15 <= waited < 1.0
+    assert scheduler.granted == 2
+    assert scheduler._wakeup is None
+
+
+def test_actual_usage_refunds_bucket():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=10, tokens_per_minute=6000, queue_timeout=5)
+        async with scheduler.slot(tokens=6000) as usage:
+            usage.actual_tokens = 100
+        # 预估 6000、实际 100：多扣的还回桶里，下一次请求不用等待
+        started = time.monotonic()
+        async with scheduler.slot(tokens=1000):
+            pass
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 0.1
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+# single_flight 经 answer_cache 依赖 numpy（requirements.txt 中的运行依赖）
+pytest.importorskip("numpy")
+
+from single_flight import SingleFlight  # noqa: E402
+
+
+async def _collect(stream):
+    return [event async for event in stream]
+
+
+def test_stream_runs_producer_once_and_broadcasts():
+    async def scenario():
+        flight = SingleFlight()
+        runs = 0
+        release = asyncio.Event()
+
+        async def produce():
+            nonlocal runs
+            runs += 1
+            yield {"event": "delta", "content": "a"}
+            await release.wait()
+            yield {"event": "delta", "content": "b"}
+            yield {"event": "done", "result": {"content": "ab"}}
+
+        first = asyncio.create_task(_collect(flight.stream("k", produce)))
+        await asyncio.sleep(0.01)
+        # 中途加入的订阅者先回放已产出的事件
+        second = asyncio.create_task(_collect(flight.stream("k", produce)))
+        await asyncio.sleep(0.01)
+        release.set()
+        return runs, await first, await second, flight
+
+    runs, first, second, flight = asyncio.run(scenario())
+    assert runs == 1
+    assert first == second
+    assert [e.get("content") for e in first[:2]] == ["a", "b"]
+    assert flight.leaders == 1 and flight.coalesced == 1
+    assert flight.snapshot()["streams_in_flight"] == 0
+
+
+def test_stream_cancels_producer_when_last_subscriber_leaves():
+    async def scenario():
+        flight = SingleFlight()
+        closed = asyncio.Event()
+
+        async def produce():
+            try:
+                yield {"event": "delta", "content": "a"}
+                await asyncio.sleep(10)
+            finally:
+                closed.set()
+
+        stream = flight.stream("k", produce)
+        assert (await stream.__anext__())["content"] == "a"
+        await stream.aclose()
+        await asyncio.wait_for(closed.wait(), 1)
+        return flight
+
+    flight = asyncio.run(scenario())
+    assert flight.snapshot()["streams_in_flight"] == 0
+
+
+def test_stream_keeps_running_while_others_listen():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def produce():
+            yield {"event": "delta", "content": "a"}
+            await release.wait()
+            yield {"event": "done", "result": {}}
+
+        leaving = flight.stream("k", produce)
+        staying = asyncio.create_task(_collect(flight.stream("k", produce)))
+        await leaving.__anext__()
+        await leaving.aclose()
+        release.set()
+        return await staying
+
+    events = asyncio.run(scenario())
+    assert events[-1]["event"] == "done"
+
+
+def test_stream_error_reaches_every_subscriber():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def produce():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+            yield  # pragma: no cover
+
+        results = await asyncio.gather(
+            _collect(flight.stream("k", produce)), _collect(flight.stream("k", produce)), return_exceptions=True
+        )
+        return results
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, ValueError) for r in results)
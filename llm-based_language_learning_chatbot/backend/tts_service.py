@@ -0,0 +1,265 @@
+import os
+import re
+import uuid
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# 配置
+# ==========================================
+# azure（默认）/ local（生成静音 MP3，仅用于开发与测试，必须显式配置）
+TTS_BACKEND = os.getenv("TTS_BACKEND", "azure").lower()
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "./tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# 长文本按句切分后并发合成的段数上限，以及单段最大字数
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+TTS_SEGMENT_MAX_CHARS = int(os.getenv("TTS_SEGMENT_MAX_CHARS", "120"))
+
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？!?；;\n])")
+_CLAUSE_END_RE = re.compile(r"(?<=[，,、：:])")
+
+
+class TTSError(Exception):
+    """语音合成失败"""
+
+
+# ==========================================
+# 1. 合成后端
+# ==========================================
+class TTSBackend:
+    """合成后端接口：synthesize 为同步调用（在线程池中执行），返回一段可直接拼接的 MP3 字节"""
+    name = "base"
+    media_type = "audio/mpeg"
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        raise NotImplementedError
+
+
+class AzureTTSBackend(TTSBackend):
+    name = "azure"
+
+    def __init__(self):
+        import azure.cognitiveservices.speech as speechsdk
+
+        self._sdk = speechsdk
+        self._key = os.getenv("AZURE_SPEECH_KEY")
+        self._region = os.getenv("AZURE_SPEECH_REGION", "eastasia")
+        if not self._key:
+            raise TTSError("未配置 AZURE_SPEECH_KEY")
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        sdk = self._sdk
+        config = sdk.SpeechConfig(subscription=self._key, region=self._region)
+        config.speech_synthesis_voice_name = voice
+        # 固定 MP3 格式：各段可以直接首尾拼接成一个流
+        config.set_speech_synthesis_output_format(sdk.SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3)
+        synthesizer = sdk.SpeechSynthesizer(speech_config=config, audio_config=None)
+        result = synthesizer.speak_text_async(text).get()
+        if result.reason != sdk.ResultReason.SynthesizingAudioCompleted:
+            details = getattr(result, "cancellation_details", None)
+            raise TTSError(f"Azure TTS 失败: {result.reason} {getattr(details, 'error_details', '')}")
+        return result.audio_data
+
+
+class LocalTTSBackend(TTSBackend):
+    """
+    本地替身：按文本长度生成静音的 MPEG-1 Layer III 帧（44.1kHz / 32kbps / 单声道），
+    不依赖任何外部服务，播放器与缓存、分段、流式链路都能完整跑通。
+    """
+    name = "local"
+    _FRAME = bytes([0xFF, 0xFB, 0x10, 0xC0]) + bytes(100)  # 帧头 + 全零边信息/数据 = 104 字节静音帧
+    _FRAMES_PER_CHAR = 8  # 每帧约 26ms，每字约 0.2 秒
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        return self._FRAME * max(1, len(text.strip()) * self._FRAMES_PER_CHAR)
+
+
+BACKENDS = {
+    "azure": AzureTTSBackend,
+    "local": LocalTTSBackend,
+}
+
+_backend: Optional[TTSBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> TTSBackend:
+    """
+    首次使用时创建后端。初始化失败（SDK 未安装、未配置密钥、后端名未知）时抛出 TTSError，
+    不退化为静音替身，避免线上静默返回无声音频；下次调用时重试。
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backend_cls = BACKENDS.get(TTS_BACKEND)
+                if backend_cls is None:
+                    raise TTSError(f"未知的 TTS 后端: {TTS_BACKEND}")
+                try:
+                    _backend = backend_cls()
+                except TTSError:
+                    raise
+                except Exception as e:
+                    raise TTSError(f"TTS 后端 {TTS_BACKEND} 初始化失败: {e}") from e
+    return _backend
+
+
+def set_backend(backend: TTSBackend):
+    global _backend
+    _backend = backend
+
+
+# ==========================================
+# 2. 磁盘 LRU 缓存
+# ==========================================
+class TTSDiskCache:
+    """
+    以 sha256(后端, 音色, 文本) 为文件名缓存音频，总大小超过上限时按最近使用时间淘汰。
+    启动时按文件修改时间恢复 LRU 顺序，命中时刷新修改时间。
+    """
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        if self._loaded:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".mp3"):
+                st = entry.stat()
+                files.append((st.st_mtime, entry.name[:-4], st.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._bytes += size
+        self._loaded = True
+
+    @staticmethod
+    def key(backend: str, voice: str, text: str) -> str:
+        return hashlib.sha256(f"{backend}\x00{voice}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            with self._lock:
+                self._bytes -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._load()
+        tmp_path = os.path.join(self.directory, f".{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self._lock:
+            os.replace(tmp_path, self._path(key))
+            self._bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._bytes > self.max_bytes and self._entries:
+                evicted, size = self._entries.popitem(last=False)
+                self._bytes -= size
+                try:
+                    os.remove(self._path(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def snapshot(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+tts_cache = TTSDiskCache()
+
+
+# ==========================================
+# 3. 分段与流式合成
+# ==========================================
+def split_sentences(text: str, max_chars: int = TTS_SEGMENT_MAX_CHARS) -> List[str]:
+    """按句末标点切分，短句合并到不超过 max_chars，超长句再按逗号等切分"""
+    pieces: List[str] = []
+    for sentence in _SENTENCE_END_RE.split(text):
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        for clause in _CLAUSE_END_RE.split(sentence):
+            pieces.extend(clause[i:i + max_chars] for i in range(0, len(clause), max_chars))
+
+    segments: List[str] = []
+    current = ""
+    for piece in pieces:
+        # 第一句单独成段，尽早产出第一段音频
+        if current and (not segments or len(current) + len(piece) > max_chars):
+            segments.append(current)
+            current = ""
+        current += piece
+    if current:
+        segments.append(current)
+    return [s.strip() for s in segments if s.strip()]
+
+
+def _synthesize_segment(backend: TTSBackend, text: str, voice: str) -> bytes:
+    key = tts_cache.key(backend.name, voice, text)
+    audio = tts_cache.get(key)
+    if audio is None:
+        audio = backend.synthesize(text, voice)
+        tts_cache.put(key, audio)
+    return audio
+
+
+async def synthesize_stream(text: str, voice: str) -> AsyncIterator[bytes]:
+    """
+    按句切分后并发合成（最多 TTS_CONCURRENCY 段同时进行），按原顺序逐段产出音频。
+    第一段完成即可开始播放；客户端断开时取消尚未完成的分段。
+    """
+    backend = get_backend()
+    semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+
+    async def run(segment: str) -> bytes:
+        async with semaphore:
+            return await asyncio.to_thread(_synthesize_segment, backend, segment, voice)
+
+    tasks = [asyncio.create_task(run(segment)) for segment in split_sentences(text)]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def cache_stats() -> Dict:
+    try:
+        backend = get_backend().name
+    except TTSError as e:
+        backend = f"unavailable: {e}"
+    return {"backend": backend, **tts_cache.snapshot()}
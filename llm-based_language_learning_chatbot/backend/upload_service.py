@@ -0,0 +1,236 @@
+"""
+上传文件存储：内容寻址（文件名即 SHA-256），重复上传直接复用已有文件。
+
+垃圾回收（在 backend 目录下）：删除不再被任何 Message.media_url 引用的文件
+    python upload_service.py gc [--dry-run] [--min-age-hours 24]
+"""
+import os
+import re
+import uuid
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+import mimetypes
+from typing import NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+import aiofiles
+import aiofiles.os
+from fastapi import APIRouter, HTTPException, Request, UploadFile
+from fastapi.responses import Response, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "static/uploads"
+# 临时文件与最终文件位于同一文件系统，os.replace 才是原子的
+UPLOAD_TMP_DIR = os.path.join(UPLOAD_DIR, ".tmp")
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# 内容寻址文件名：<sha256>.<ext>；旧版本的 uuid 文件名仍可访问，但不标记 immutable
+_CONTENT_NAME_RE = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+_SAFE_NAME_RE = re.compile(r"^[A-Za-z0-9_-]+\.[A-Za-z0-9]+$")
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+LEGACY_CACHE_CONTROL = "public, max-age=86400"
+
+
+class StoredUpload(NamedTuple):
+    path: str
+    sha256: str
+    size: int
+    deduplicated: bool = False
+
+
+async def stream_upload(file: UploadFile, ext: str, max_size: int) -> StoredUpload:
+    """
+    把上传内容按块流式写入临时文件，边写边计算 SHA-256，完成后原子改名为 <sha256>.<ext>。
+    内存占用只与块大小有关；超过 max_size 立即中止并删除临时文件（413）。
+    同内容文件已存在时丢弃临时文件，直接返回已有文件。
+    """
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOAD_TMP_DIR, f"{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(413, f"文件不能超过 {max_size // 1024 // 1024}MB")
+                digest.update(chunk)
+                await out.write(chunk)
+        sha256 = digest.hexdigest()
+        dest_path = os.path.join(UPLOAD_DIR, f"{sha256}.{ext}")
+        if await aiofiles.os.path.exists(dest_path):
+            await _discard(tmp_path)
+            # 刷新修改时间，避免刚被复用的文件被 GC 当作陈旧文件
+            os.utime(dest_path)
+            return StoredUpload(dest_path, sha256, size, deduplicated=True)
+        await aiofiles.os.replace(tmp_path, dest_path)
+    except HTTPException:
+        await _discard(tmp_path)
+        raise
+    except Exception as e:
+        await _discard(tmp_path)
+        logger.error(f"文件上传失败: {e}")
+        raise HTTPException(500, "文件保存失败")
+    return StoredUpload(dest_path, sha256, size)
+
+
+async def _discard(path: str):
+    try:
+        await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def resolve_upload_path(media_url: Optional[str]) -> Optional[str]:
+    """把 /static/uploads/ 下的媒体 URL 映射为本地文件路径，外部 URL 或非法文件名返回 None"""
+    if not media_url:
+        return None
+    path = urlparse(media_url).path
+    prefix = "/static/uploads/"
+    if not path.startswith(prefix):
+        return None
+    name = path[len(prefix):]
+    if not _SAFE_NAME_RE.match(name):
+        return None
+    return os.path.join(UPLOAD_DIR, name)
+
+
+# ==========================================
+# 1. 文件服务：强 ETag + immutable + Range
+# ==========================================
+uploads_router = APIRouter(tags=["Misc"])
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """解析单段 Range（bytes=a-b / a- / -n），返回闭区间；多段或无法识别返回 None（按完整响应处理）"""
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if start:
+        first = int(start)
+        last = min(int(end), size - 1) if end else size - 1
+    elif end:
+        first, last = max(size - int(end), 0), size - 1
+    else:
+        return None
+    if first > last or first >= size:
+        raise HTTPException(416, headers={"Content-Range": f"bytes */{size}"})
+    return first, last
+
+
+async def _iter_file(path: str, start: int, length: int):
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@uploads_router.api_route("/static/uploads/{filename}", methods=["GET", "HEAD"])
+async def serve_upload(filename: str, request: Request):
+    if not _SAFE_NAME_RE.match(filename):
+        raise HTTPException(404, "File not found")
+    path = os.path.join(UPLOAD_DIR, filename)
+    try:
+        stat = await aiofiles.os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(404, "File not found")
+
+    if _CONTENT_NAME_RE.match(filename):
+        etag = f'"{filename.split(".")[0]}"'
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        cache_control = LEGACY_CACHE_CONTROL
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    size = stat.st_size
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    byte_range = None
+    range_header = request.headers.get("range")
+    # If-Range 与当前 ETag 不一致说明客户端持有的是别的版本，返回完整内容
+    if range_header and request.headers.get("if-range", etag) == etag:
+        byte_range = _parse_range(range_header, size)
+
+    if byte_range:
+        first, last = byte_range
+        headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+        status_code, start, length = 206, first, last - first + 1
+    else:
+        status_code, start, length = 200, 0, size
+    headers["Content-Length"] = str(length)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    return StreamingResponse(_iter_file(path, start, length), status_code=status_code, headers=headers, media_type=media_type)
+
+
+# ==========================================
+# 2. 垃圾回收
+# ==========================================
+async def collect_garbage(session_factory, dry_run: bool = False, min_age_hours: float = 24) -> dict:
+    """
+    删除上传目录中未被任何 Message.media_url 引用的文件。
+    只删除超过 min_age_hours 的文件：刚上传、还没发送成消息的文件不会被误删。
+    """
+    from sqlalchemy import distinct
+    from sqlalchemy.future import select
+    import models
+
+    async with session_factory() as db:
+        result = await db.execute(select(distinct(models.Message.media_url)).filter(models.Message.media_url.isnot(None)))
+        referenced = {os.path.basename(p) for p in map(resolve_upload_path, result.scalars().all()) if p}
+
+    cutoff = time.time() - min_age_hours * 3600
+    stats = {"kept": 0, "removed": 0, "freed_bytes": 0}
+    for directory in (UPLOAD_DIR, UPLOAD_TMP_DIR):
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            if (directory == UPLOAD_DIR and entry.name in referenced) or st.st_mtime > cutoff:
+                stats["kept"] += 1
+                continue
+            stats["removed"] += 1
+            stats["freed_bytes"] += st.st_size
+            if not dry_run:
+                os.remove(entry.path)
+            logger.info(f"🗑️ {'[dry-run] ' if dry_run else ''}删除未引用文件: {entry.path}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    gc = sub.add_parser("gc", help="删除未被消息引用的上传文件")
+    gc.add_argument("--dry-run", action="store_true")
+    gc.add_argument("--min-age-hours", type=float, default=24)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from database import AsyncSessionLocal
+
+    stats = asyncio.run(collect_garbage(AsyncSessionLocal, args.dry_run, args.min_age_hours))
+    print(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from sqlalchemy import event, inspect
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# 已解析用户的缓存时长与容量；TTL 同时是跨 worker 权限变更生效的最长延迟
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+
+class CurrentUser(NamedTuple):
+    """鉴权依赖返回的轻量用户身份（与 models.User 一样可用 .id / .username / .role 访问）"""
+    id: int
+    username: str
+    role: str
+
+
+class UserCache:
+    """
+    以 (sub, iat) 为键的进程内 TTL 缓存：同一个 token 在 TTL 内只查一次 users 表。
+    invalidate(username) 会丢弃该用户的全部缓存，并让此前签发的 token 内嵌声明失效
+    （之后这些 token 必须回库校验，重新登录拿到的新 token 不受影响）。
+    """
+
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_size: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, Optional[int]], Tuple[float, CurrentUser]]" = OrderedDict()
+        self._revoked_at: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sub: str, iat: Optional[int]) -> Optional[CurrentUser]:
+        key = (sub, iat)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, sub: str, iat: Optional[int], user: CurrentUser):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[(sub, iat)] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end((sub, iat))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def claims_trusted(self, sub: str, iat: Optional[int]) -> bool:
+        """token 内嵌的 uid/role 是否可信：签发后该用户在本进程内没有发生过变更"""
+        revoked = self._revoked_at.get(sub)
+        return revoked is None or (iat is not None and iat > revoked)
+
+    def invalidate(self, username: str):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == username]:
+                del self._entries[key]
+            self._revoked_at[username] = time.time()
+        logger.info(f"🔑 用户缓存已失效: {username}")
+
+    def snapshot(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+user_cache = UserCache()
+
+
+# 任何代码路径修改角色/用户名或删除用户，flush 时都会自动失效缓存
+@event.listens_for(models.User, "after_update")
+def _on_user_update(mapper, connection, target):
+    user_cache.invalidate(target.username)
+    # 改名时旧用户名签发的 token 也要失效
+    for old_name in inspect(target).attrs.username.history.deleted or ():
+        user_cache.invalidate(old_name)
+
+
+@event.listens_for(models.User, "after_delete")
+def _on_user_delete(mapper, connection, target):
+    user_cache.invalidate(target.username)